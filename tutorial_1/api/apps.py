@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "api"
+
+    def ready(self):
+        # Connect the cache invalidation and order status receivers
+        from . import signals  # noqa: F401
+        # Time every SQL statement on every connection
+        from . import db_instrumentation  # noqa: F401
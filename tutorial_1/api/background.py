@@ -0,0 +1,44 @@
+# api/background.py
+import os
+import threading
+
+class BackgroundThread:
+    """
+    A daemon thread started on first use, and again in each forked process.
+
+    Threads don't survive ``fork()``, so a gunicorn worker forked from a parent
+    that already started one gets its own on its next ``ensure_started``; so
+    does a process whose thread has finished.
+    ``before_start`` runs under the lock just before a thread starts, for state
+    inherited from the parent that the new thread mustn't see.
+    """
+    def __init__(self, target, name, before_start=None):
+        self.target = target
+        self.name = name
+        self.before_start = before_start
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def started(self):
+        """Whether the thread was started in this process and is still running."""
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def ensure_started(self):
+        if self.started():
+            return
+
+        with self._lock:
+            if self.started():
+                return
+            if self.before_start is not None:
+                self.before_start()
+            self._thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def join(self, timeout=None):
+        """Wait for this process's thread to finish; the next ``ensure_started`` starts a new one."""
+        if self.started():
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,159 @@
+# api/batch.py
+import json
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from . import caching
+from .models import Item, UserProfile
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+CONFLICT_MODES = ('update', 'ignore')
+
+class BatchError(ValueError):
+    """The request body as a whole can't be processed."""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def parse_batch_body(request):
+    """
+    Parse a JSON array or NDJSON body into ``(rows, errors)``.
+
+    ``rows`` is a list of ``(index, object)``; lines that aren't valid JSON
+    objects are reported in ``errors`` as ``{index: message}`` instead of
+    failing the whole batch.
+    """
+    max_rows = getattr(settings, 'BATCH_INGEST_MAX_ROWS', 10000)
+    rows, errors = [], {}
+
+    if request.content_type in NDJSON_CONTENT_TYPES:
+        lines = [line for line in request.body.decode('utf-8').splitlines() if line.strip()]
+        if len(lines) > max_rows:
+            raise BatchError(f"Batch too large: {len(lines)} rows (max {max_rows})", status=413)
+        for index, line in enumerate(lines):
+            try:
+                rows.append((index, json.loads(line)))
+            except json.JSONDecodeError as e:
+                errors[index] = f"Invalid JSON: {e}"
+    else:
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError as e:
+            raise BatchError(f"Invalid JSON: {e}")
+        if not isinstance(data, list):
+            raise BatchError("Expected a JSON array of objects or an NDJSON body")
+        if len(data) > max_rows:
+            raise BatchError(f"Batch too large: {len(data)} rows (max {max_rows})", status=413)
+        rows = list(enumerate(data))
+
+    valid_rows = []
+    for index, obj in rows:
+        if isinstance(obj, dict):
+            valid_rows.append((index, obj))
+        else:
+            errors[index] = "Expected a JSON object"
+    return valid_rows, errors
+
+def _clean(model, obj, required, defaults=None):
+    """
+    Validate ``obj`` against the model's own field definitions.
+
+    Fields in ``required`` are always validated; fields in ``defaults`` fall
+    back to the given value when absent, as in the single-row endpoints.
+    Returns ``(values, errors)``; unique constraints are left to the database.
+    """
+    values, errors = {}, {}
+    for name in list(required) + list(defaults or {}):
+        if name not in obj and name not in required:
+            values[name] = defaults[name]
+            continue
+        try:
+            values[name] = model._meta.get_field(name).clean(obj.get(name), None)
+        except ValidationError as e:
+            errors[name] = e.messages
+    return values, errors
+
+def _chunks(rows, size):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+def ingest_users(rows, on_conflict='update'):
+    """
+    Validate and insert users in chunked bulk INSERTs, upserting on ``email``.
+
+    With ``on_conflict='update'`` an existing email gets the new username; with
+    ``'ignore'`` it is left alone. When an email appears more than once in a
+    batch, the last occurrence wins. Returns one result per input row.
+
+    Ids and statuses come from reading the chunk's rows back after the INSERT:
+    ``bulk_create`` can't return ids for ignored conflicts, and a row counts as
+    created only if it carries the ``created_at`` this INSERT stamped on it, so
+    an email another writer inserted concurrently is reported as existing.
+    """
+    results = {}
+    by_email = {}
+    for index, obj in rows:
+        values, errors = _clean(UserProfile, obj, ('username', 'email'))
+        if errors:
+            results[index] = {"index": index, "status": "invalid", "errors": errors}
+            continue
+        previous = by_email.get(values['email'])
+        if previous is not None:
+            results[previous[0]] = {"index": previous[0], "status": "superseded"}
+        by_email[values['email']] = (index, values)
+
+    chunk_size = getattr(settings, 'BATCH_INGEST_CHUNK_SIZE', 1000)
+    for chunk in _chunks(list(by_email.values()), chunk_size):
+        emails = [values['email'] for _, values in chunk]
+        with transaction.atomic():
+            objects = [UserProfile(**values) for _, values in chunk]
+            if on_conflict == 'update':
+                UserProfile.objects.bulk_create(
+                    objects, update_conflicts=True,
+                    unique_fields=['email'], update_fields=['username']
+                )
+            else:
+                UserProfile.objects.bulk_create(objects, ignore_conflicts=True)
+            stored = {
+                email: (pk, created_at)
+                for email, pk, created_at in UserProfile.objects.filter(email__in=emails)
+                .values_list('email', 'id', 'created_at')
+            }
+
+        for (index, values), user in zip(chunk, objects):
+            pk, created_at = stored.get(values['email'], (None, None))
+            if created_at is not None and created_at == user.created_at:
+                status = "created"
+            else:
+                status = "updated" if on_conflict == 'update' else "ignored"
+            results[index] = {"index": index, "status": status, "id": pk}
+
+    return [results[index] for index in sorted(results)]
+
+def ingest_items(rows):
+    """Validate and insert items in chunked bulk INSERTs. Returns one result per input row."""
+    results = {}
+    valid = []
+    for index, obj in rows:
+        values, errors = _clean(Item, obj, ('name', 'price'), {'description': '', 'stock': 0})
+        if errors:
+            results[index] = {"index": index, "status": "invalid", "errors": errors}
+        else:
+            valid.append((index, Item(**values)))
+
+    chunk_size = getattr(settings, 'BATCH_INGEST_CHUNK_SIZE', 1000)
+    for chunk in _chunks(valid, chunk_size):
+        Item.objects.bulk_create([item for _, item in chunk])
+        for index, item in chunk:
+            results[index] = {"index": index, "status": "created", "id": item.pk}
+        # bulk_create sends no post_save signals; the new rows only change the list pages
+        caching.invalidate_items(source='item_batch')
+
+    return [results[index] for index in sorted(results)]
+
+def summarize(results):
+    """Count results by status for the response body."""
+    summary = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    return summary
@@ -0,0 +1,170 @@
+# api/caching.py
+import logging
+import threading
+import time
+import zlib
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bump when the shape of cached values changes so old entries are never read
+KEY_SCHEMA = 1
+CATALOG = 'catalog'
+
+_MISSING = object()
+
+# Striped in-process locks: concurrent misses for the same key in one process
+# wait for a single recompute instead of all hitting the database
+_LOCK_STRIPES = [threading.Lock() for _ in range(64)]
+
+def _cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+def _local_lock(key):
+    return _LOCK_STRIPES[zlib.crc32(key.encode('utf-8')) % len(_LOCK_STRIPES)]
+
+def _version(version_key):
+    """
+    Current value of a version counter, creating it if absent.
+
+    Counters start from the clock rather than 1, so a counter that was evicted
+    or expired and recreated can't come back at a version whose entries are
+    still cached. They expire so that reads of keys nobody writes (pks that
+    don't exist) can't pile up counters; living at least as long as any entry,
+    one expiring only costs misses.
+    """
+    cache = _cache()
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, time.time_ns() // 1000, timeout=_version_ttl())
+        version = cache.get(version_key)
+    return version
+
+def _bump(version_key):
+    cache = _cache()
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        cache.add(version_key, time.time_ns() // 1000, timeout=_version_ttl())
+
+def _version_ttl():
+    return max(getattr(settings, 'CATALOG_CACHE_LIST_TTL', 30), getattr(settings, 'CATALOG_CACHE_ITEM_TTL', 300))
+
+def get_or_compute(name, key, compute, ttl, cache_none=True):
+    """
+    Read-through lookup of ``key``, calling ``compute()`` on a miss.
+
+    Recomputes are single-flight: within a process, concurrent misses for a key
+    share one recompute; across processes, the first miss takes a short lock in
+    the cache and the others poll for its result (up to ``CATALOG_CACHE_LOCK_TIMEOUT``)
+    before computing it themselves. Polling happens outside the in-process lock,
+    so it doesn't hold up other keys on the same stripe, and only the process
+    that took the cache lock deletes it. ``None`` is cached unless ``cache_none``
+    is false.
+    """
+    cache = _cache()
+    start = time.perf_counter()
+
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        _record(name, 'hit', start)
+        return value
+
+    lock_timeout = getattr(settings, 'CATALOG_CACHE_LOCK_TIMEOUT', 5)
+    lock_key = f"{key}:lock"
+    with _local_lock(key):
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
+            _record(name, 'coalesced', start)
+            return value
+
+        if cache.add(lock_key, 1, timeout=lock_timeout):
+            try:
+                value = compute()
+                if value is not None or cache_none:
+                    cache.set(key, value, timeout=ttl)
+            finally:
+                cache.delete(lock_key)
+            _record(name, 'miss', start)
+            return value
+
+    # Another process is recomputing: wait for its result
+    deadline = time.monotonic() + lock_timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.02)
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
+            _record(name, 'coalesced', start)
+            return value
+    logger.warning(f"Gave up waiting for cache recompute of {key}")
+
+    with _local_lock(key):
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
+            _record(name, 'coalesced', start)
+            return value
+        # The lock belongs to the other process (or has expired); leave it alone
+        value = compute()
+        if value is not None or cache_none:
+            cache.set(key, value, timeout=ttl)
+
+    _record(name, 'miss', start)
+    return value
+
+def _record(name, result, start):
+    metrics.recorder.inc(metrics.cache_requests_total, (name, result))
+    metrics.recorder.observe(metrics.cache_lookup_duration_seconds, (name, result), time.perf_counter() - start)
+
+def _list_version_key():
+    return f"{CATALOG}:s{KEY_SCHEMA}:list-version"
+
+def _item_version_key(pk):
+    return f"{CATALOG}:s{KEY_SCHEMA}:item-version:{pk}"
+
+def get_item_page(params, compute):
+    """
+    Cached item list page for the normalized ``params`` tuple.
+
+    Keys embed the catalog list version: any invalidation moves readers to new
+    keys, and a recompute racing with a write is stored under the old version
+    where nobody will read it.
+    """
+    version = _version(_list_version_key())
+    key = f"{CATALOG}:s{KEY_SCHEMA}:list:v{version}:" + ":".join(str(param) for param in params)
+    return get_or_compute('item_list', key, compute,
+                          getattr(settings, 'CATALOG_CACHE_LIST_TTL', 30))
+
+def get_item(pk, compute):
+    """
+    Cached single item (or ``None`` when it doesn't exist), versioned per item.
+
+    Missing items aren't cached, so creating an item only has to invalidate
+    the list pages, not its own (never cached) entry.
+    """
+    version = _version(_item_version_key(pk))
+    key = f"{CATALOG}:s{KEY_SCHEMA}:item:{pk}:v{version}"
+    return get_or_compute('item_detail', key, compute,
+                          getattr(settings, 'CATALOG_CACHE_ITEM_TTL', 300), cache_none=False)
+
+def invalidate_items(pks=(), source='write'):
+    """
+    Invalidate cached list pages and the given items once the current transaction commits.
+
+    Pass only existing items that changed or were deleted: new rows have no
+    cached entry, so inserts just invalidate the list pages.
+
+    Deferring to commit keeps a reader from recomputing from rows that are
+    about to change (or roll back); outside a transaction it runs immediately.
+    """
+    pks = list(pks)
+
+    def invalidate():
+        _bump(_list_version_key())
+        for pk in pks:
+            _bump(_item_version_key(pk))
+        metrics.cache_invalidations_total.labels(cache=CATALOG, source=source).inc()
+
+    transaction.on_commit(invalidate)
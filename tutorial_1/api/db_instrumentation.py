@@ -0,0 +1,179 @@
+# api/db_instrumentation.py
+import collections
+import contextlib
+import contextvars
+import functools
+import re
+import time
+import sqlparse
+from sqlparse.sql import Function, Identifier
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from . import metrics
+
+# Literals and placeholders collapse to "?" and lists of them to "?, ...", so
+# the same query with different values or IN/VALUES lengths has one fingerprint
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|%\(\w+\)s")
+_PLACEHOLDER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_VALUES_LIST = re.compile(r"\((?:\?|\?, \.\.\.)\)(?:\s*,\s*\((?:\?|\?, \.\.\.)\))+")
+_WHITESPACE = re.compile(r"\s+")
+_LEADING_WORD = re.compile(r"[A-Za-z]+")
+
+_TABLE_KEYWORDS = frozenset(('FROM', 'INTO', 'UPDATE'))
+
+def normalize(sql):
+    """Normalized statement used as its fingerprint, e.g. ``... WHERE "id" IN (?, ...)``."""
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _PLACEHOLDER.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _PLACEHOLDER_LIST.sub('?, ...', sql)
+    sql = _VALUES_LIST.sub('(?, ...), ...', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+@functools.lru_cache(maxsize=2048)
+def classify(fingerprint):
+    """
+    ``(query_type, table)`` labels for a normalized statement, parsed with sqlparse.
+
+    The table is the first one the statement reads from, inserts into or
+    updates; statements without one (``SAVEPOINT``, ``SET``) get ``none``.
+    Parsing takes about a millisecond, hence the cache.
+    """
+    statement = sqlparse.parse(fingerprint)[0]
+    query_type = statement.get_type()
+    if query_type == 'UNKNOWN':
+        # Label by the leading keyword instead: SAVEPOINT, RELEASE, SET, ...
+        leading = _LEADING_WORD.match(fingerprint)
+        query_type = leading.group(0).upper() if leading else 'OTHER'
+
+    after_keyword = False
+    for token in statement.tokens:
+        if after_keyword and isinstance(token, (Identifier, Function)):
+            return query_type, token.get_real_name() or 'none'
+        if token.is_keyword and token.normalized in _TABLE_KEYWORDS:
+            after_keyword = True
+    return query_type, 'none'
+
+@functools.lru_cache(maxsize=4096)
+def _analyze(sql):
+    fingerprint = normalize(sql)
+    return (fingerprint,) + classify(fingerprint)
+
+# A statement that took at least SLOW_QUERY_THRESHOLD seconds, with what's needed to EXPLAIN it
+SlowStatement = collections.namedtuple(
+    'SlowStatement', ['fingerprint', 'query_type', 'table', 'duration', 'sql', 'params', 'many', 'alias']
+)
+
+class QueryStats:
+    """Queries run while handling one request, grouped by fingerprint."""
+    # Slow statements kept per request; the rest are only counted
+    MAX_SLOW_STATEMENTS = 20
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id
+        # request_ids only lets through IDs that are safe inside a SQL comment
+        self.sql_comment = f" /*request_id='{request_id}'*/" if request_id else ''
+        self.count = 0
+        self.duration = 0.0
+        # fingerprint -> [query_type, table, executions, total seconds]
+        self.statements = {}
+        self.slow = []
+
+    def record(self, fingerprint, query_type, table, duration):
+        self.count += 1
+        self.duration += duration
+        entry = self.statements.get(fingerprint)
+        if entry is None:
+            self.statements[fingerprint] = [query_type, table, 1, duration]
+        else:
+            entry[2] += 1
+            entry[3] += duration
+
+    def record_slow(self, statement):
+        if len(self.slow) < self.MAX_SLOW_STATEMENTS:
+            self.slow.append(statement)
+
+    def top_statements(self, limit):
+        """``(fingerprint, executions, total seconds)`` of the ``limit`` statements with the most DB time."""
+        statements = [
+            (fingerprint, executions, duration)
+            for fingerprint, (query_type, table, executions, duration) in self.statements.items()
+        ]
+        return sorted(statements, key=lambda statement: statement[2], reverse=True)[:limit]
+
+    def repeated_selects(self, threshold):
+        """
+        SELECT fingerprints executed at least ``threshold`` times, most frequent first.
+
+        The same SELECT run again and again with different parameters is the
+        signature of an N+1: a query per row of an earlier result.
+        """
+        repeated = [
+            (fingerprint, executions, duration)
+            for fingerprint, (query_type, table, executions, duration) in self.statements.items()
+            if query_type == 'SELECT' and executions >= threshold
+        ]
+        return sorted(repeated, key=lambda statement: statement[1], reverse=True)
+
+_request_stats = contextvars.ContextVar('db_query_stats', default=None)
+
+def start_request(request_id=None):
+    """Start counting this context's queries; returns the stats and a token for ``finish_request``."""
+    stats = QueryStats(request_id)
+    return stats, _request_stats.set(stats)
+
+def finish_request(token):
+    _request_stats.reset(token)
+
+def current_stats():
+    return _request_stats.get()
+
+@contextlib.contextmanager
+def untracked():
+    """Keep statements run in this block out of the current request's stats."""
+    token = _request_stats.set(None)
+    try:
+        yield
+    finally:
+        _request_stats.reset(token)
+
+def instrument(execute, sql, params, many, context):
+    """
+    Execute wrapper timing every statement Django sends to the database.
+
+    Each statement is recorded in ``db_query_duration_seconds`` by query type
+    and table, and in the current request's ``QueryStats``, which also keeps
+    statements slower than ``SLOW_QUERY_THRESHOLD`` seconds. Queries outside a
+    request (background threads, management commands, the rows of a streamed
+    export consumed after the view returned) are still timed.
+
+    With ``DB_QUERY_COMMENTS``, statements run for a request carry its ID in
+    a trailing SQL comment, so the database's own logs (slow query log,
+    ``pg_stat_activity``) can be joined with ours. PostgreSQL ignores comments
+    when grouping statements in ``pg_stat_statements``.
+    """
+    stats = _request_stats.get()
+    executed_sql = sql
+    if stats is not None and stats.sql_comment and getattr(settings, 'DB_QUERY_COMMENTS', False):
+        executed_sql = sql + stats.sql_comment
+    start = time.perf_counter()
+    try:
+        return execute(executed_sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        fingerprint, query_type, table = _analyze(sql)
+        metrics.track_db_query(query_type, table, duration)
+        if stats is not None:
+            stats.record(fingerprint, query_type, table, duration)
+            if duration >= getattr(settings, 'SLOW_QUERY_THRESHOLD', 0.1):
+                stats.record_slow(SlowStatement(fingerprint, query_type, table, duration,
+                                                sql, params, many, context['connection'].alias))
+
+@receiver(connection_created, dispatch_uid='api.instrument_db_connection')
+def install(sender, connection, **kwargs):
+    """Add the wrapper to every database connection as it's opened."""
+    if getattr(settings, 'DB_INSTRUMENTATION_ENABLED', True) and instrument not in connection.execute_wrappers:
+        connection.execute_wrappers.append(instrument)
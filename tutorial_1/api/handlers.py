@@ -1,95 +1,578 @@
 import logging
 import json
+import os
+import gzip
 import time
+import threading
+import random
+import collections
 import requests
-from datetime import datetime
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from . import metrics
+from .background import BackgroundThread
+
+# Optional fast JSON encoders, used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+RESERVED_RECORD_ATTRS = frozenset(
+    logging.LogRecord('', logging.INFO, '', 0, '', (), None).__dict__
+) | {'message', 'asctime', 'taskName'}
+
+
+def get_json_encoder(backend='auto'):
+    """
+    Return a function that encodes an object to JSON bytes.
+
+    ``auto`` picks orjson, then msgspec, then the standard library. Values the
+    encoder doesn't know about are converted with ``str``.
+    """
+    if backend == 'auto':
+        backend = 'orjson' if orjson else 'msgspec' if msgspec else 'json'
+
+    if backend == 'orjson':
+        if orjson is None:
+            raise ImportError("The orjson JSON backend requires the orjson package")
+        return lambda obj: orjson.dumps(obj, default=str)
+    if backend == 'msgspec':
+        if msgspec is None:
+            raise ImportError("The msgspec JSON backend requires the msgspec package")
+        return msgspec.json.Encoder(enc_hook=str).encode
+    if backend == 'json':
+        return lambda obj: json.dumps(obj, default=str, separators=(',', ':')).encode('utf-8')
+    raise ValueError(f"Unknown JSON backend: {backend}")
+
+
+class CircuitBreaker:
+    """
+    Minimal circuit breaker guarding the Loki endpoint.
+
+    After ``failure_threshold`` consecutive failed deliveries the breaker opens
+    and pushes are skipped for ``reset_timeout`` seconds. The next delivery after
+    that is a half-open trial: success closes the breaker, failure re-opens it.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+    STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.state = self.CLOSED
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            return self.state != self.OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        if state != self.state:
+            metrics.loki_circuit_breaker_transitions_total.labels(state=state).inc()
+        self.state = state
+        metrics.loki_circuit_breaker_state.set(self.STATE_VALUES[state])
+
+
+class SpillFile:
+    """
+    Append-only, size-capped file of batches that could not be delivered.
+
+    Each line holds one JSON-encoded batch. Appends use ``O_APPEND`` so several
+    worker processes can share a file, and replay atomically renames the file
+    aside before reading it so a batch is only ever replayed once.
+    """
+    def __init__(self, path, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def append(self, batch):
+        """Persist a batch, returning False when the file is full."""
+        line = (json.dumps([[list(labels), value] for labels, value in batch],
+                           separators=(',', ':')) + "\n").encode('utf-8')
+
+        with self._lock:
+            if self.size() + len(line) > self.max_bytes:
+                return False
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            metrics.loki_spill_bytes.set(self.size())
+            return True
+
+    def take(self):
+        """Move the spilled batches aside and yield them one by one."""
+        replay_path = f"{self.path}.{os.getpid()}.replay"
+        with self._lock:
+            try:
+                os.rename(self.path, replay_path)
+            except FileNotFoundError:
+                return
+            metrics.loki_spill_bytes.set(self.size())
+
+        try:
+            with open(replay_path, encoding='utf-8') as spilled:
+                for line in spilled:
+                    try:
+                        batch = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn write from a crashed process; skip it
+                        continue
+                    yield [(tuple(tuple(label) for label in labels), value) for labels, value in batch]
+        finally:
+            os.remove(replay_path)
+
 
 class LokiHandler(logging.Handler):
     """
     Custom log handler to send logs to Loki.
-    """ 
-    def __init__(self, url='http://localhost:3100/loki/api/v1/push', **kwargs):
+
+    Two shipping modes are supported:
+
+    - ``async`` (default): ``emit`` only appends the entry to a bounded in-memory
+      ring buffer. A dedicated background thread drains it in batches, sending
+      whenever ``batch_size`` entries are waiting or ``flush_interval`` seconds
+      have passed. The request thread never waits on Loki.
+    - ``sync``: the original behaviour, where the thread that logs the record
+      sends the batch itself.
+
+    When the buffer is full, ``overflow_policy`` decides what happens:
+    ``drop_oldest`` evicts the oldest queued entry, ``drop_newest`` discards the
+    incoming one, and ``block`` waits up to ``block_timeout`` seconds for room
+    before discarding the incoming entry.
+
+    Batches are pushed as one stream per distinct label set, compressed with
+    ``compression`` (``gzip`` or ``None``), over a keep-alive ``requests.Session``
+    so consecutive pushes reuse the same pooled connection.
+
+    Stream labels are limited to the low-cardinality fields in ``labels``.
+    Per-request fields such as ``request_id`` and ``user_id`` would create a new
+    stream for every request, so they are listed in ``metadata_fields`` and sent
+    as Loki structured metadata (``metadata_mode='structured'``) or folded into
+    the log line itself (``metadata_mode='line'``).
+
+    Failed pushes are retried up to ``max_retries`` times with jittered
+    exponential backoff. Repeated failures open a circuit breaker so a dead
+    endpoint is not hammered, and batches that still cannot be delivered are
+    appended to ``spill_path`` (capped at ``spill_max_bytes``) and replayed once
+    a push succeeds again.
+
+    With ``record_format='structured'`` the log line is built straight from the
+    record and its ``extra`` fields and encoded once with ``json_backend``,
+    bypassing the formatter. ``record_format='formatter'`` uses the configured
+    formatter's output as the line unchanged.
+    """
+    OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+    COMPRESSIONS = (None, 'gzip')
+    METADATA_MODES = ('structured', 'line')
+    RECORD_FORMATS = ('formatter', 'structured')
+    METADATA_DEFAULTS = {'request_id': 'no-request-id', 'user_id': 'anonymous', 'trace_id': 'no-trace-id'}
+    RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, url='http://localhost:3100/loki/api/v1/push', mode='async',
+                 batch_size=10, flush_interval=5, queue_size=10000,
+                 overflow_policy='drop_oldest', block_timeout=0.05,
+                 shutdown_timeout=10, compression='gzip', compress_level=6,
+                 timeout=5, pool_size=2, labels=('level', 'module', 'app'),
+                 metadata_fields=('request_id', 'user_id'), metadata_mode='structured',
+                 app='django-monitoring-demo', max_retries=3, backoff_base=0.5,
+                 backoff_max=10, breaker_threshold=5, breaker_reset_timeout=30,
+                 spill_path=None, spill_max_bytes=50 * 1024 * 1024,
+                 record_format='formatter', json_backend='auto', **kwargs):
         super().__init__()
+        if mode not in ('async', 'sync'):
+            raise ValueError(f"Unknown Loki shipping mode: {mode}")
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown Loki overflow policy: {overflow_policy}")
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f"Unsupported Loki compression: {compression}")
+        if metadata_mode not in self.METADATA_MODES:
+            raise ValueError(f"Unknown Loki metadata mode: {metadata_mode}")
+        if record_format not in self.RECORD_FORMATS:
+            raise ValueError(f"Unknown Loki record format: {record_format}")
+
         self.url = url
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.compression = compression
+        self.compress_level = compress_level
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.labels = tuple(labels)
+        self.metadata_fields = tuple(metadata_fields)
+        self.metadata_mode = metadata_mode
+        self.app = app
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_timeout)
+        self.spill = SpillFile(spill_path, spill_max_bytes) if spill_path else None
+        self.record_format = record_format
+        self._encode_json = get_json_encoder(json_backend)
         self.batch = []
         self.last_send_time = time.time()
-    
-    def emit(self, record):
-        try:
-            # Format the record
-            log_entry = self.format(record)
-            
-            # Extract JSON fields if using JsonFormatter
+
+        # Ring buffer shared with the background shipper thread
+        self._queue = collections.deque()
+        self._queue_lock = threading.Lock()
+        self._not_empty = threading.Condition(self._queue_lock)
+        self._not_full = threading.Condition(self._queue_lock)
+        self._queue_pid = os.getpid()
+        self._closing = False
+        self._worker = BackgroundThread(self._run_worker, 'loki-shipper', before_start=self._prepare_worker)
+        self._session = None
+        self._session_pid = None
+
+    def build_entry(self, record):
+        """
+        Turn a log record into a Loki entry: a hashable label set plus its value.
+
+        Only the fields listed in ``labels`` become stream labels. The
+        high-cardinality ``metadata_fields`` are attached as structured
+        metadata, or embedded in the log line when ``metadata_mode`` is ``line``.
+        """
+        metadata = {
+            field: str(getattr(record, field, self.METADATA_DEFAULTS.get(field, 'unknown')))
+            for field in self.metadata_fields
+        }
+
+        if self.record_format == 'structured':
+            log_data = self.record_to_dict(record)
+            if self.metadata_mode == 'line':
+                for field, value in metadata.items():
+                    log_data.setdefault(field, value)
+            message = self._encode_json(log_data).decode('utf-8')
+        else:
+            # The formatter output is used verbatim (JsonFormatter output is already JSON)
+            message = self.format(record)
+            if self.metadata_mode == 'line' and metadata:
+                message = self._embed_metadata(message, metadata)
+
+        # Create Loki record with labels, stamped with the time it was logged
+        timestamp_ns = int(record.created * 1_000_000_000)
+
+        # Entries sharing a label set are merged into one stream at push time
+        labels = tuple((name, self._label_value(record, name)) for name in self.labels)
+        if self.metadata_mode == 'structured' and metadata:
+            return (labels, [str(timestamp_ns), message, metadata])
+        return (labels, [str(timestamp_ns), message])
+
+    def record_to_dict(self, record):
+        """Collect the standard fields of a record plus everything passed via ``extra``."""
+        log_data = {
+            "timestamp": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "name": record.name,
+            "message": record.getMessage(),
+            "pathname": record.pathname,
+            "lineno": record.lineno,
+        }
+        for key, value in record.__dict__.items():
+            if key not in RESERVED_RECORD_ATTRS:
+                log_data[key] = value
+
+        if record.exc_info:
+            log_data["exc_info"] = (self.formatter or logging.Formatter()).formatException(record.exc_info)
+        return log_data
+
+    def _embed_metadata(self, message, metadata):
+        """Add metadata fields to a formatted line that doesn't already carry them."""
+        if message.startswith('{'):
             try:
-                log_data = json.loads(log_entry)
-                # Convert to string for Loki
-                message = json.dumps(log_data)
+                log_data = json.loads(message)
             except json.JSONDecodeError:
-                # Not JSON, use as is
-                message = log_entry
-            
-            # Create Loki record with labels
-            timestamp_ns = int(time.time() * 1_000_000_000)
-            
-            # Extract attributes for labels
-            level = getattr(record, 'levelname', 'INFO').lower()
-            request_id = getattr(record, 'request_id', 'no-request-id')
-            user_id = getattr(record, 'user_id', 'anonymous')
-            module = record.module if hasattr(record, 'module') else 'unknown'
-            
-            # Create the log entry for Loki
-            entry = {
-                "stream": {
-                    "level": level,
-                    "request_id": request_id,
-                    "user_id": user_id,
-                    "module": module,
-                    "app": "django-monitoring-demo"
-                },
-                "values": [
-                    [str(timestamp_ns), message]
-                ]
-            }
-            
-            # Add to batch - in production, you'd want to implement proper batching
+                log_data = None
+            if isinstance(log_data, dict):
+                missing = {field: value for field, value in metadata.items() if field not in log_data}
+                if not missing:
+                    return message
+                log_data.update(missing)
+                return self._encode_json(log_data).decode('utf-8')
+        return " ".join([message] + [f"{field}={value}" for field, value in metadata.items()])
+
+    def _label_value(self, record, name):
+        """Resolve a stream label from the record."""
+        if name == 'level':
+            return getattr(record, 'levelname', 'INFO').lower()
+        if name == 'app':
+            return self.app
+        return str(getattr(record, name, 'unknown'))
+
+    def emit(self, record):
+        try:
+            entry = self.build_entry(record)
+
+            if self.mode == 'async':
+                # Hand the entry to the background shipper and return immediately
+                self._enqueue(entry)
+                return
+
             self.batch.append(entry)
-            
+
             # Send if batch is full or it's been a while
-            if len(self.batch) >= 10 or (time.time() - self.last_send_time) > 5:
-                self._send_logs()
-                
+            if len(self.batch) >= self.batch_size or (time.time() - self.last_send_time) > self.flush_interval:
+                batch, self.batch = self.batch, []
+                self.last_send_time = time.time()
+                self._send_logs(batch)
+
         except Exception as e:
             # Never let logging break the application
             print(f"Error sending logs to Loki: {e}")
-    
-    def _send_logs(self):
-        """Send the batch of logs to Loki."""
-        if not self.batch:
+
+    def _enqueue(self, entry):
+        """Add an entry to the ring buffer, applying the overflow policy when full."""
+        self._worker.ensure_started()
+
+        with self._queue_lock:
+            if len(self._queue) >= self.queue_size:
+                if self.overflow_policy == 'block':
+                    self._not_full.wait_for(
+                        lambda: len(self._queue) < self.queue_size or self._closing,
+                        timeout=self.block_timeout
+                    )
+
+                if len(self._queue) >= self.queue_size:
+                    metrics.loki_log_lines_dropped_total.labels(reason='overflow').inc()
+                    if self.overflow_policy != 'drop_oldest':
+                        return
+                    self._queue.popleft()
+
+            self._queue.append(entry)
+            if len(self._queue) >= self.batch_size:
+                self._not_empty.notify()
+
+        metrics.recorder.inc(metrics.loki_log_lines_queued_total, ())
+
+    def _prepare_worker(self):
+        """
+        Reset the shipper's state before it (re)starts.
+
+        A shipper stopped by ``close()`` starts again for records logged after
+        it. In a forked child, the entries queued by the parent are the
+        parent's to ship, and its lock may have been held mid-fork, so the
+        child starts with a fresh queue.
+        """
+        if self._queue_pid != os.getpid():
+            self._queue = collections.deque()
+            self._queue_lock = threading.Lock()
+            self._not_empty = threading.Condition(self._queue_lock)
+            self._not_full = threading.Condition(self._queue_lock)
+            self._queue_pid = os.getpid()
+        self._closing = False
+
+    def _run_worker(self):
+        """Drain the ring buffer in size- and time-triggered batches."""
+        last_flush = time.monotonic()
+
+        while True:
+            with self._queue_lock:
+                while len(self._queue) < self.batch_size and not self._closing:
+                    remaining = self.flush_interval - (time.monotonic() - last_flush)
+                    if remaining <= 0:
+                        break
+                    self._not_empty.wait(remaining)
+
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.batch_size))]
+                finished = self._closing and not self._queue
+                self._not_full.notify_all()
+
+            if batch:
+                self._send_logs(batch)
+            last_flush = time.monotonic()
+
+            if finished:
+                return
+
+    @staticmethod
+    def build_payload(batch):
+        """
+        Build a Loki push payload, merging entries with identical labels.
+
+        Each distinct label set is sent once, with all of its values in
+        the order they were logged.
+        """
+        streams = {}
+        for labels, value in batch:
+            streams.setdefault(labels, []).append(value)
+
+        return {
+            "streams": [
+                {"stream": dict(labels), "values": values}
+                for labels, values in streams.items()
+            ]
+        }
+
+    def _encode_payload(self, batch):
+        """Serialize (and optionally compress) a batch into a request body and headers."""
+        body = self._encode_json(self.build_payload(batch))
+        headers = {"Content-Type": "application/json"}
+
+        if self.compression == 'gzip':
+            body = gzip.compress(body, compresslevel=self.compress_level)
+            headers["Content-Encoding"] = "gzip"
+
+        return body, headers
+
+    def _get_session(self):
+        """Return a keep-alive session, creating a fresh one in forked processes."""
+        if self._session is None or self._session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+            self._session_pid = os.getpid()
+        return self._session
+
+    def _send_logs(self, batch):
+        """
+        Deliver a batch of logs to Loki.
+
+        The batch is retried with backoff while the circuit breaker allows it,
+        and spilled to disk if it still cannot be delivered.
+        """
+        if not batch:
             return
-            
+
+        if self._push_with_retries(batch):
+            metrics.loki_log_lines_sent_total.inc(len(batch))
+            self._replay_spill()
+        else:
+            self._spill(batch)
+
+    def _push_with_retries(self, batch):
+        """Push a batch, returning True once Loki has accepted it."""
         try:
-            payload = {
-                "streams": self.batch
-            }
-            
-            # In production, add proper error handling, retries, etc.
-            response = requests.post(
-                self.url,
-                json=payload,
-                headers={"Content-Type": "application/json"}
-            )
-            
-            if response.status_code != 204:
-                print(f"Failed to send logs to Loki: {response.status_code} {response.text}")
-                
+            body, headers = self._encode_payload(batch)
         except Exception as e:
-            print(f"Error sending batch to Loki: {e}")
-        finally:
-            # Reset batch and update timestamp regardless of success
-            self.batch = []
-            self.last_send_time = time.time()
-            
+            print(f"Error encoding batch for Loki: {e}")
+            metrics.loki_log_lines_dropped_total.labels(reason='error').inc(len(batch))
+            return True
+
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow_request():
+                metrics.loki_push_attempts_total.labels(outcome='short_circuited').inc()
+                return False
+
+            if attempt:
+                # Full jitter keeps workers from retrying in lockstep
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+                metrics.loki_push_backoff_seconds_total.inc(delay)
+                time.sleep(delay)
+
+            try:
+                response = self._get_session().post(
+                    self.url,
+                    data=body,
+                    headers=headers,
+                    timeout=self.timeout
+                )
+            except requests.RequestException as e:
+                print(f"Error sending batch to Loki: {e}")
+                metrics.loki_push_attempts_total.labels(outcome='error').inc()
+                self.breaker.record_failure()
+                continue
+
+            if response.status_code == 204:
+                metrics.loki_push_attempts_total.labels(outcome='success').inc()
+                self.breaker.record_success()
+                return True
+
+            print(f"Failed to send logs to Loki: {response.status_code} {response.text}")
+            if response.status_code not in self.RETRYABLE_STATUS_CODES:
+                # Loki rejected the payload itself; retrying won't help
+                metrics.loki_push_attempts_total.labels(outcome='rejected').inc()
+                metrics.loki_log_lines_dropped_total.labels(reason='rejected').inc(len(batch))
+                self.breaker.record_success()
+                return True
+
+            metrics.loki_push_attempts_total.labels(outcome='retryable_status').inc()
+            self.breaker.record_failure()
+
+        return False
+
+    def _spill(self, batch):
+        """Park an undeliverable batch on disk, or drop it if spilling isn't possible."""
+        if self.spill is None:
+            metrics.loki_log_lines_dropped_total.labels(reason='undeliverable').inc(len(batch))
+            return
+
+        try:
+            spilled = self.spill.append(batch)
+        except OSError as e:
+            print(f"Error spilling logs to {self.spill.path}: {e}")
+            spilled = False
+
+        if spilled:
+            metrics.loki_spill_batches_total.labels(action='spilled').inc()
+        else:
+            metrics.loki_log_lines_dropped_total.labels(reason='spill_full').inc(len(batch))
+
+    def _replay_spill(self):
+        """Re-send spilled batches now that the endpoint is accepting pushes again."""
+        if self.spill is None or not self.spill.size():
+            return
+
+        recovered = True
+        for batch in self.spill.take():
+            if recovered and self._push_with_retries(batch):
+                metrics.loki_spill_batches_total.labels(action='replayed').inc()
+                metrics.loki_log_lines_sent_total.inc(len(batch))
+            else:
+                # Still failing: put the rest back and let the next success retry them
+                recovered = False
+                self._spill(batch)
+
     def close(self):
         """Send any remaining logs when shutting down."""
-        self._send_logs()
-        super().close()
\ No newline at end of file
+        if self._worker.started():
+            # Let the shipper drain everything that is still queued, then stop
+            with self._queue_lock:
+                self._closing = True
+                self._not_empty.notify_all()
+                self._not_full.notify_all()
+            self._worker.join(self.shutdown_timeout)
+
+        batch, self.batch = self.batch, []
+        self._send_logs(batch)
+
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        super().close()
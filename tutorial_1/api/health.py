@@ -0,0 +1,100 @@
+# api/health.py
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import connections
+from . import metrics
+from .background import BackgroundThread
+
+logger = logging.getLogger(__name__)
+
+class HealthMonitor:
+    """
+    Keeps a health snapshot fresh from a background thread.
+
+    Every ``ttl`` seconds the refresher samples process stats and checks that
+    the database answers ``SELECT 1``. Endpoints only read the latest snapshot,
+    so a load balancer probing several times a second costs no syscalls or
+    database round trips. A snapshot older than ``max_staleness`` seconds is
+    reported as stale, which catches a stuck or dead refresher.
+
+    Samples are only ever taken on the refresher thread, which owns its
+    database connection. The first call in a process waits up to
+    ``warmup_timeout`` seconds for the first sample, then reports a
+    warming-up snapshot (database not OK) rather than sampling inline.
+    """
+    def __init__(self, ttl=5.0, max_staleness=None, database='default', warmup_timeout=1.0):
+        self.ttl = ttl
+        self.max_staleness = max_staleness if max_staleness is not None else ttl * 3
+        self.database = database
+        self.warmup_timeout = warmup_timeout
+        self._snapshot = None
+        self._sampled = threading.Event()
+        # A snapshot inherited from a parent process describes the wrong process
+        self._refresher = BackgroundThread(self._run, 'health-monitor', before_start=self._forget_snapshot)
+
+    def snapshot(self):
+        """Return the latest health snapshot, starting the refresher if needed."""
+        self._refresher.ensure_started()
+        snapshot = self._snapshot
+        if snapshot is None:
+            self._sampled.wait(self.warmup_timeout)
+            snapshot = self._snapshot
+        if snapshot is None:
+            return {
+                "memory_usage_mb": None,
+                "cpu_percent": None,
+                "thread_count": None,
+                "database_ok": False,
+                "warming_up": True,
+                "stale": False,
+            }
+
+        return dict(snapshot, warming_up=False,
+                    stale=time.monotonic() - snapshot['sampled_at'] > self.max_staleness)
+
+    def _forget_snapshot(self):
+        self._snapshot = None
+        self._sampled = threading.Event()
+
+    def _run(self):
+        while True:
+            try:
+                self._snapshot = self._sample()
+            except Exception as e:
+                logger.error(f"Health snapshot refresh failed: {str(e)}")
+            # Waiters stop waiting after the first attempt, even a failed one
+            self._sampled.set()
+            time.sleep(self.ttl)
+
+    def _sample(self):
+        process = metrics.get_process_snapshot(max_age=0)
+        return {
+            "sampled_at": time.monotonic(),
+            "memory_usage_mb": process['rss_bytes'] / (1024 * 1024),
+            "cpu_percent": process['cpu_percent'],
+            "thread_count": process['thread_count'],
+            "database_ok": self._check_database(),
+        }
+
+    def _check_database(self):
+        connection = connections[self.database]
+        try:
+            # Execute a simple test query
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except Exception as e:
+            logger.warning(f"Database health check failed: {str(e)}")
+            return False
+        finally:
+            # Only the refresher thread gets here, and it shouldn't pin its
+            # connection between checks
+            connection.close()
+
+monitor = HealthMonitor(ttl=getattr(settings, 'HEALTH_CHECK_TTL', 5.0))
+
+def get_health_snapshot():
+    """Return the cached health snapshot shared by the health endpoints."""
+    return monitor.snapshot()
@@ -0,0 +1,62 @@
+# api/leaderboard.py
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from .models import UserOrderCount, UserProfile
+
+def record_orders(user_id, delta=1):
+    """
+    Adjust a user's order count by ``delta`` in the caller's transaction.
+
+    The common case is a single ``UPDATE ... SET order_count = order_count + 1``;
+    a user's first order inserts the row, retrying as an update if a concurrent
+    first order won the insert.
+    """
+    if UserOrderCount.objects.filter(user_id=user_id).update(order_count=F('order_count') + delta) or delta <= 0:
+        # Nothing to decrement without a row (e.g. the user is being deleted too)
+        return
+    try:
+        with transaction.atomic():
+            UserOrderCount.objects.create(user_id=user_id, order_count=delta)
+    except IntegrityError:
+        UserOrderCount.objects.filter(user_id=user_id).update(order_count=F('order_count') + delta)
+
+def top_users(limit=10):
+    """
+    The ``limit`` users with the most orders, as ``(username, order_count)`` pairs.
+
+    Reads the first ``limit`` entries of the ``(-order_count, user)`` index.
+    """
+    limit = min(limit, getattr(settings, 'LEADERBOARD_MAX_SIZE', 100))
+    return list(
+        UserOrderCount.objects.filter(order_count__gt=0)
+        .order_by('-order_count', 'user')
+        .values_list('user__username', 'order_count')[:limit]
+    )
+
+def rebuild(chunk_size=5000):
+    """
+    Recompute every user's order count from the order table. Returns the rows written.
+
+    Orders placed while the rebuild runs can be counted twice or missed, so run
+    it when order traffic is quiet.
+    """
+    counts = (
+        UserProfile.objects.annotate(order_count=Count('order'))
+        .filter(order_count__gt=0)
+        .values_list('pk', 'order_count')
+        .order_by()
+    )
+    written = 0
+    with transaction.atomic():
+        UserOrderCount.objects.all().delete()
+        batch = []
+        for user_id, order_count in counts.iterator(chunk_size=chunk_size):
+            batch.append(UserOrderCount(user_id=user_id, order_count=order_count))
+            if len(batch) >= chunk_size:
+                UserOrderCount.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+        UserOrderCount.objects.bulk_create(batch)
+        written += len(batch)
+    return written
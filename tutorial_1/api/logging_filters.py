@@ -3,7 +3,7 @@ from .middleware import RequestContext
 
 class RequestIdFilter(logging.Filter):
     """
-    This filter adds request_id and user_id to log records.
+    This filter adds request_id, user_id and trace_id to log records.
     
     Having these fields in your logs is crucial for tracing issues
     across multiple services and understanding user context.
@@ -11,4 +11,5 @@ class RequestIdFilter(logging.Filter):
     def filter(self, record):
         record.request_id = RequestContext.get_request_id()
         record.user_id = RequestContext.get_user_id()
+        record.trace_id = RequestContext.get_trace_id()
         return True
\ No newline at end of file
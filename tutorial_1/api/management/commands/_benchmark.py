@@ -0,0 +1,30 @@
+import statistics
+import time
+from contextlib import contextmanager
+from django.db import connection
+
+@contextmanager
+def benchmark_database(keepdb=False):
+    """
+    Run a benchmark against a throwaway copy of the database.
+
+    Uses Django's test database machinery, so seeded rows never touch the
+    configured database. With ``keepdb`` the test database (and its seed data)
+    survives between runs.
+    """
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+
+def time_calls(func, samples):
+    """Call ``func`` ``samples`` times and return (median, p99) latency in milliseconds."""
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[min(len(timings) - 1, int(len(timings) * 0.99))]
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from unittest import mock
+from asgiref.sync import SyncToAsync
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand
+from api import middleware
+
+HYBRID_MIDDLEWARES = (
+    middleware.request_tracking_middleware,
+    middleware.query_budget_middleware,
+    middleware.memory_leak_middleware,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare ASGI requests/sec, and sync_to_async thread hops per request, with the api "
+        "middlewares running sync (API_MIDDLEWARE_ASYNC off, one hop into the whole chain) "
+        "versus natively async (API_MIDDLEWARE_ASYNC on). "
+        "Requests are driven in-process, so the numbers exclude server and network overhead; "
+        "run `uvicorn tutorial_1.asgi:application` with an external load generator for end-to-end figures."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/api/',
+                            help='Endpoint to request (should not need the database)')
+        parser.add_argument('--requests', type=int, default=5_000)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--with-logging', action='store_true',
+                            help='Keep request logging enabled while benchmarking')
+
+    def handle(self, *args, **options):
+        if not options['with_logging']:
+            logging.disable(logging.CRITICAL)
+
+        variants = [('sync chain', self._build_application(False)),
+                    ('async chain', self._build_application(True))]
+        results = []
+        for name, app in variants:
+            results.append(asyncio.run(
+                self._run(app, options['path'], options['requests'], options['concurrency'])
+            ))
+        # Counted after every timed run: serving a lone request on an earlier
+        # event loop slows down the loops after it
+        for (name, app), (elapsed, statuses) in zip(variants, results):
+            self.stdout.write(
+                f"{name:>12}: {options['requests'] / elapsed:9.1f} req/s "
+                f"({elapsed:.2f}s, statuses {sorted(statuses)}), "
+                f"{self._count_hops(app, options['path'])} thread hop(s) per request"
+            )
+
+    def _build_application(self, async_capable):
+        """Build an ASGI handler with the api middlewares flagged as (a)sync capable."""
+        saved = [func.async_capable for func in HYBRID_MIDDLEWARES]
+        for func in HYBRID_MIDDLEWARES:
+            func.async_capable = async_capable
+        try:
+            return ASGIHandler()
+        finally:
+            for func, flag in zip(HYBRID_MIDDLEWARES, saved):
+                func.async_capable = flag
+
+    def _count_hops(self, app, path):
+        """Number of sync_to_async calls made while serving one request."""
+        calls = 0
+        original_call = SyncToAsync.__call__
+
+        async def counting_call(adapter, *args, **kwargs):
+            nonlocal calls
+            calls += 1
+            return await original_call(adapter, *args, **kwargs)
+
+        with mock.patch.object(SyncToAsync, '__call__', counting_call):
+            asyncio.run(self._request(app, path))
+        return calls
+
+    async def _run(self, app, path, total, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        statuses = set()
+
+        async def one():
+            async with semaphore:
+                statuses.add(await self._request(app, path))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        return time.perf_counter() - start, statuses
+
+    async def _request(self, app, path):
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': b'',
+            'root_path': '',
+            'headers': [(b'host', b'localhost')],
+            'client': ('127.0.0.1', 50000),
+            'server': ('localhost', 8000),
+        }
+        status = None
+        body_sent = False
+        finished = asyncio.Event()
+
+        async def receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            # The client stays connected until the response is complete
+            await finished.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+        await app(scope, receive, send)
+        finished.set()
+        return status
@@ -0,0 +1,112 @@
+import logging
+import statistics
+import threading
+import time
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from api.models import UserProfile
+from ._benchmark import benchmark_database
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test a database-backed endpoint through the WSGI handler with per-request, "
+        "persistent and pooled database connections, reporting latency percentiles and "
+        "how many connections were opened"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/api/users/?limit=10&fields=id,username')
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--requests', type=int, default=200, help='Requests per thread')
+        parser.add_argument('--keepdb', action='store_true')
+
+    def handle(self, *args, **options):
+        logging.disable(logging.CRITICAL)
+        db_settings = connections.settings['default']
+        configured_pool = db_settings.get('OPTIONS', {}).pop('pool', None)
+        configured_max_age = db_settings.get('CONN_MAX_AGE', 0)
+        # The test database has to be created without a pool pointing at the real one
+        db_settings['CONN_MAX_AGE'] = 0
+        connections.close_all()
+
+        modes = [('per-request', 0, None), ('persistent', 60, None)]
+        if connection.vendor == 'postgresql':
+            modes.append(('pool', 0, configured_pool or {'min_size': 2, 'max_size': options['threads']}))
+        else:
+            self.stdout.write("Connection pooling needs PostgreSQL; skipping the pool run")
+
+        try:
+            with benchmark_database(options['keepdb']), override_settings(ALLOWED_HOSTS=['testserver']):
+                UserProfile.objects.bulk_create(
+                    [UserProfile(username=f"user-{i}", email=f"user-{i}@example.com") for i in range(100)],
+                    ignore_conflicts=True
+                )
+                connections.close_all()
+                for name, max_age, pool in modes:
+                    self._run_mode(name, db_settings, max_age, pool, options)
+        finally:
+            db_settings['CONN_MAX_AGE'] = configured_max_age
+            if configured_pool is not None:
+                db_settings.setdefault('OPTIONS', {})['pool'] = configured_pool
+
+    def _run_mode(self, name, db_settings, max_age, pool, options):
+        db_settings['CONN_MAX_AGE'] = max_age
+        if pool is not None:
+            db_settings.setdefault('OPTIONS', {})['pool'] = pool
+        else:
+            db_settings.get('OPTIONS', {}).pop('pool', None)
+
+        # Without a pool every connection_created is a new connection; with one it fires
+        # on every checkout, so pooled runs count the pool's own connection attempts
+        created = []
+        def count_connection(sender, connection, **kwargs):
+            created.append(1)
+        connection_created.connect(count_connection)
+
+        handler = WSGIHandler()
+        factory = RequestFactory()
+        latencies = []
+        lock = threading.Lock()
+
+        def worker():
+            own = []
+            try:
+                for _ in range(options['requests']):
+                    environ = factory.get(options['path']).environ
+                    start = time.perf_counter()
+                    response = handler(environ, lambda status, headers, exc_info=None: None)
+                    b''.join(response)
+                    # Fires request_finished, which closes connections past CONN_MAX_AGE
+                    response.close()
+                    own.append((time.perf_counter() - start) * 1000)
+            finally:
+                connections.close_all()
+                with lock:
+                    latencies.extend(own)
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        connection_created.disconnect(count_connection)
+        if pool is not None:
+            opened = connection.pool.get_stats().get('connections_num', 0)
+            connection.close_pool()
+        else:
+            opened = len(created)
+
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        self.stdout.write(
+            f"{name:>12}: {len(latencies) / elapsed:8.0f} req/s, median {statistics.median(latencies):7.2f} ms, "
+            f"p99 {p99:7.2f} ms, {opened} connections opened"
+        )
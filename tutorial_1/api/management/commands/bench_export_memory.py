@@ -0,0 +1,66 @@
+import logging
+import time
+import tracemalloc
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings
+from api.models import Item
+from ._benchmark import benchmark_database
+
+SEED_BATCH_SIZE = 10_000
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway database with growing item tables and report peak Python memory, "
+        "time to first byte and total time for the streaming item export"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000,100000,1000000',
+                            help='Comma-separated item counts to export')
+        parser.add_argument('--format', choices=('ndjson', 'json'), default='ndjson')
+        parser.add_argument('--keepdb', action='store_true')
+
+    def handle(self, *args, **options):
+        logging.disable(logging.CRITICAL)
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+
+        with benchmark_database(options['keepdb']), override_settings(ALLOWED_HOSTS=['testserver']):
+            client = Client()
+            for size in sizes:
+                self._seed(size)
+                peak, first_byte, total, exported_bytes = self._export(client, options['format'])
+                self.stdout.write(
+                    f"{size:>9} items: peak {peak / 1024 / 1024:7.2f} MB, "
+                    f"first byte {first_byte * 1000:7.1f} ms, total {total:6.2f}s, "
+                    f"{exported_bytes / 1024 / 1024:8.1f} MB exported"
+                )
+
+    def _export(self, client, stream_format):
+        tracemalloc.start()
+        start = time.perf_counter()
+        response = client.get(f'/api/items/?stream={stream_format}')
+
+        first_byte = None
+        exported_bytes = 0
+        for chunk in response.streaming_content:
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            # Discard chunks as they arrive, like a client writing to disk
+            exported_bytes += len(chunk)
+
+        total = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak, first_byte, total, exported_bytes
+
+    def _seed(self, size):
+        existing = Item.objects.count()
+        for start in range(existing, size, SEED_BATCH_SIZE):
+            Item.objects.bulk_create(
+                [Item(name=f"item-{i}", price=Decimal('9.99'), description='', stock=i % 100)
+                 for i in range(start, min(start + SEED_BATCH_SIZE, size))],
+                batch_size=SEED_BATCH_SIZE
+            )
@@ -0,0 +1,134 @@
+import logging
+import random
+from datetime import timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count, DecimalField, F, Sum
+from django.utils import timezone
+from api.models import Item, Order, OrderItem, UserProfile
+from ._benchmark import benchmark_database, time_calls
+
+SEED_BATCH_SIZE = 10_000
+STATUSES = ['pending'] * 14 + ['completed'] * 4 + ['cancelled', 'abandoned']
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway database, then report EXPLAIN plans and timings for the hot order "
+        "and user queries without and with the indexes from migration 0002"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=200_000)
+        parser.add_argument('--samples', type=int, default=20)
+        parser.add_argument('--no-plans', action='store_true', help='Only print timings')
+        parser.add_argument('--keepdb', action='store_true')
+
+    def handle(self, *args, **options):
+        logging.disable(logging.CRITICAL)
+
+        with benchmark_database(options['keepdb']):
+            self._seed(options['orders'])
+            queries = self._queries()
+
+            self._set_indexes(enabled=False)
+            before = self._measure(queries, options)
+            self._set_indexes(enabled=True)
+            after = self._measure(queries, options)
+
+            self.stdout.write("\nSummary (median / p99 ms):")
+            for name in queries:
+                (b_median, b_p99), (a_median, a_p99) = before[name], after[name]
+                self.stdout.write(
+                    f"  {name:>28}: before {b_median:8.2f} / {b_p99:8.2f}, "
+                    f"after {a_median:8.2f} / {a_p99:8.2f}"
+                )
+
+    def _queries(self):
+        """The hot queries, as they are issued by the views and background jobs."""
+        page_ids = list(Order.objects.order_by('pk').values_list('pk', flat=True)[:100])
+        return {
+            'order status counts': lambda: Order.objects.values('status').annotate(count=Count('id')).order_by(),
+            'recent abandoned orders': lambda: Order.objects.filter(status='abandoned').order_by('-created_at')[:100],
+            'orders per username': lambda: UserProfile.objects.values('username').annotate(
+                order_count=Count('order')).order_by('-order_count'),
+            'user by username': lambda: UserProfile.objects.filter(username='user-42'),
+            'order page lines': lambda: OrderItem.objects.filter(order_id__in=page_ids).values(
+                'order_id', 'item_id', 'quantity'),
+            'order page totals': lambda: Order.objects.filter(pk__in=page_ids).annotate(total_value=Sum(
+                F('orderitem__item__price') * F('orderitem__quantity'),
+                output_field=DecimalField(max_digits=20, decimal_places=2))),
+        }
+
+    def _measure(self, queries, options):
+        label = "with indexes" if self._indexes_present() else "without indexes"
+        self.stdout.write(f"\n=== {label} ===")
+        results = {}
+        for name, build in queries.items():
+            if not options['no_plans']:
+                self.stdout.write(f"\n-- {name}\n{self._explain(build())}")
+            results[name] = time_calls(lambda: list(build()), options['samples'])
+            self.stdout.write(f"-- {name}: median {results[name][0]:.2f} ms, p99 {results[name][1]:.2f} ms")
+        return results
+
+    def _explain(self, queryset):
+        if connection.vendor == 'postgresql':
+            return queryset.explain(analyze=True, buffers=True)
+        return queryset.explain()
+
+    def _meta_indexes(self):
+        for model in (Order, OrderItem, UserProfile):
+            for index in model._meta.indexes:
+                yield model, index
+
+    def _indexes_present(self):
+        with connection.cursor() as cursor:
+            existing = set()
+            for model in (Order, OrderItem, UserProfile):
+                existing.update(connection.introspection.get_constraints(cursor, model._meta.db_table))
+        return all(index.name in existing for _, index in self._meta_indexes())
+
+    def _set_indexes(self, enabled):
+        """Drop or recreate the migration 0002 indexes, then refresh planner statistics."""
+        with connection.schema_editor() as editor:
+            for model, index in self._meta_indexes():
+                if enabled:
+                    editor.add_index(model, index)
+                else:
+                    editor.remove_index(model, index)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def _seed(self, order_count):
+        if Order.objects.count() >= order_count:
+            return
+
+        rng = random.Random(42)
+        user_count = max(order_count // 10, 1)
+        UserProfile.objects.bulk_create(
+            [UserProfile(username=f"user-{i}", email=f"user-{i}@example.com") for i in range(user_count)],
+            batch_size=SEED_BATCH_SIZE
+        )
+        Item.objects.bulk_create(
+            [Item(name=f"item-{i}", price=Decimal('9.99'), description='', stock=100) for i in range(1000)],
+            batch_size=SEED_BATCH_SIZE
+        )
+        user_ids = list(UserProfile.objects.values_list('pk', flat=True))
+        item_ids = list(Item.objects.values_list('pk', flat=True))
+
+        now = timezone.now()
+        for start in range(0, order_count, SEED_BATCH_SIZE):
+            orders = Order.objects.bulk_create([
+                Order(user_id=rng.choice(user_ids), status=rng.choice(STATUSES))
+                for _ in range(start, min(start + SEED_BATCH_SIZE, order_count))
+            ])
+            # auto_now_add stamps every row the same; spread orders over a year
+            for order in orders:
+                order.created_at = now - timedelta(minutes=rng.randrange(525_600))
+            Order.objects.bulk_update(orders, ['created_at'], batch_size=2000)
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, item_id=item_id, quantity=rng.randint(1, 5))
+                for order in orders
+                for item_id in rng.sample(item_ids, 2)
+            ])
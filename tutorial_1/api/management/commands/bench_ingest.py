@@ -0,0 +1,67 @@
+import json
+import logging
+import time
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings
+from api.models import Item, UserProfile
+from ._benchmark import benchmark_database
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare ingestion throughput (rows/sec) of the single-row user/item POST endpoints "
+        "against the JSON array and NDJSON batch endpoints in a throwaway database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000, help='Rows ingested per scenario')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per batch request')
+        parser.add_argument('--single-max', type=int, default=2000,
+                            help='Cap on rows sent through the single-row endpoints')
+        parser.add_argument('--keepdb', action='store_true')
+
+    def handle(self, *args, **options):
+        logging.disable(logging.CRITICAL)
+        rows = options['rows']
+        single_rows = min(rows, options['single_max'])
+
+        with benchmark_database(options['keepdb']), override_settings(ALLOWED_HOSTS=['testserver']):
+            client = Client()
+            scenarios = [
+                ('items single-row', single_rows, lambda: self._single(client, '/api/items/', self._items(single_rows))),
+                ('items batch json', rows, lambda: self._batch(client, '/api/items/batch/', self._items(rows), options['batch_size'], ndjson=False)),
+                ('items batch ndjson', rows, lambda: self._batch(client, '/api/items/batch/', self._items(rows), options['batch_size'], ndjson=True)),
+                ('users single-row', single_rows, lambda: self._single(client, '/api/users/', self._users(single_rows, 'single'))),
+                ('users batch insert', rows, lambda: self._batch(client, '/api/users/batch/', self._users(rows, 'batch'), options['batch_size'], ndjson=False)),
+                ('users batch upsert', rows, lambda: self._batch(client, '/api/users/batch/', self._users(rows, 'batch'), options['batch_size'], ndjson=False)),
+            ]
+            for name, count, run in scenarios:
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+                self.stdout.write(f"{name:>20}: {count:>7} rows in {elapsed:7.2f}s, {count / elapsed:10.0f} rows/s")
+
+            Item.objects.all().delete()
+            UserProfile.objects.all().delete()
+
+    def _items(self, count):
+        return [{"name": f"item-{i}", "price": "9.99", "description": "", "stock": i % 100} for i in range(count)]
+
+    def _users(self, count, prefix):
+        return [{"username": f"{prefix}-{i}", "email": f"{prefix}-{i}@example.com"} for i in range(count)]
+
+    def _single(self, client, url, rows):
+        for row in rows:
+            response = client.post(url, json.dumps(row), content_type='application/json')
+            assert response.status_code == 201, response.content
+
+    def _batch(self, client, url, rows, batch_size, ndjson):
+        for start in range(0, len(rows), batch_size):
+            chunk = rows[start:start + batch_size]
+            if ndjson:
+                body = "\n".join(json.dumps(row) for row in chunk)
+                response = client.post(url, body, content_type='application/x-ndjson')
+            else:
+                response = client.post(url, json.dumps(chunk), content_type='application/json')
+            assert response.status_code == 200, response.content
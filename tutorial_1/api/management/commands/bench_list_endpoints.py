@@ -0,0 +1,86 @@
+import logging
+from decimal import Decimal
+from unittest import mock
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.http import JsonResponse
+from django.test import Client
+from django.test.utils import override_settings
+from api.models import Item, UserProfile
+from ._benchmark import benchmark_database, time_calls
+
+SEED_BATCH_SIZE = 10_000
+
+# Catalog cache alias that never stores anything, so every item page is read from the database
+UNCACHED = 'bench-uncached'
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed growing item/user tables in a throwaway database and time the paginated list "
+        "endpoints (first and deep pages) against the old unbounded full-table listing. "
+        "The catalog cache and the item list's simulated slow queries are disabled, so "
+        "item pages measure the database work"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000,100000,1000000',
+                            help='Comma-separated table sizes to measure at')
+        parser.add_argument('--samples', type=int, default=20)
+        parser.add_argument('--limit', type=int, default=100)
+        parser.add_argument('--legacy-max', type=int, default=100_000,
+                            help='Skip the unbounded listing above this size')
+        parser.add_argument('--keepdb', action='store_true')
+
+    def handle(self, *args, **options):
+        logging.disable(logging.CRITICAL)
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+
+        uncached = override_settings(
+            CACHES={**settings.CACHES, UNCACHED: {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+            CATALOG_CACHE_ALIAS=UNCACHED,
+        )
+        with benchmark_database(options['keepdb']), override_settings(ALLOWED_HOSTS=['testserver']), \
+                uncached, mock.patch('api.views.random.random', return_value=1.0):
+            client = Client()
+            for size in sizes:
+                self._seed(size)
+                deep_cursor = str(Item.objects.order_by('-pk').values_list('pk', flat=True)[options['limit']])
+
+                rows = [
+                    ('items first page', lambda: client.get(f"/api/items/?limit={options['limit']}")),
+                    ('items deep page', lambda: client.get(f"/api/items/?limit={options['limit']}&cursor={deep_cursor}")),
+                    ('items id,price', lambda: client.get(f"/api/items/?limit={options['limit']}&fields=id,price")),
+                    ('users first page', lambda: client.get(f"/api/users/?limit={options['limit']}")),
+                ]
+                if size <= options['legacy_max']:
+                    rows.append(('items unbounded (before)', self._legacy_item_list))
+
+                self.stdout.write(f"{size} rows:")
+                for name, call in rows:
+                    median, p99 = time_calls(call, options['samples'])
+                    self.stdout.write(f"  {name:>26}: median {median:9.2f} ms, p99 {p99:9.2f} ms")
+
+    def _seed(self, size):
+        """Top the item and user tables up to ``size`` rows."""
+        for model, build in ((Item, self._build_item), (UserProfile, self._build_user)):
+            existing = model.objects.count()
+            for start in range(existing, size, SEED_BATCH_SIZE):
+                model.objects.bulk_create(
+                    [build(i) for i in range(start, min(start + SEED_BATCH_SIZE, size))],
+                    batch_size=SEED_BATCH_SIZE
+                )
+
+    def _build_item(self, i):
+        return Item(name=f"item-{i}", price=Decimal('9.99'), description='', stock=i % 100)
+
+    def _build_user(self, i):
+        return UserProfile(username=f"user-{i}", email=f"user-{i}@example.com")
+
+    def _legacy_item_list(self):
+        """The pre-pagination item listing: every row materialized into one response."""
+        items = Item.objects.all()
+        return JsonResponse({"items": [
+            {"id": item.id, "name": item.name, "price": float(item.price), "stock": item.stock}
+            for item in items
+        ]})
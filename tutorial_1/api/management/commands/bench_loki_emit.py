@@ -0,0 +1,76 @@
+import json
+import logging
+import time
+from django.core.management.base import BaseCommand
+from pythonjsonlogger.jsonlogger import JsonFormatter
+from api import handlers
+from api.handlers import LokiHandler
+
+JSON_FORMAT = '%(timestamp)s %(level)s %(name)s %(message)s %(pathname)s %(lineno)d %(request_id)s %(user_id)s'
+
+
+class LegacyLokiHandler(LokiHandler):
+    """The original emit path: format, then json.loads and json.dumps the result again."""
+
+    def build_entry(self, record):
+        log_entry = self.format(record)
+        try:
+            message = json.dumps(json.loads(log_entry))
+        except json.JSONDecodeError:
+            message = log_entry
+        labels = tuple((name, self._label_value(record, name)) for name in self.labels)
+        return (labels, [str(int(time.time() * 1_000_000_000)), message])
+
+
+class Command(BaseCommand):
+    help = "Measure the per-record cost of building Loki entries for each emit path and JSON backend"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=100_000,
+                            help='Number of records to build per variant')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs per variant; the fastest is reported')
+
+    def handle(self, *args, **options):
+        records = [self._make_record(i) for i in range(options['records'])]
+
+        variants = [
+            ('legacy formatter + loads/dumps', LegacyLokiHandler, {'record_format': 'formatter', 'json_backend': 'json'}),
+            ('formatter (single pass)', LokiHandler, {'record_format': 'formatter', 'json_backend': 'json'}),
+            ('structured / json', LokiHandler, {'record_format': 'structured', 'json_backend': 'json'}),
+        ]
+        if handlers.orjson is not None:
+            variants.append(('structured / orjson', LokiHandler, {'record_format': 'structured', 'json_backend': 'orjson'}))
+        if handlers.msgspec is not None:
+            variants.append(('structured / msgspec', LokiHandler, {'record_format': 'structured', 'json_backend': 'msgspec'}))
+
+        baseline = None
+        for name, handler_class, kwargs in variants:
+            handler = handler_class(mode='sync', **kwargs)
+            handler.setFormatter(JsonFormatter(JSON_FORMAT))
+
+            best = min(self._time(handler, records) for _ in range(options['repeat']))
+            per_record_us = best / len(records) * 1_000_000
+            baseline = baseline or per_record_us
+            self.stdout.write(f"{name:>32}: {per_record_us:7.2f} us/record  ({baseline / per_record_us:4.1f}x)")
+
+    def _time(self, handler, records):
+        build_entry = handler.build_entry
+        start = time.perf_counter()
+        for record in records:
+            build_entry(record)
+        return time.perf_counter() - start
+
+    def _make_record(self, i):
+        """A request-completed record carrying the same extras as request_tracking_middleware."""
+        record = logging.LogRecord(
+            'api.middleware', logging.INFO, 'api/middleware.py', 88,
+            "Request completed: %s %s - %s in %.4fs", ('GET', '/api/items/', 200, 0.0123), None
+        )
+        record.request_path = '/api/items/'
+        record.request_method = 'GET'
+        record.status_code = 200
+        record.duration = 0.0123
+        record.request_id = f"00000000-0000-4000-8000-{i:012d}"
+        record.user_id = 'anonymous'
+        return record
@@ -0,0 +1,99 @@
+import gzip
+import json
+import logging
+import random
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from pythonjsonlogger.jsonlogger import JsonFormatter
+from api.handlers import LokiHandler
+
+# Stream labels used before the label policy: one stream per request
+LEGACY_SCHEMA = {
+    'labels': ('level', 'request_id', 'user_id', 'module', 'app'),
+    'metadata_fields': (),
+}
+
+LOW_CARDINALITY_SCHEMA = {
+    'labels': ('level', 'module', 'app'),
+    'metadata_fields': ('request_id', 'user_id'),
+    'metadata_mode': 'structured',
+}
+
+
+class Command(BaseCommand):
+    help = "Compare Loki stream counts and push payload sizes for the legacy and low-cardinality label schemas"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100_000,
+                            help='Number of synthetic requests to log')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Entries per Loki push')
+        parser.add_argument('--users', type=int, default=5_000,
+                            help='Number of distinct user IDs in the workload')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        records = self._build_workload(options['requests'], options['users'], options['seed'])
+        self.stdout.write(f"Synthetic workload: {options['requests']} requests, {len(records)} log lines")
+
+        for name, schema in (('legacy', LEGACY_SCHEMA), ('low-cardinality', LOW_CARDINALITY_SCHEMA)):
+            stats = self._measure(records, schema, options['batch_size'])
+            self.stdout.write(
+                f"{name:>16}: {stats['streams']:>8} distinct streams, "
+                f"{stats['streams_per_push']:>7.1f} streams/push, "
+                f"{stats['raw_bytes'] / 1024 / 1024:>8.2f} MB raw, "
+                f"{stats['gzip_bytes'] / 1024 / 1024:>7.2f} MB gzip, "
+                f"{stats['seconds']:.2f}s"
+            )
+
+    def _build_workload(self, request_count, user_count, seed):
+        """Create the log records a request produces as it passes through the app."""
+        rng = random.Random(seed)
+        records = []
+        for _ in range(request_count):
+            request_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            user_id = rng.randint(1, user_count) if rng.random() < 0.7 else 'anonymous'
+            lines = [
+                ('api.middleware', 'middleware', logging.INFO, "Request started: GET /api/items/"),
+                ('api.views', 'views', logging.INFO, "Status check performed"),
+                ('api.middleware', 'middleware', logging.INFO, "Request completed: GET /api/items/ - 200"),
+            ]
+            if rng.random() < 0.05:
+                lines.append(('api.views', 'views', logging.WARNING, "Slow order query detected"))
+
+            for logger_name, module, level, message in lines:
+                record = logging.LogRecord(logger_name, level, f"{module}.py", 1, message, None, None)
+                record.module = module
+                record.request_id = request_id
+                record.user_id = user_id
+                records.append(record)
+        return records
+
+    def _measure(self, records, schema, batch_size):
+        handler = LokiHandler(mode='sync', **schema)
+        handler.setFormatter(JsonFormatter(
+            '%(timestamp)s %(level)s %(name)s %(message)s %(pathname)s %(lineno)d %(request_id)s %(user_id)s'
+        ))
+
+        start = time.perf_counter()
+        streams = set()
+        stream_entries = raw_bytes = gzip_bytes = pushes = 0
+        for offset in range(0, len(records), batch_size):
+            batch = [handler.build_entry(record) for record in records[offset:offset + batch_size]]
+            payload = handler.build_payload(batch)
+            body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+            streams.update(labels for labels, _ in batch)
+            stream_entries += len(payload['streams'])
+            raw_bytes += len(body)
+            gzip_bytes += len(gzip.compress(body))
+            pushes += 1
+
+        return {
+            'streams': len(streams),
+            'streams_per_push': stream_entries / max(pushes, 1),
+            'raw_bytes': raw_bytes,
+            'gzip_bytes': gzip_bytes,
+            'seconds': time.perf_counter() - start,
+        }
@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+from django.core.management.base import BaseCommand
+from api import metrics
+
+ENDPOINTS = [f"/api/route-{i}/" for i in range(20)]
+
+
+def legacy_request(method, endpoint, status_code):
+    """The pre-buffering hot path: labels() lookups and locked updates inline."""
+    metrics.http_request_in_progress.labels(method=method, endpoint=endpoint).inc()
+    start_time = time.time()
+    for table in ('item', 'order'):
+        metrics.db_query_duration_seconds.labels(query_type='SELECT', table=table).observe(0.001)
+    duration = time.time() - start_time
+    metrics.http_requests_total.labels(method=method, endpoint=endpoint, status_code=status_code).inc()
+    metrics.http_request_duration_seconds.labels(method=method, endpoint=endpoint).observe(duration)
+    metrics.http_request_in_progress.labels(method=method, endpoint=endpoint).dec()
+
+
+def buffered_request(method, endpoint, status_code):
+    start_time = metrics.track_request_start(method, endpoint)
+    for table in ('item', 'order'):
+        metrics.track_db_query('SELECT', table, 0.001)
+    metrics.track_request_end(method, endpoint, status_code, start_time)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure per-request metric recording overhead (request start/end plus two DB query "
+        "observations) from many concurrent threads, before and after per-thread buffering"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=64)
+        parser.add_argument('--requests', type=int, default=5000, help='Requests per thread')
+
+    def handle(self, *args, **options):
+        # Measure the metrics alone, not the DEBUG line track_db_query may log
+        logging.disable(logging.CRITICAL)
+        for name, record in (('labels() inline (before)', legacy_request), ('buffered (after)', buffered_request)):
+            elapsed = self._run(record, options['threads'], options['requests'])
+            total = options['threads'] * options['requests']
+            self.stdout.write(
+                f"{name:>26}: {elapsed / total * 1e6:6.2f} us/request wall, "
+                f"{total / elapsed:10.0f} requests/s across {options['threads']} threads"
+            )
+
+        start = time.perf_counter()
+        metrics.recorder.flush()
+        self.stdout.write(f"{'final flush':>26}: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def _run(self, record, thread_count, requests):
+        barrier = threading.Barrier(thread_count + 1)
+
+        def worker(index):
+            endpoint = ENDPOINTS[index % len(ENDPOINTS)]
+            barrier.wait()
+            for i in range(requests):
+                record('GET', endpoint, '200' if i % 50 else '500')
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
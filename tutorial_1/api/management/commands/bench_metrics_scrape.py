@@ -0,0 +1,82 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector, mark_process_dead
+from ._benchmark import time_calls
+
+# Runs in a fresh interpreter per simulated worker so prometheus_client picks
+# up PROMETHEUS_MULTIPROC_DIR at import, exactly as a gunicorn worker would
+WORKER_SCRIPT = """
+import sys
+import django
+django.setup()
+from api import metrics
+
+endpoints = int(sys.argv[1])
+for i in range(endpoints):
+    endpoint = f"/api/route-{i}/"
+    for method in ("GET", "POST"):
+        start = metrics.track_request_start(method, endpoint)
+        for status_code in (200, 201, 400, 404, 500):
+            metrics.http_requests_total.labels(method=method, endpoint=endpoint, status_code=status_code).inc()
+        metrics.track_request_end(method, endpoint, 200, start)
+    metrics.track_db_query("SELECT", f"table_{i % 20}", 0.01)
+metrics.worker_publisher.publish()
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate N multiprocess workers writing thousands of series and time an aggregated "
+        "/metrics scrape over their mmap files"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default='1,8,32', help='Comma-separated worker counts')
+        parser.add_argument('--endpoints', type=int, default=100, help='Distinct endpoint labels per worker')
+        parser.add_argument('--restarts', type=int, default=0,
+                            help='Dead worker generations left behind per slot (worker churn)')
+        parser.add_argument('--samples', type=int, default=20)
+
+    def handle(self, *args, **options):
+        for workers in sorted(int(count) for count in options['workers'].split(',')):
+            path = tempfile.mkdtemp(prefix='prometheus-multiproc-')
+            try:
+                self._run_workers(path, workers, options)
+
+                registry = CollectorRegistry()
+                MultiProcessCollector(registry, path=path)
+                output = generate_latest(registry)
+                series = sum(1 for line in output.splitlines() if line and not line.startswith(b'#'))
+                files = os.listdir(path)
+                size = sum(os.path.getsize(os.path.join(path, name)) for name in files)
+
+                median, p99 = time_calls(lambda: generate_latest(registry), options['samples'])
+                self.stdout.write(
+                    f"{workers:>3} workers: {len(files):>4} files ({size / 1024 / 1024:6.1f} MB), "
+                    f"{series:>6} series, {len(output) / 1024:7.0f} KB; "
+                    f"scrape median {median:8.2f} ms, p99 {p99:8.2f} ms"
+                )
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _run_workers(self, path, workers, options):
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=path,
+                   PYTHONPATH=os.pathsep.join(filter(None, [str(settings.BASE_DIR), os.environ.get('PYTHONPATH')])))
+        for generation in range(options['restarts'] + 1):
+            processes = [
+                subprocess.Popen([sys.executable, '-c', WORKER_SCRIPT, str(options['endpoints'])], env=env)
+                for _ in range(workers)
+            ]
+            for process in processes:
+                if process.wait() != 0:
+                    raise RuntimeError(f"Simulated worker exited with {process.returncode}")
+            if generation < options['restarts']:
+                # As gunicorn's child_exit hook does for replaced workers
+                for process in processes:
+                    mark_process_dead(process.pid, path)
@@ -0,0 +1,65 @@
+import threading
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from api import request_ids
+
+TRACEPARENT = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the per-request cost of producing a request ID: uuid4 (before), the "
+        "time-ordered generator, and accepting inbound X-Request-ID/traceparent headers"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ids', type=int, default=200_000, help='IDs per variant')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per variant; the fastest is reported')
+        parser.add_argument('--threads', type=int, default=8,
+                            help='Threads for the contended run of the generator')
+
+    def handle(self, *args, **options):
+        variants = [
+            ('str(uuid.uuid4()) (before)', lambda: str(uuid.uuid4())),
+            ('new_request_id()', request_ids.new_request_id),
+            ('resolve, no headers', lambda: request_ids.resolve({})),
+            ('resolve, X-Request-ID', lambda: request_ids.resolve({'HTTP_X_REQUEST_ID': 'edge-5f2c9a7e41b3'})),
+            ('resolve, traceparent', lambda: request_ids.resolve({'HTTP_TRACEPARENT': TRACEPARENT})),
+        ]
+
+        baseline = None
+        for name, generate in variants:
+            best = min(self._time(generate, options['ids']) for _ in range(options['repeat']))
+            per_id_ns = best / options['ids'] * 1e9
+            baseline = baseline or per_id_ns
+            self.stdout.write(f"{name:>28}: {per_id_ns:7.0f} ns/id  ({baseline / per_id_ns:4.1f}x)")
+
+        for name, generate in variants[:2]:
+            elapsed = self._time_threads(generate, options['threads'], options['ids'] // options['threads'])
+            self.stdout.write(
+                f"{name:>28}: {options['ids'] / elapsed:10.0f} ids/s across {options['threads']} threads"
+            )
+
+    def _time(self, generate, count):
+        start = time.perf_counter()
+        for _ in range(count):
+            generate()
+        return time.perf_counter() - start
+
+    def _time_threads(self, generate, thread_count, count):
+        barrier = threading.Barrier(thread_count + 1)
+
+        def worker():
+            barrier.wait()
+            for _ in range(count):
+                generate()
+
+        threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
@@ -1,10 +1,146 @@
 # api/metrics.py
-from prometheus_client import Counter, Histogram, Gauge, Summary
+from prometheus_client import CollectorRegistry, Counter, Histogram, Gauge, Summary, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+import atexit
+import os
 import time
 import logging
+import threading
+import bisect
+import collections
+import psutil
+from .background import BackgroundThread
 
 logger = logging.getLogger(__name__)
 
+# Under a pre-fork server each worker writes its samples to mmap-backed files in
+# this directory and scrapes aggregate all of them. It must be set in the
+# environment before prometheus_client is imported (see gunicorn.conf.py).
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+class BufferedRecorder:
+    """
+    Per-thread buffers for metric updates on the request hot path.
+
+    Recording a value only appends to a deque owned by the calling thread: no
+    ``labels()`` lookup and no prometheus_client lock. ``flush`` drains every
+    thread's buffer, sums increments per label set and applies them through
+    cached label children. It runs before every scrape and every
+    ``flush_interval`` seconds from a background thread, so values lag by at
+    most that interval between scrapes.
+    """
+    INC = 0
+    OBSERVE = 1
+
+    def __init__(self, flush_interval=1.0):
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._buffers = []
+        self._buffers_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._children = {}
+        self._flusher = BackgroundThread(self._run, 'metrics-flusher')
+
+    def inc(self, metric, labels, amount=1):
+        """Buffer ``metric.labels(*labels).inc(amount)``; gauges accept negative amounts."""
+        try:
+            self._local.events.append((self.INC, metric, labels, amount))
+        except AttributeError:
+            self._register_thread().append((self.INC, metric, labels, amount))
+
+    def observe(self, metric, labels, value):
+        """Buffer ``metric.labels(*labels).observe(value)``."""
+        try:
+            self._local.events.append((self.OBSERVE, metric, labels, value))
+        except AttributeError:
+            self._register_thread().append((self.OBSERVE, metric, labels, value))
+
+    def _register_thread(self):
+        events = self._local.events = collections.deque()
+        with self._buffers_lock:
+            self._buffers.append((threading.current_thread(), events))
+        self._flusher.ensure_started()
+        return events
+
+    def child(self, metric, labels):
+        """Bound label child for ``labels``, created once and reused."""
+        key = (metric, labels)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = metric.labels(*labels) if labels else metric
+        return child
+
+    def flush(self):
+        """Apply every buffered update to the metrics."""
+        with self._flush_lock:
+            with self._buffers_lock:
+                buffers = list(self._buffers)
+
+            increments = collections.defaultdict(float)
+            observations = collections.defaultdict(list)
+            for thread, events in buffers:
+                # popleft() is atomic, so owners can keep appending while we drain
+                while events:
+                    kind, metric, labels, value = events.popleft()
+                    if kind == self.INC:
+                        increments[(metric, labels)] += value
+                    else:
+                        observations[(metric, labels)].append(value)
+                if not thread.is_alive() and not events:
+                    with self._buffers_lock:
+                        self._buffers.remove((thread, events))
+
+            for (metric, labels), amount in increments.items():
+                if amount:
+                    self.child(metric, labels).inc(amount)
+            for (metric, labels), values in observations.items():
+                _observe_many(self.child(metric, labels), values)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Flushing buffered metrics failed: {str(e)}")
+
+def _observe_many(histogram, values):
+    """
+    Apply many observations to a histogram child with one update per bucket.
+
+    Equivalent to calling ``observe`` for each value, which stores each
+    observation in the first bucket whose upper bound is >= the value. This
+    uses prometheus_client's Histogram internals (pinned in requirements.txt)
+    and falls back to ``observe`` for anything else.
+    """
+    bounds = getattr(histogram, '_upper_bounds', None)
+    if bounds is None:
+        for value in values:
+            histogram.observe(value)
+        return
+    histogram._sum.inc(sum(values))
+    for index, count in collections.Counter(bisect.bisect_left(bounds, value) for value in values).items():
+        histogram._buckets[index].inc(count)
+
+class _FlushBeforeScrape:
+    """Collector that flushes the recorder; registered first so scrapes see current values."""
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        self.recorder.flush()
+        return []
+
+recorder = BufferedRecorder()
+REGISTRY.register(_FlushBeforeScrape(recorder))
+# The flusher is a daemon thread, so without this the last interval's updates are
+# lost at exit (in multiprocess mode, never written to this worker's files)
+atexit.register(recorder.flush)
+
 # Define custom metrics
 http_requests_total = Counter(
     'http_requests_total', 
@@ -22,7 +158,8 @@ http_request_duration_seconds = Histogram(
 http_request_in_progress = Gauge(
     'http_requests_in_progress',
     'Number of HTTP requests in progress',
-    ['method', 'endpoint']
+    ['method', 'endpoint'],
+    multiprocess_mode='livesum'
 )
 
 db_query_duration_seconds = Histogram(
@@ -31,19 +168,36 @@ db_query_duration_seconds = Histogram(
     ['query_type', 'table']
 )
 
-memory_usage_bytes = Gauge(
-    'app_memory_usage_bytes',
-    'Memory usage in bytes'
+db_queries_per_request = Histogram(
+    'db_queries_per_request',
+    'Database queries executed while handling a request',
+    ['endpoint'],
+    buckets=[0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 500]
 )
 
-active_users_total = Gauge(
-    'active_users_total',
-    'Number of active users'
+db_n_plus_one_requests_total = Counter(
+    'db_n_plus_one_requests_total',
+    'Requests that ran the same SELECT at least DB_N_PLUS_ONE_THRESHOLD times',
+    ['endpoint']
+)
+
+query_budget_exceeded_total = Counter(
+    'query_budget_exceeded_total',
+    'Requests over their query budget, by the limit exceeded (queries or db_time)',
+    ['endpoint', 'limit']
 )
 
-cart_abandonment_rate = Gauge(
-    'cart_abandonment_rate',
-    'Rate of cart abandonment'
+slow_query_explains_total = Counter(
+    'slow_query_explains_total',
+    'Sampled EXPLAIN captures of slow statements by outcome (queued, dropped, captured, failed)',
+    ['outcome']
+)
+
+active_users_total = Gauge(
+    'active_users_total',
+    'Number of active users',
+    # A table count: the latest refresh by any worker is the answer
+    multiprocess_mode='mostrecent'
 )
 
 order_value_total = Summary(
@@ -52,36 +206,418 @@ order_value_total = Summary(
     ['status']
 )
 
+# orders_by_status and cart_abandonment_rate are exported by api.order_stats
+order_status_reconciliations_total = Counter(
+    'order_status_reconciliations_total',
+    'Recounts of the incrementally maintained order status counts'
+)
+
+order_status_drift_total = Counter(
+    'order_status_drift_total',
+    'Total absolute difference found between maintained and recounted order status counts'
+)
+
 # Simulated memory leak tracker
 memory_leak_objects = Gauge(
     'memory_leak_objects',
-    'Number of objects held in memory for the simulated leak'
+    'Number of objects held in memory for the simulated leak',
+    multiprocess_mode='livesum'
+)
+
+# Log shipping metrics for the Loki handler
+loki_log_lines_queued_total = Counter(
+    'loki_log_lines_queued_total',
+    'Log lines queued for shipping to Loki'
+)
+
+loki_log_lines_sent_total = Counter(
+    'loki_log_lines_sent_total',
+    'Log lines successfully pushed to Loki'
+)
+
+loki_log_lines_dropped_total = Counter(
+    'loki_log_lines_dropped_total',
+    'Log lines dropped before reaching Loki',
+    ['reason']
+)
+
+loki_push_attempts_total = Counter(
+    'loki_push_attempts_total',
+    'Loki push attempts by outcome',
+    ['outcome']
+)
+
+loki_push_backoff_seconds_total = Counter(
+    'loki_push_backoff_seconds_total',
+    'Time spent backing off between Loki push retries'
+)
+
+loki_circuit_breaker_state = Gauge(
+    'loki_circuit_breaker_state',
+    'Loki circuit breaker state (0 = closed, 1 = open, 2 = half-open)',
+    multiprocess_mode='livemax'
+)
+
+loki_circuit_breaker_transitions_total = Counter(
+    'loki_circuit_breaker_transitions_total',
+    'Loki circuit breaker state transitions',
+    ['state']
+)
+
+loki_spill_batches_total = Counter(
+    'loki_spill_batches_total',
+    'Undeliverable log batches written to or replayed from the spill file',
+    ['action']
+)
+
+loki_spill_bytes = Gauge(
+    'loki_spill_bytes',
+    'Size of the Loki spill file in bytes',
+    multiprocess_mode='livemax'
+)
+
+# Read-through cache metrics
+cache_requests_total = Counter(
+    'cache_requests_total',
+    'Read-through cache lookups by outcome (hit, miss, coalesced)',
+    ['cache', 'result']
+)
+
+cache_lookup_duration_seconds = Histogram(
+    'cache_lookup_duration_seconds',
+    'Time to serve a read-through cache lookup, including any recompute',
+    ['cache', 'result'],
+    buckets=[0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+)
+
+cache_invalidations_total = Counter(
+    'cache_invalidations_total',
+    'Read-through cache invalidations by source',
+    ['cache', 'source']
 )
 
+class ProcessSnapshotCollector:
+    """
+    Collector for process resource usage, sampled lazily at scrape time.
+
+    A single ``psutil.Process`` handle is reused (and recreated after a fork),
+    and a sample is reused for ``min_interval`` seconds, so neither requests nor
+    frequent scrapes pay for repeated /proc reads. Views that report process
+    stats read the same snapshot through ``get_process_snapshot``.
+    """
+    def __init__(self, min_interval=1.0):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._process = None
+        self._pid = None
+        self._snapshot = None
+
+    def snapshot(self, max_age=None):
+        """Return the latest sample, refreshing it if older than ``max_age`` seconds."""
+        max_age = self.min_interval if max_age is None else max_age
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot['pid'] == os.getpid() and time.monotonic() - snapshot['sampled_at'] <= max_age:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot['pid'] != os.getpid() or time.monotonic() - snapshot['sampled_at'] > max_age:
+                snapshot = self._snapshot = self._sample()
+            return snapshot
+
+    def _sample(self):
+        if self._process is None or self._pid != os.getpid():
+            self._process = psutil.Process(os.getpid())
+            self._pid = os.getpid()
+            # The first cpu_percent() call only primes the counter
+            self._process.cpu_percent(interval=None)
+
+        process = self._process
+        with process.oneshot():
+            try:
+                open_fds = process.num_fds()
+            except (AttributeError, psutil.Error):
+                # num_fds() is only available on POSIX
+                open_fds = None
+            return {
+                'pid': self._pid,
+                'sampled_at': time.monotonic(),
+                'rss_bytes': process.memory_info().rss,
+                'cpu_percent': process.cpu_percent(interval=None),
+                'thread_count': process.num_threads(),
+                'open_fds': open_fds,
+            }
+
+    def describe(self):
+        # Registering shouldn't trigger a sample
+        return []
+
+    def collect(self):
+        snapshot = self.snapshot()
+        yield GaugeMetricFamily('app_memory_usage_bytes', 'Memory usage in bytes',
+                                value=snapshot['rss_bytes'])
+        yield GaugeMetricFamily('app_cpu_percent', 'Process CPU usage since the previous sample, in percent',
+                                value=snapshot['cpu_percent'])
+        yield GaugeMetricFamily('app_threads', 'Number of threads in the process',
+                                value=snapshot['thread_count'])
+        if snapshot['open_fds'] is not None:
+            yield GaugeMetricFamily('app_open_fds', 'Number of open file descriptors',
+                                    value=snapshot['open_fds'])
+
+# Collectors that read state shared by all workers (e.g. the cache). In
+# multiprocess mode they are added to the aggregated scrape as they are.
+_shared_collectors = []
+
+def register_collector(collector, shared=False):
+    """
+    Register a scrape-time collector.
+
+    Per-process collectors are only registered in single-process mode; under
+    multiprocess mode their values reach the scrape through the worker
+    publisher instead. ``shared`` collectors are exported in both modes.
+    """
+    if shared:
+        _shared_collectors.append(collector)
+    if shared or not MULTIPROCESS:
+        REGISTRY.register(collector)
+
+def scrape_registry():
+    """The registry a /metrics scrape should render: all workers' samples in multiprocess mode."""
+    if not MULTIPROCESS:
+        return REGISTRY
+    # This worker's buffered values go to its files before they are read
+    recorder.flush()
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    for collector in _shared_collectors:
+        registry.register(collector)
+    return registry
+
+process_snapshot = ProcessSnapshotCollector()
+register_collector(process_snapshot)
+
+# Pool gauges: (metric, help)
+POOL_GAUGES = (
+    ('db_pool_connections', 'Pooled database connections by state'),
+    ('db_pool_max_connections', 'Maximum size of the connection pool'),
+    ('db_pool_requests_waiting', 'Requests currently waiting for a connection'),
+)
+# Cumulative pool counters: (metric, pool stat, scale, help)
+POOL_COUNTERS = (
+    ('db_pool_requests_queued', 'requests_queued', 1, 'Checkouts that had to wait for a free connection'),
+    ('db_pool_checkouts', 'requests_num', 1, 'Connections checked out of the pool'),
+    ('db_pool_checkout_wait_seconds', 'requests_wait_ms', 0.001,
+     'Time spent waiting to check connections out of the pool'),
+    ('db_pool_connections_opened', 'connections_num', 1, 'Connections opened by the pool'),
+    ('db_pool_connect_seconds', 'connections_ms', 0.001, 'Time spent opening pool connections'),
+)
+# Pool error kinds: (kind label, pool stat)
+POOL_ERRORS = (
+    ('checkout', 'requests_errors'),
+    ('connect', 'connections_errors'),
+    ('lost', 'connections_lost'),
+    ('bad_return', 'returns_bad'),
+)
+
+def _pool_gauge_labels(metric):
+    return ['state'] if metric == 'db_pool_connections' else []
+
+def _pool_gauge_values(stats):
+    """Yield ``(metric, extra_labels, value)`` for the point-in-time pool gauges."""
+    available = stats.get('pool_available', 0)
+    yield 'db_pool_connections', ['in_use'], stats.get('pool_size', 0) - available
+    yield 'db_pool_connections', ['idle'], available
+    yield 'db_pool_max_connections', [], stats.get('pool_max', 0)
+    yield 'db_pool_requests_waiting', [], stats.get('requests_waiting', 0)
+
+class DatabasePoolCollector:
+    """
+    Exports psycopg connection pool statistics at scrape time.
+
+    Reads the pools Django's PostgreSQL backend has already created (one per
+    database alias and process) without opening new ones. Nothing is exported
+    when pooling is disabled. In multiprocess mode ``publish`` copies the same
+    statistics into this worker's metric files instead.
+    """
+    def _open_pools(self):
+        from django.db import connections
+
+        for alias in connections:
+            pool = getattr(connections[alias], '_connection_pools', {}).get(alias)
+            # Django creates pools closed and opens them on first use
+            if pool is not None and not pool.closed:
+                yield alias, pool
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        pools = {alias: pool.get_stats() for alias, pool in self._open_pools()}
+        if not pools:
+            return
+
+        gauges = {metric: GaugeMetricFamily(metric, help_text, labels=['database', *_pool_gauge_labels(metric)])
+                  for metric, help_text in POOL_GAUGES}
+        counters = {metric: CounterMetricFamily(metric, help_text, labels=['database'])
+                    for metric, _, _, help_text in POOL_COUNTERS}
+        errors = CounterMetricFamily('db_pool_errors', 'Connection pool errors by kind',
+                                     labels=['database', 'kind'])
+
+        for alias, stats in pools.items():
+            for metric, extra_labels, value in _pool_gauge_values(stats):
+                gauges[metric].add_metric([alias, *extra_labels], value)
+            for metric, stat, scale, _ in POOL_COUNTERS:
+                counters[metric].add_metric([alias], stats.get(stat, 0) * scale)
+            for kind, stat in POOL_ERRORS:
+                errors.add_metric([alias, kind], stats.get(stat, 0))
+
+        yield from gauges.values()
+        yield from counters.values()
+        yield errors
+
+    def publish(self):
+        # pop_stats() resets the pool's counters, so each call adds only what's new
+        for alias, pool in self._open_pools():
+            stats = pool.pop_stats()
+            for metric, extra_labels, value in _pool_gauge_values(stats):
+                _worker_metrics[metric].labels(alias, *extra_labels).set(value)
+            for metric, stat, scale, _ in POOL_COUNTERS:
+                _worker_metrics[metric].labels(alias).inc(stats.get(stat, 0) * scale)
+            for kind, stat in POOL_ERRORS:
+                _worker_metrics['db_pool_errors'].labels(alias, kind).inc(stats.get(stat, 0))
+
+database_pool = DatabasePoolCollector()
+register_collector(database_pool)
+
+# Metrics that the worker publisher writes in multiprocess mode, standing in
+# for the per-process collectors above
+_worker_metrics = {}
+if MULTIPROCESS:
+    _worker_metrics.update({
+        'app_memory_usage_bytes': Gauge('app_memory_usage_bytes', 'Memory usage in bytes',
+                                        multiprocess_mode='liveall'),
+        'app_cpu_percent': Gauge('app_cpu_percent', 'Process CPU usage since the previous sample, in percent',
+                                 multiprocess_mode='liveall'),
+        'app_threads': Gauge('app_threads', 'Number of threads in the process',
+                             multiprocess_mode='liveall'),
+        'app_open_fds': Gauge('app_open_fds', 'Number of open file descriptors',
+                              multiprocess_mode='liveall'),
+        'db_pool_errors': Counter('db_pool_errors', 'Connection pool errors by kind', ['database', 'kind']),
+    })
+    for metric, help_text in POOL_GAUGES:
+        _worker_metrics[metric] = Gauge(metric, help_text, ['database', *_pool_gauge_labels(metric)],
+                                        multiprocess_mode='livesum')
+    for metric, _, _, help_text in POOL_COUNTERS:
+        _worker_metrics[metric] = Counter(metric, help_text, ['database'])
+
+class WorkerMetricsPublisher:
+    """
+    Publishes per-worker values into multiprocess metrics from a background thread.
+
+    A multiprocess scrape is served by whichever worker gets it, so values only
+    known inside each worker (process stats, connection pool state) are written
+    to that worker's metric files every ``interval`` seconds instead of being
+    sampled at scrape time. Gauges use live modes, so a dead worker's values
+    disappear once it is marked dead.
+    """
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self._thread = BackgroundThread(self._run, 'metrics-publisher')
+
+    def ensure_started(self):
+        self._thread.ensure_started()
+
+    def _run(self):
+        while True:
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error(f"Publishing worker metrics failed: {str(e)}")
+            time.sleep(self.interval)
+
+    def publish(self):
+        snapshot = process_snapshot.snapshot(max_age=0)
+        _worker_metrics['app_memory_usage_bytes'].set(snapshot['rss_bytes'])
+        _worker_metrics['app_cpu_percent'].set(snapshot['cpu_percent'])
+        _worker_metrics['app_threads'].set(snapshot['thread_count'])
+        if snapshot['open_fds'] is not None:
+            _worker_metrics['app_open_fds'].set(snapshot['open_fds'])
+        database_pool.publish()
+
+worker_publisher = WorkerMetricsPublisher()
+
 # Global cache for memory leak simulation
 MEMORY_LEAK_CACHE = []
 
+# Endpoint label bucket for requests that matched no URL pattern
+UNMATCHED_ENDPOINT = 'unmatched'
+# Endpoint label bucket for routes beyond the series cap
+OVERFLOW_ENDPOINT = 'other'
+
+_endpoint_labels = set()
+_endpoint_labels_lock = threading.Lock()
+
+def cap_endpoint_label(endpoint, limit):
+    """
+    Fold endpoint labels beyond the first ``limit`` distinct values into one bucket.
+
+    Route templates are already bounded by the URLconf; the cap is a safety net
+    so no code path can grow the HTTP metrics' series count without bound.
+    """
+    if endpoint in _endpoint_labels:
+        return endpoint
+
+    with _endpoint_labels_lock:
+        if endpoint in _endpoint_labels:
+            return endpoint
+        if len(_endpoint_labels) >= limit:
+            return OVERFLOW_ENDPOINT
+        _endpoint_labels.add(endpoint)
+        return endpoint
+
 def track_request_start(method, endpoint):
     """Track the start of an HTTP request."""
-    http_request_in_progress.labels(method=method, endpoint=endpoint).inc()
+    if MULTIPROCESS:
+        worker_publisher.ensure_started()
+    recorder.inc(http_request_in_progress, (method, endpoint))
     return time.time()
 
 def track_request_end(method, endpoint, status_code, start_time):
     """Track the end of an HTTP request with its duration and status code."""
     duration = time.time() - start_time
-    http_requests_total.labels(method=method, endpoint=endpoint, status_code=status_code).inc()
-    http_request_duration_seconds.labels(method=method, endpoint=endpoint).observe(duration)
-    http_request_in_progress.labels(method=method, endpoint=endpoint).dec()
+    recorder.inc(http_requests_total, (method, endpoint, str(status_code)))
+    recorder.observe(http_request_duration_seconds, (method, endpoint), duration)
+    recorder.inc(http_request_in_progress, (method, endpoint), -1)
     return duration
 
 def track_db_query(query_type, table, duration):
-    """Track database query duration."""
-    db_query_duration_seconds.labels(query_type=query_type, table=table).observe(duration)
-    logger.debug(f"DB query to {table} ({query_type}) took {duration:.4f}s")
+    """
+    Track database query duration.
 
-def update_memory_usage(bytes_used):
-    """Update the memory usage metric."""
-    memory_usage_bytes.set(bytes_used)
+    Runs for every statement, so it doesn't log; slow statements and N+1s are
+    logged per request by the middleware.
+    """
+    recorder.observe(db_query_duration_seconds, (query_type, table), duration)
+
+def get_process_snapshot(max_age=None):
+    """Return cached process stats (RSS, CPU, threads, open fds)."""
+    return process_snapshot.snapshot(max_age)
+
+_active_users_refreshed_at = None
+
+def update_active_users(count_users, max_age=60):
+    """
+    Refresh the active users gauge from ``count_users()`` at most every ``max_age`` seconds.
+
+    Counting the whole table on every listing would make each request scale with
+    the table, so the count is amortised across requests instead.
+    """
+    global _active_users_refreshed_at
+    now = time.monotonic()
+    if _active_users_refreshed_at is not None and now - _active_users_refreshed_at < max_age:
+        return
+    _active_users_refreshed_at = now
+    active_users_total.set(count_users())
 
 def simulate_memory_leak(request_path, size=1000):
     """
@@ -1,116 +1,330 @@
 # api/middleware.py
+import asyncio
+import functools
 import logging
-import uuid
+import contextvars
 import random
 import time
 import traceback
-import os
-import psutil
+from asgiref.sync import iscoroutinefunction
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.urls import Resolver404, resolve
+from django.utils.decorators import sync_and_async_middleware
 from django.http import HttpResponse
-from . import metrics
+from . import db_instrumentation, metrics, query_budget, request_ids
 
 logger = logging.getLogger(__name__)
 
 class RequestContext:
-    _request_local = {}
-    
+    """
+    Request-scoped values used to correlate logs, stored in context variables.
+
+    Each thread and each asyncio task sees its own values, so concurrent requests
+    never stamp logs with each other's IDs. ``sync_to_async``/``async_to_sync``
+    carry the context across the boundary; for plain threads or executors, wrap
+    the callable with ``RequestContext.wrap`` so it runs in a copy of the
+    current context.
+    """
+    _request_id = contextvars.ContextVar('request_id', default='no-request-id')
+    _user_id = contextvars.ContextVar('user_id', default='anonymous')
+    _trace_id = contextvars.ContextVar('trace_id', default='no-trace-id')
+
     @classmethod
     def get_request_id(cls):
-        return cls._request_local.get('request_id', 'no-request-id')
-    
+        return cls._request_id.get()
+
     @classmethod
     def set_request_id(cls, request_id):
-        cls._request_local['request_id'] = request_id
-    
+        return cls._request_id.set(request_id)
+
     @classmethod
     def get_user_id(cls):
-        return cls._request_local.get('user_id', 'anonymous')
-    
+        return cls._user_id.get()
+
     @classmethod
     def set_user_id(cls, user_id):
-        cls._request_local['user_id'] = user_id
+        return cls._user_id.set(user_id)
+
+    @classmethod
+    def get_trace_id(cls):
+        return cls._trace_id.get()
+
+    @classmethod
+    def set_trace_id(cls, trace_id):
+        return cls._trace_id.set(trace_id)
+
+    @classmethod
+    def reset(cls, request_id_token, user_id_token, trace_id_token):
+        """Restore the values that were current before a request set its own."""
+        cls._trace_id.reset(trace_id_token)
+        cls._user_id.reset(user_id_token)
+        cls._request_id.reset(request_id_token)
+
+    @staticmethod
+    def wrap(func):
+        """Bind ``func`` to a copy of the current context, for use in another thread."""
+        context = contextvars.copy_context()
+
+        def wrapper(*args, **kwargs):
+            return context.run(func, *args, **kwargs)
+        return wrapper
+
+def api_middleware(func):
+    """
+    Mark a hybrid (sync and async) api middleware.
 
+    It only advertises async support with ``API_MIDDLEWARE_ASYNC``. While the
+    views are sync, Django's own MiddlewareMixin middlewares hop to a thread
+    for every hook once the chain runs async under ASGI, which costs more than
+    the single hop into a sync chain; enable it once the views are async.
+    """
+    func.sync_capable = True
+    func.async_capable = getattr(settings, 'API_MIDDLEWARE_ASYNC', False)
+    return func
+
+@functools.lru_cache(maxsize=4096)
+def _route_for_path(path_info, urlconf):
+    """Resolve a path to its URL pattern template, e.g. ``/api/orders/<int:pk>/``."""
+    try:
+        match = resolve(path_info, urlconf)
+    except Resolver404:
+        return metrics.UNMATCHED_ENDPOINT
+    return '/' + match.route
+
+@receiver(setting_changed, dispatch_uid='api.route_cache_root_urlconf_changed')
+def _root_urlconf_changed(setting, **kwargs):
+    # The cache is keyed on request.urlconf, which is None for the default URLconf
+    if setting == 'ROOT_URLCONF':
+        _route_for_path.cache_clear()
+
+def _endpoint_label(request):
+    """
+    Endpoint label for the HTTP metrics: the route template, never the raw path.
+
+    Raw paths put IDs, typos and scanner probes into the label and create new
+    series forever; route templates are bounded by the URLconf.
+    """
+    route = _route_for_path(request.path_info, getattr(request, 'urlconf', None))
+    return metrics.cap_endpoint_label(route, getattr(settings, 'METRICS_MAX_ENDPOINT_LABELS', 200))
+
+def _start_request_tracking(request, user):
+    """Set up request context, metrics and the start log line for a request."""
+    # Reuse the caller's request ID and trace when they send valid ones
+    request_id, trace_id = request_ids.resolve(request.META)
+    request_id_token = RequestContext.set_request_id(request_id)
+    trace_id_token = RequestContext.set_trace_id(trace_id)
+    request.request_id = request_id
+    request.trace_id = trace_id
+
+    # Set user information
+    if user is not None and user.is_authenticated:
+        user_id_token = RequestContext.set_user_id(user.id)
+    else:
+        user_id_token = RequestContext.set_user_id('anonymous')
+
+    # Start request tracking
+    request.metrics_endpoint = _endpoint_label(request)
+    start_time = metrics.track_request_start(request.method, request.metrics_endpoint)
+    request.query_stats, query_stats_token = db_instrumentation.start_request(request_id)
+
+    # Log request with structured data
+    logger.info(f"Request started: {request.method} {request.path}",
+                extra={
+                    'request_path': request.path,
+                    'request_method': request.method,
+                    'request_id': request_id,
+                    'trace_id': trace_id,
+                    'user_agent': request.META.get('HTTP_USER_AGENT', 'unknown'),
+                    'remote_addr': request.META.get('REMOTE_ADDR', 'unknown'),
+                })
+
+    return start_time, (request_id_token, user_id_token, trace_id_token, query_stats_token)
+
+def _reset_request_tracking(context_tokens):
+    """Don't let this request's IDs and query stats leak into the next one."""
+    request_id_token, user_id_token, trace_id_token, query_stats_token = context_tokens
+    db_instrumentation.finish_request(query_stats_token)
+    RequestContext.reset(request_id_token, user_id_token, trace_id_token)
+
+def _record_query_stats(request):
+    """Export the request's query count and warn about repeated SELECTs (likely N+1s)."""
+    stats = request.query_stats
+    metrics.recorder.observe(metrics.db_queries_per_request, (request.metrics_endpoint,), stats.count)
+
+    repeated = stats.repeated_selects(getattr(settings, 'DB_N_PLUS_ONE_THRESHOLD', 10))
+    if repeated:
+        metrics.recorder.inc(metrics.db_n_plus_one_requests_total, (request.metrics_endpoint,))
+        fingerprint, executions, duration = repeated[0]
+        logger.warning(f"Possible N+1 on {request.method} {request.path}: "
+                       f"same SELECT ran {executions} times ({duration:.4f}s)",
+                       extra={
+                           'request_path': request.path,
+                           'request_id': request.request_id,
+                           'statement': fingerprint,
+                           'executions': executions,
+                           'db_queries': stats.count,
+                       })
+
+def _finish_request_tracking(request, response, start_time):
+    """Record metrics and the completion log line for a request."""
+    # Track request end
+    duration = metrics.track_request_end(
+        request.method, request.metrics_endpoint, response.status_code, start_time
+    )
+    _record_query_stats(request)
+    # Let the caller (and our edge proxy) correlate the response with our logs
+    response['X-Request-ID'] = request.request_id
+
+    # Log request completion with structured data
+    logger.info(f"Request completed: {request.method} {request.path} - {response.status_code} in {duration:.4f}s",
+                extra={
+                    'request_path': request.path,
+                    'request_method': request.method,
+                    'status_code': response.status_code,
+                    'duration': duration,
+                    'db_queries': request.query_stats.count,
+                    'db_time': request.query_stats.duration,
+                    'request_id': request.request_id,
+                })
+
+def _fail_request_tracking(request, error, start_time):
+    """Record metrics and an error log line for a request that raised."""
+    # Log exceptions with full context
+    logger.error(f"Request failed: {request.method} {request.path} - {str(error)}",
+                extra={
+                    'request_path': request.path,
+                    'request_method': request.method,
+                    'error': str(error),
+                    'traceback': traceback.format_exc(),
+                    'request_id': request.request_id,
+                })
+
+    # Track the error in metrics
+    metrics.track_request_end(request.method, request.metrics_endpoint, 500, start_time)
+
+@api_middleware
 def request_tracking_middleware(get_response):
     """
     Middleware to track request metrics and add request context.
     
     This middleware:
-    1. Generates a unique request ID for tracing
+    1. Takes the request ID and trace from X-Request-ID/traceparent, or
+       generates one, and echoes it in the X-Request-ID response header
     2. Logs request start/end
     3. Tracks request duration in Prometheus
     4. Captures user information for context
+
+    It has native sync and async paths (see ``api_middleware``); the request
+    context lives in ContextVars, so both see the same values.
     """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            # request.user would hit the session store synchronously; auser() doesn't
+            auser = getattr(request, 'auser', None)
+            user = await auser() if auser is not None else None
+            start_time, context_tokens = _start_request_tracking(request, user)
+
+            try:
+                # Process the request
+                response = await get_response(request)
+                _finish_request_tracking(request, response, start_time)
+                return response
+
+            except Exception as e:
+                _fail_request_tracking(request, e, start_time)
+
+                # Re-raise the exception to let Django handle it
+                raise
+
+            finally:
+                _reset_request_tracking(context_tokens)
+
+        return middleware
+
     def middleware(request):
-        # Generate a unique request ID
-        request_id = str(uuid.uuid4())
-        RequestContext.set_request_id(request_id)
-        request.request_id = request_id
-        
-        # Set user information
-        if request.user.is_authenticated:
-            user_id = request.user.id
-            RequestContext.set_user_id(user_id)
-        else:
-            RequestContext.set_user_id('anonymous')
-        
-        # Start request tracking
-        start_time = metrics.track_request_start(request.method, request.path)
-        
-        # Log request with structured data
-        logger.info(f"Request started: {request.method} {request.path}",
-                    extra={
-                        'request_path': request.path,
-                        'request_method': request.method,
-                        'request_id': request_id,
-                        'user_agent': request.META.get('HTTP_USER_AGENT', 'unknown'),
-                        'remote_addr': request.META.get('REMOTE_ADDR', 'unknown'),
-                    })
-        
-        # Update memory usage metrics
-        process = psutil.Process(os.getpid())
-        metrics.update_memory_usage(process.memory_info().rss)
-        
+        start_time, context_tokens = _start_request_tracking(request, getattr(request, 'user', None))
+
         try:
             # Process the request
             response = get_response(request)
-            
-            # Track request end
-            duration = metrics.track_request_end(
-                request.method, request.path, response.status_code, start_time
-            )
-            
-            # Log request completion with structured data
-            logger.info(f"Request completed: {request.method} {request.path} - {response.status_code} in {duration:.4f}s",
-                        extra={
-                            'request_path': request.path,
-                            'request_method': request.method,
-                            'status_code': response.status_code,
-                            'duration': duration,
-                            'request_id': request_id,
-                        })
-            
+            _finish_request_tracking(request, response, start_time)
             return response
-            
+
         except Exception as e:
-            # Log exceptions with full context
-            logger.error(f"Request failed: {request.method} {request.path} - {str(e)}",
-                        extra={
-                            'request_path': request.path,
-                            'request_method': request.method,
-                            'error': str(e),
-                            'traceback': traceback.format_exc(),
-                            'request_id': request_id,
-                        })
-            
-            # Track the error in metrics
-            metrics.track_request_end(request.method, request.path, 500, start_time)
-            
+            _fail_request_tracking(request, e, start_time)
+
             # Re-raise the exception to let Django handle it
             raise
+
+        finally:
+            _reset_request_tracking(context_tokens)
     
     return middleware
 
+def _check_query_budget(request):
+    """Log requests over their route's query budget and sample their slow statements for EXPLAIN."""
+    stats = db_instrumentation.current_stats()
+    if stats is None:
+        return
+
+    route = _route_for_path(request.path_info, getattr(request, 'urlconf', None))
+    exceeded = query_budget.check_budget(route, stats, request.method)
+    if exceeded:
+        endpoint = _endpoint_label(request)
+        for limit in exceeded:
+            metrics.recorder.inc(metrics.query_budget_exceeded_total, (endpoint, limit))
+        logger.warning(f"Query budget exceeded ({', '.join(exceeded)}) on {request.method} {request.path}: "
+                       f"{stats.count} queries in {stats.duration:.4f}s",
+                       extra={
+                           'request_path': request.path,
+                           'request_method': request.method,
+                           'budget': query_budget.budget_for(route, request.method),
+                           'db_queries': stats.count,
+                           'db_time': stats.duration,
+                           'statements': [
+                               {'statement': fingerprint, 'executions': executions, 'db_time': duration}
+                               for fingerprint, executions, duration in stats.top_statements(5)
+                           ],
+                       })
+
+    for statement in stats.slow:
+        query_budget.explain_sampler.offer(statement)
+
+@api_middleware
+def query_budget_middleware(get_response):
+    """
+    Middleware enforcing per-route query budgets, for continuous DB profiling.
+
+    Requests that run more queries or spend more DB time than their route's
+    budget (``QUERY_BUDGET``/``QUERY_BUDGET_ROUTES``) are counted and logged
+    with the statements that cost the most, and a sample of statements slower
+    than ``SLOW_QUERY_THRESHOLD`` get their plans captured in the background.
+    It must come after ``request_tracking_middleware``, which counts the queries.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            response = await get_response(request)
+            _check_query_budget(request)
+            return response
+
+        return middleware
+
+    def middleware(request):
+        response = get_response(request)
+        _check_query_budget(request)
+        return response
+
+    return middleware
+
+def _maybe_simulate_memory_leak(request):
+    # Simulate a memory leak with a certain probability
+    leak_probability = getattr(settings, 'MEMORY_LEAK_PROBABILITY', 0.05)
+    if random.random() < leak_probability:
+        metrics.simulate_memory_leak(request.path)
+
+@api_middleware
 def memory_leak_middleware(get_response):
     """
     Middleware to simulate a memory leak for demonstration purposes.
@@ -118,33 +332,57 @@ def memory_leak_middleware(get_response):
     This is an educational example of how memory leaks occur in real-world applications
     and how to detect them with monitoring.
     """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            # Process the request
+            response = await get_response(request)
+            _maybe_simulate_memory_leak(request)
+            return response
+
+        return middleware
+
     def middleware(request):
         # Process the request
         response = get_response(request)
-        
-        # Simulate a memory leak with a certain probability
-        leak_probability = getattr(settings, 'MEMORY_LEAK_PROBABILITY', 0.05)
-        if random.random() < leak_probability:
-            metrics.simulate_memory_leak(request.path)
-        
+        _maybe_simulate_memory_leak(request)
         return response
     
     return middleware
 
+def _record_slow_query(delay):
+    logger.info("Slow database query detected",
+                extra={'query_time': delay, 'table': 'orders'})
+    metrics.track_db_query('SELECT', 'orders', delay)
+
+@sync_and_async_middleware
 def slow_database_query_middleware(get_response):
     """
     Middleware to simulate slow database queries.
     
     This helps demonstrate how to identify database performance issues.
+    Under ASGI the simulated query awaits instead of blocking the event loop.
     """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            # Before request processing
+            if 'slow-query' in request.path:
+                # Simulate a slow DB query without blocking other requests
+                delay = random.uniform(0.1, 1.5)
+                await asyncio.sleep(delay)
+                _record_slow_query(delay)
+
+            # Process the request
+            return await get_response(request)
+
+        return middleware
+
     def middleware(request):
         # Before request processing
         if 'slow-query' in request.path:
             # Simulate a slow DB query
-            time.sleep(random.uniform(0.1, 1.5))  # Simulate random query times
-            logger.info("Slow database query detected",
-                        extra={'query_time': 1.5, 'table': 'orders'})
-            metrics.track_db_query('SELECT', 'orders', 1.5)
+            delay = random.uniform(0.1, 1.5)  # Simulate random query times
+            time.sleep(delay)
+            _record_slow_query(delay)
         
         # Process the request
         response = get_response(request)
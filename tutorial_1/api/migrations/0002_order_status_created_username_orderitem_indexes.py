@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-17 18:57
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction. Building the
+    # indexes concurrently keeps the tables writable while the migration runs.
+    atomic = False
+
+    dependencies = [
+        ("api", "0001_initial"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="order",
+            index=models.Index(
+                fields=["status", "created_at"], name="api_order_status_created_idx"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="orderitem",
+            index=models.Index(
+                fields=["order", "item"],
+                include=("quantity",),
+                name="api_orderitem_order_item_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="userprofile",
+            index=models.Index(fields=["username"], name="api_user_username_idx"),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.2 on 2026-10-17 18:58
+
+import django.db.models.deletion
+import django_prometheus.models
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_order_counts(apps, schema_editor):
+    UserOrderCount = apps.get_model("api", "UserOrderCount")
+    UserProfile = apps.get_model("api", "UserProfile")
+    counts = (
+        UserProfile.objects.annotate(order_count=Count("order"))
+        .filter(order_count__gt=0)
+        .values_list("pk", "order_count")
+    )
+    UserOrderCount.objects.bulk_create(
+        (
+            UserOrderCount(user_id=user_id, order_count=order_count)
+            for user_id, order_count in counts.iterator(chunk_size=5000)
+        ),
+        batch_size=5000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0002_order_status_created_username_orderitem_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserOrderCount",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="api.userprofile",
+                    ),
+                ),
+                ("order_count", models.IntegerField(default=0)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["-order_count", "user"],
+                        name="api_userordercount_top_idx",
+                    )
+                ],
+            },
+            bases=(
+                django_prometheus.models.ExportModelOperationsMixin("user_order_count"),
+                models.Model,
+            ),
+        ),
+        migrations.RunPython(backfill_order_counts, migrations.RunPython.noop),
+    ]
@@ -11,6 +11,12 @@ class UserProfile(ExportModelOperationsMixin('user_profile'), models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     last_login = models.DateTimeField(null=True, blank=True)
     
+    class Meta:
+        indexes = [
+            # Per-user order leaderboard groups by username
+            models.Index(fields=['username'], name='api_user_username_idx'),
+        ]
+    
     def __str__(self):
         return self.username
 
@@ -36,6 +42,12 @@ class Order(ExportModelOperationsMixin('order'), models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=20, default='pending')
     
+    class Meta:
+        indexes = [
+            # Status counts and "recent orders in a status" filters
+            models.Index(fields=['status', 'created_at'], name='api_order_status_created_idx'),
+        ]
+    
     def __str__(self):
         return f"Order {self.id} by {self.user.username}"
 
@@ -47,5 +59,28 @@ class OrderItem(ExportModelOperationsMixin('order_item'), models.Model):
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
     
+    class Meta:
+        indexes = [
+            # Covers order line lookups and totals without visiting the table (PostgreSQL)
+            models.Index(fields=['order', 'item'], include=['quantity'], name='api_orderitem_order_item_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.quantity}x {self.item.name} in Order {self.order.id}"
+
+
+class UserOrderCount(ExportModelOperationsMixin('user_order_count'), models.Model):
+    """
+    Per-user order count, maintained incrementally as orders are created and deleted.
+    Backs the order leaderboard so it never aggregates the order table.
+    """
+    user = models.OneToOneField(UserProfile, on_delete=models.CASCADE, primary_key=True)
+    order_count = models.IntegerField(default=0)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['-order_count', 'user'], name='api_userordercount_top_idx'),
+        ]
+    
     def __str__(self):
-        return f"{self.quantity}x {self.item.name} in Order {self.order.id}"
\ No newline at end of file
+        return f"{self.user_id}: {self.order_count} orders"
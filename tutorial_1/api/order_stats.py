@@ -0,0 +1,149 @@
+# api/order_stats.py
+import logging
+import os
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, transaction
+from django.db.models import Count
+from prometheus_client.core import GaugeMetricFamily
+from . import metrics
+from .background import BackgroundThread
+from .models import Order
+
+logger = logging.getLogger(__name__)
+
+# Statuses outside ORDER_STATUSES are counted together so the label stays bounded
+OTHER_STATUS = 'other'
+
+class OrderStatusCounts:
+    """
+    Order counts per status, maintained incrementally in the shared cache.
+
+    Order signals adjust the counts when an order is created, changes status or
+    is deleted, so reading them is a single ``get_many`` however many orders
+    exist. Writes that bypass signals (``QuerySet.update()``, raw SQL) are
+    corrected by a background reconciler that recounts from the database every
+    ``reconcile_interval`` seconds; across workers, a cache lock lets only one
+    of them run each recount. Counts that were never seeded (or were evicted)
+    are recounted by the next read, not by the write that found them missing.
+    """
+    def __init__(self, statuses, reconcile_interval=300, cache_alias='default'):
+        self.statuses = tuple(statuses)
+        self.reconcile_interval = reconcile_interval
+        self.cache_alias = cache_alias
+        self._reconciler = BackgroundThread(self._run, 'order-status-reconciler')
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def bucket(self, status):
+        return status if status in self.statuses else OTHER_STATUS
+
+    def _key(self, bucket):
+        return f"order-status:count:{bucket}"
+
+    def _buckets(self):
+        return self.statuses + (OTHER_STATUS,)
+
+    def counts(self):
+        """Return ``{status: count}``, seeding missing counts from the database (None if that fails)."""
+        self._reconciler.ensure_started()
+        keys = {self._key(bucket): bucket for bucket in self._buckets()}
+        cached = self.cache.get_many(list(keys))
+        if len(cached) == len(keys):
+            return {keys[key]: value for key, value in cached.items()}
+        try:
+            return self.reconcile()
+        except Exception as e:
+            logger.error(f"Seeding order status counts failed: {str(e)}")
+            return None
+
+    def record_change(self, old_status, new_status):
+        """Move one order between statuses once the current transaction commits."""
+        old = None if old_status is None else self.bucket(old_status)
+        new = None if new_status is None else self.bucket(new_status)
+        if old == new:
+            return
+        transaction.on_commit(lambda: self._apply(old, new))
+
+    def _apply(self, old, new):
+        try:
+            if old is not None:
+                self.cache.decr(self._key(old))
+            if new is not None:
+                self.cache.incr(self._key(new))
+        except ValueError:
+            # Counts were never seeded or got evicted: the next read recounts them,
+            # including this change, so a request's commit never runs the GROUP BY
+            pass
+
+    def reconcile(self):
+        """Recount orders by status from the database and overwrite the cached counts."""
+        actual = dict.fromkeys(self._buckets(), 0)
+        for row in Order.objects.values('status').annotate(count=Count('id')).order_by():
+            actual[self.bucket(row['status'])] += row['count']
+
+        cached = self.cache.get_many([self._key(bucket) for bucket in actual])
+        drift = sum(
+            abs(cached[self._key(bucket)] - count)
+            for bucket, count in actual.items() if self._key(bucket) in cached
+        )
+        self.cache.set_many({self._key(bucket): count for bucket, count in actual.items()}, timeout=None)
+
+        metrics.order_status_reconciliations_total.inc()
+        metrics.order_status_drift_total.inc(drift)
+        if drift:
+            logger.warning(f"Order status counts drifted by {drift}; reconciled from the database",
+                           extra={"drift": drift})
+        return actual
+
+    def _run(self):
+        while True:
+            try:
+                # Only one worker recounts per interval
+                if self.cache.add('order-status:reconcile-lock', os.getpid(), timeout=self.reconcile_interval):
+                    self.reconcile()
+            except Exception as e:
+                logger.error(f"Order status reconciliation failed: {str(e)}")
+            finally:
+                connection.close()
+            time.sleep(self.reconcile_interval)
+
+def _cache_is_shared(alias):
+    """Whether all worker processes see the same ``alias`` cache."""
+    return not isinstance(caches[alias], (LocMemCache, DummyCache))
+
+class OrderStatusCollector:
+    """Exports the order status counts and the cart abandonment rate at scrape time."""
+    def __init__(self, counts):
+        self.counts = counts
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        counts = self.counts.counts()
+        if counts is None:
+            return
+
+        by_status = GaugeMetricFamily('orders_by_status', 'Number of orders by status', labels=['status'])
+        for status, count in counts.items():
+            by_status.add_metric([status], count)
+        yield by_status
+
+        total = sum(counts.values())
+        yield GaugeMetricFamily('cart_abandonment_rate', 'Rate of cart abandonment',
+                                value=counts.get('abandoned', 0) / total if total else 0)
+
+order_status_counts = OrderStatusCounts(
+    getattr(settings, 'ORDER_STATUSES', ('pending', 'processing', 'completed', 'cancelled', 'abandoned')),
+    reconcile_interval=getattr(settings, 'ORDER_STATS_RECONCILE_INTERVAL', 300),
+)
+# In a cache shared by all workers any worker can export the counts for all;
+# a per-process cache only holds this worker's view
+metrics.register_collector(OrderStatusCollector(order_status_counts),
+                           shared=_cache_is_shared(order_status_counts.cache_alias))
@@ -0,0 +1,83 @@
+# api/orders.py
+import logging
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, When
+from . import caching
+from .models import Item, Order, OrderItem
+
+logger = logging.getLogger(__name__)
+
+class OrderRejected(Exception):
+    """An order that can't be placed as requested; nothing was written."""
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+def parse_order_lines(lines):
+    """
+    Turn the ``items`` payload into ``{item_id: quantity}``.
+
+    Repeated lines for the same item are merged so the item is locked, checked
+    and decremented once.
+    """
+    if not isinstance(lines, list):
+        raise OrderRejected("items must be a list of {item_id, quantity} objects")
+
+    quantities = {}
+    for line in lines:
+        if not isinstance(line, dict):
+            raise OrderRejected(f"Invalid order line: {line}")
+        try:
+            item_id = int(line.get('item_id'))
+            quantity = int(line.get('quantity', 1))
+        except (TypeError, ValueError):
+            raise OrderRejected(f"Invalid order line: {line}")
+        if quantity < 1:
+            raise OrderRejected(f"Quantity must be positive for item {item_id}")
+        quantities[item_id] = quantities.get(item_id, 0) + quantity
+    return quantities
+
+def create_order(user, status, quantities):
+    """
+    Create an order and reserve its stock as one atomic unit.
+
+    The query count doesn't depend on the number of lines: one locking
+    ``SELECT ... FOR UPDATE`` for all items, one INSERT for the order, one bulk
+    INSERT for its lines and one UPDATE that decrements every item's stock.
+    The affected catalog cache entries are invalidated when the order commits.
+    Items are locked in primary key order so concurrent orders can't deadlock,
+    and the stock check happens under the lock, so scarce stock can't be
+    oversold. Any failure rolls the whole order back.
+
+    Returns ``(order, total_value)``.
+    """
+    with transaction.atomic():
+        items = Item.objects.select_for_update().order_by('pk').in_bulk(list(quantities))
+
+        missing = sorted(item_id for item_id in quantities if item_id not in items)
+        if missing:
+            raise OrderRejected("Items not found", status=404, missing_items=missing)
+
+        insufficient = sorted(
+            item_id for item_id, quantity in quantities.items() if items[item_id].stock < quantity
+        )
+        if insufficient:
+            raise OrderRejected("Insufficient stock", status=409, insufficient_stock=insufficient)
+
+        order = Order.objects.create(user=user, status=status)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, item_id=item_id, quantity=quantity)
+            for item_id, quantity in quantities.items()
+        ])
+
+        if quantities:
+            Item.objects.filter(pk__in=list(quantities)).update(stock=Case(
+                *[When(pk=item_id, then=F('stock') - quantity) for item_id, quantity in quantities.items()],
+                output_field=IntegerField()
+            ))
+            # update() sends no signals; cached stock levels must go explicitly
+            caching.invalidate_items(list(quantities), source='order_stock')
+
+    total_value = sum(float(items[item_id].price) * quantity for item_id, quantity in quantities.items())
+    return order, total_value
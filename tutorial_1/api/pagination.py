@@ -0,0 +1,70 @@
+# api/pagination.py
+from django.conf import settings
+
+class PaginationError(ValueError):
+    """Raised for malformed ``cursor``, ``limit`` or ``fields`` parameters."""
+
+def parse_list_params(request, allowed_fields, default_fields=None):
+    """
+    Read keyset pagination and projection parameters from the query string.
+
+    - ``cursor``: the ``next_cursor`` value from the previous page
+    - ``limit``: page size, capped at ``API_MAX_PAGE_SIZE``
+    - ``fields``: comma-separated subset of ``allowed_fields`` to return
+
+    Returns ``(cursor, limit, fields)``.
+    """
+    default_limit = getattr(settings, 'API_DEFAULT_PAGE_SIZE', 100)
+    max_limit = getattr(settings, 'API_MAX_PAGE_SIZE', 1000)
+
+    cursor = request.GET.get('cursor')
+    if cursor:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            raise PaginationError(f"Invalid cursor: {cursor}")
+    else:
+        cursor = None
+
+    try:
+        limit = int(request.GET.get('limit', default_limit))
+    except ValueError:
+        raise PaginationError(f"Invalid limit: {request.GET.get('limit')}")
+    if limit < 1:
+        raise PaginationError("limit must be a positive integer")
+    limit = min(limit, max_limit)
+
+    fields = request.GET.get('fields')
+    if fields:
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+        unknown = [field for field in fields if field not in allowed_fields]
+        if unknown:
+            raise PaginationError(
+                f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed_fields)}"
+            )
+    else:
+        fields = list(default_fields or allowed_fields)
+
+    return cursor, limit, fields
+
+def paginate(queryset, cursor, limit):
+    """
+    Return one page of ``queryset`` by keyset on the primary key.
+
+    Filtering on ``pk > cursor`` walks the primary key index, so every page
+    costs the same no matter how deep into the table it is, unlike OFFSET.
+    Returns ``(rows, next_cursor)``; ``next_cursor`` is None on the last page.
+    Rows may be model instances or ``.values()`` dicts (which must include ``id``).
+    """
+    queryset = queryset.order_by('pk')
+    if cursor is not None:
+        queryset = queryset.filter(pk__gt=cursor)
+
+    # Fetch one extra row to learn whether another page exists
+    rows = list(queryset[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, str(last['id'] if isinstance(last, dict) else last.pk)
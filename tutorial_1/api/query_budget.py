@@ -0,0 +1,126 @@
+# api/query_budget.py
+import contextvars
+import logging
+import queue
+import random
+import threading
+import time
+from django.conf import settings
+from django.db import connections, transaction
+from . import db_instrumentation, metrics
+from .background import BackgroundThread
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = {'queries': 50, 'db_time': 0.5}
+
+def budget_for(route, method=None):
+    """
+    Query budget for a route template: ``{'queries': max count, 'db_time': max seconds}``.
+
+    ``QUERY_BUDGET`` is the default and ``QUERY_BUDGET_ROUTES`` overrides it per
+    route (``'/api/orders/'``) and then per method and route
+    (``'POST /api/orders/'``); a limit of ``None`` isn't enforced.
+    """
+    routes = getattr(settings, 'QUERY_BUDGET_ROUTES', {})
+    budget = dict(getattr(settings, 'QUERY_BUDGET', DEFAULT_BUDGET))
+    budget.update(routes.get(route, {}))
+    if method is not None:
+        budget.update(routes.get(f"{method} {route}", {}))
+    return budget
+
+def check_budget(route, stats, method=None):
+    """Return the names of the budget limits ``stats`` went over (empty when within budget)."""
+    budget = budget_for(route, method)
+    exceeded = []
+    if budget.get('queries') is not None and stats.count > budget['queries']:
+        exceeded.append('queries')
+    if budget.get('db_time') is not None and stats.duration > budget['db_time']:
+        exceeded.append('db_time')
+    return exceeded
+
+class ExplainSampler:
+    """
+    Captures ``EXPLAIN (ANALYZE, BUFFERS)`` plans for a sample of slow statements.
+
+    Plans are captured on a background thread, off the request path, and
+    logged (and so shipped to Loki) with the statement fingerprint and the
+    request ID of the request that ran it. Only PostgreSQL SELECTs are
+    explained: ANALYZE executes the statement, so it runs in a transaction
+    that is rolled back, under ``statement_timeout``. Each fingerprint is
+    explained at most once per ``min_interval`` seconds, and statements that
+    arrive while the queue is full are dropped.
+    """
+    def __init__(self, sample_rate=0.05, min_interval=300, timeout=5, max_queue=100):
+        self.sample_rate = sample_rate
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._last_explained = {}
+        self._lock = threading.Lock()
+        self._thread = BackgroundThread(self._run, 'slow-query-explain')
+
+    def offer(self, statement):
+        """Maybe queue a ``db_instrumentation.SlowStatement`` for an EXPLAIN."""
+        if statement.many or statement.query_type != 'SELECT' or 'FOR UPDATE' in statement.fingerprint:
+            return
+        if connections[statement.alias].vendor != 'postgresql':
+            return
+        if random.random() >= self.sample_rate or not self._claim(statement.fingerprint):
+            return
+
+        self._thread.ensure_started()
+        try:
+            # Run in the request's context so the plan is logged with its request ID
+            context = contextvars.copy_context()
+            self._queue.put_nowait(lambda: context.run(self.explain, statement))
+            metrics.recorder.inc(metrics.slow_query_explains_total, ('queued',))
+        except queue.Full:
+            metrics.recorder.inc(metrics.slow_query_explains_total, ('dropped',))
+
+    def _claim(self, fingerprint):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_explained.get(fingerprint, float('-inf')) < self.min_interval:
+                return False
+            if len(self._last_explained) >= 1000:
+                self._last_explained.clear()
+            self._last_explained[fingerprint] = now
+            return True
+
+    def explain(self, statement):
+        """Run ``EXPLAIN (ANALYZE, BUFFERS)`` for a slow statement and log the plan."""
+        connection = connections[statement.alias]
+        # The EXPLAIN is itself a slow statement; keep it out of the request's stats
+        # so it can't be sampled and explained again
+        with db_instrumentation.untracked(), transaction.atomic(using=statement.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(f"SET LOCAL statement_timeout = {int(self.timeout * 1000)}")
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {statement.sql}", statement.params)
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+            transaction.set_rollback(True, using=statement.alias)
+
+        logger.warning(f"Query plan for slow statement ({statement.duration:.4f}s): {statement.fingerprint}",
+                       extra={
+                           'statement': statement.fingerprint,
+                           'query_time': statement.duration,
+                           'plan': plan,
+                       })
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job()
+                metrics.recorder.inc(metrics.slow_query_explains_total, ('captured',))
+            except Exception as e:
+                metrics.recorder.inc(metrics.slow_query_explains_total, ('failed',))
+                logger.error(f"Capturing a slow query plan failed: {str(e)}")
+            finally:
+                connections.close_all()
+
+explain_sampler = ExplainSampler(
+    sample_rate=getattr(settings, 'SLOW_QUERY_EXPLAIN_SAMPLE_RATE', 0.05),
+    min_interval=getattr(settings, 'SLOW_QUERY_EXPLAIN_INTERVAL', 300),
+    timeout=getattr(settings, 'SLOW_QUERY_EXPLAIN_TIMEOUT', 5),
+)
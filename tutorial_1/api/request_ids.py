@@ -0,0 +1,100 @@
+# api/request_ids.py
+import collections
+import os
+import random
+import re
+import threading
+import time
+from django.conf import settings
+
+# X-Request-ID values we accept from upstream: bounded length and a charset
+# that can't break log lines, SQL comments or response headers
+_REQUEST_ID = re.compile(r"[A-Za-z0-9][A-Za-z0-9._:-]{7,127}")
+_TRACEPARENT = re.compile(r"([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?")
+_MAX_TRACEPARENT_LENGTH = 512
+
+TraceContext = collections.namedtuple('TraceContext', ['trace_id', 'parent_id', 'flags'])
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_random = 0
+
+def _reset_after_fork():
+    # The child would otherwise continue the parent's sequence and repeat its IDs
+    global _last_ms
+    _last_ms = 0
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def new_request_id():
+    """
+    A new time-ordered request ID: 32 lowercase hex digits.
+
+    Uses the ULID layout (a 48-bit millisecond timestamp, then 80 random
+    bits), so IDs sort by creation time, and within one millisecond the random
+    part is incremented rather than redrawn to keep them ordered. The random
+    bits come from the ``random`` module, not ``os.urandom``: request IDs need
+    to be unique, not unguessable. Being 128 bits of hex, an ID is also a
+    valid W3C trace-id.
+    """
+    global _last_ms, _last_random
+    now_ms = time.time_ns() // 1_000_000
+    with _lock:
+        if now_ms > _last_ms:
+            _last_ms, _last_random = now_ms, random.getrandbits(80)
+        else:
+            # Same millisecond (or the clock stepped back): stay monotonic
+            _last_random += 1
+            if _last_random >> 80:
+                _last_ms, _last_random = _last_ms + 1, 0
+        value = (_last_ms << 80) | _last_random
+    return value.to_bytes(16, 'big').hex()
+
+def is_valid_request_id(value):
+    return _REQUEST_ID.fullmatch(value) is not None
+
+def parse_traceparent(value):
+    """
+    Parse a W3C ``traceparent`` header into a ``TraceContext``, or None if it's invalid.
+
+    Follows the Trace Context spec: version ``ff`` and all-zero trace or parent
+    IDs are invalid, version ``00`` has exactly four fields, and later versions
+    may append fields that are ignored.
+    """
+    if len(value) > _MAX_TRACEPARENT_LENGTH:
+        return None
+    match = _TRACEPARENT.fullmatch(value.strip())
+    if match is None:
+        return None
+    version, trace_id, parent_id, flags, extra = match.groups()
+    if version == 'ff' or (version == '00' and extra):
+        return None
+    if trace_id == '0' * 32 or parent_id == '0' * 16:
+        return None
+    return TraceContext(trace_id, parent_id, flags)
+
+def resolve(meta):
+    """
+    ``(request_id, trace_id)`` for a request, given its ``META``.
+
+    With ``REQUEST_ID_TRUST_INBOUND`` (for deployments behind a proxy that
+    sets or sanitizes these headers), a valid ``X-Request-ID`` is used as the
+    request ID and a valid ``traceparent`` supplies the trace ID, which is also
+    the request ID when no ``X-Request-ID`` came. Anything missing or invalid
+    is generated, so a request that arrives with neither gets one new ID for both.
+    """
+    request_id = trace = None
+    if getattr(settings, 'REQUEST_ID_TRUST_INBOUND', True):
+        inbound_id = meta.get('HTTP_X_REQUEST_ID')
+        if inbound_id is not None and is_valid_request_id(inbound_id):
+            request_id = inbound_id
+        inbound_traceparent = meta.get('HTTP_TRACEPARENT')
+        if inbound_traceparent is not None:
+            trace = parse_traceparent(inbound_traceparent)
+
+    if trace is not None:
+        return request_id or trace.trace_id, trace.trace_id
+    if request_id is not None:
+        return request_id, new_request_id()
+    request_id = new_request_id()
+    return request_id, request_id
@@ -0,0 +1,44 @@
+# api/signals.py
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from . import caching, leaderboard
+from .models import Item, Order
+from .order_stats import order_status_counts
+
+@receiver(post_save, sender=Item, dispatch_uid='api.item_saved_invalidate_catalog')
+def item_saved(sender, instance, created, **kwargs):
+    """Drop cached catalog pages, and the item itself if it existed, after a save (including item_list POST)."""
+    caching.invalidate_items([] if created else [instance.pk], source='item_saved')
+
+@receiver(post_delete, sender=Item, dispatch_uid='api.item_deleted_invalidate_catalog')
+def item_deleted(sender, instance, **kwargs):
+    caching.invalidate_items([instance.pk], source='item_deleted')
+
+@receiver(post_init, sender=Order, dispatch_uid='api.order_loaded_track_status')
+def order_loaded(sender, instance, **kwargs):
+    # Read from __dict__ so a deferred status isn't fetched one query per order
+    instance._tracked_status = instance.__dict__.get('status')
+
+@receiver(post_save, sender=Order, dispatch_uid='api.order_saved_count_status')
+def order_saved(sender, instance, created, update_fields=None, **kwargs):
+    """Keep the per-status order counts current on create and status change."""
+    if update_fields is not None and 'status' not in update_fields:
+        return
+    if created:
+        order_status_counts.record_change(None, instance.status)
+    elif instance._tracked_status is not None:
+        order_status_counts.record_change(instance._tracked_status, instance.status)
+    # Otherwise the previous status is unknown; the reconciler corrects the counts
+    instance._tracked_status = instance.status
+
+@receiver(post_save, sender=Order, dispatch_uid='api.order_saved_count_per_user')
+def order_created_for_user(sender, instance, created, **kwargs):
+    """Bump the user's leaderboard entry in the same transaction as the new order."""
+    if created:
+        leaderboard.record_orders(instance.user_id, 1)
+
+@receiver(post_delete, sender=Order, dispatch_uid='api.order_deleted_count_status')
+def order_deleted(sender, instance, **kwargs):
+    if instance._tracked_status is not None:
+        order_status_counts.record_change(instance._tracked_status, None)
+    leaderboard.record_orders(instance.user_id, -1)
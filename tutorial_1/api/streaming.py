@@ -0,0 +1,56 @@
+# api/streaming.py
+import json
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+STREAM_FORMATS = ('ndjson', 'json')
+
+def export_chunk_size():
+    """Rows fetched per round trip from the database cursor while exporting."""
+    return getattr(settings, 'API_EXPORT_CHUNK_SIZE', 2000)
+
+def _encode(row):
+    return json.dumps(row, cls=DjangoJSONEncoder)
+
+def _ndjson_chunks(rows, rows_per_chunk):
+    buffer = []
+    for row in rows:
+        buffer.append(_encode(row))
+        if len(buffer) >= rows_per_chunk:
+            yield ("\n".join(buffer) + "\n").encode('utf-8')
+            buffer = []
+    if buffer:
+        yield ("\n".join(buffer) + "\n").encode('utf-8')
+
+def _json_chunks(rows, key, rows_per_chunk):
+    # Send the opening bracket straight away so the client gets its first byte
+    yield f'{{"{key}": ['.encode('utf-8')
+    buffer = []
+    separator = ""
+    for row in rows:
+        buffer.append(separator + _encode(row))
+        separator = ","
+        if len(buffer) >= rows_per_chunk:
+            yield "".join(buffer).encode('utf-8')
+            buffer = []
+    buffer.append("]}")
+    yield "".join(buffer).encode('utf-8')
+
+def streaming_export(rows, stream_format, key, rows_per_chunk=500):
+    """
+    Stream ``rows`` (an iterator of dicts) as NDJSON or as one JSON document.
+
+    Rows are encoded as they are pulled from the iterator and flushed to the
+    client in small chunks, so memory use doesn't grow with the result size.
+    ``json`` produces the same ``{"<key>": [...]}`` shape as the list endpoints.
+    """
+    if stream_format == 'ndjson':
+        response = StreamingHttpResponse(_ndjson_chunks(rows, rows_per_chunk),
+                                         content_type='application/x-ndjson')
+    else:
+        response = StreamingHttpResponse(_json_chunks(rows, key, rows_per_chunk),
+                                         content_type='application/json')
+    # Ask proxies not to buffer the whole export before passing it on
+    response['X-Accel-Buffering'] = 'no'
+    return response
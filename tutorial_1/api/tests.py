@@ -1,3 +1,1313 @@
-from django.test import TestCase
+import asyncio
+import collections
+import contextlib
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from prometheus_client import CollectorRegistry
+from prometheus_client.multiprocess import MultiProcessCollector
+from unittest import mock
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, connections
+from django.http import JsonResponse
+from django.test import AsyncClient, Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import path
+from . import caching, db_instrumentation, health, leaderboard, metrics, order_stats, query_budget
+from . import middleware as api_middleware
+from .background import BackgroundThread
+from .handlers import CircuitBreaker, LokiHandler
+from .logging_filters import RequestIdFilter
+from .middleware import RequestContext
+from .models import Item, Order, OrderItem, UserOrderCount, UserProfile
 
-# Create your tests here.
+logger = logging.getLogger(__name__)
+
+
+def _log_marker_view(request):
+    # Yield the GIL mid-request so concurrent requests interleave
+    time.sleep(0)
+    logger.info("marker", extra={'marker': request.GET['n']})
+    return JsonResponse({})
+
+async def _async_log_marker_view(request):
+    await asyncio.sleep(0)
+    logger.info("marker", extra={'marker': request.GET['n']})
+    return JsonResponse({})
+
+# URLconf for tests that need their own views (ROOT_URLCONF='api.tests')
+urlpatterns = [
+    path('log-marker/', _log_marker_view),
+    path('async-log-marker/', _async_log_marker_view),
+]
+
+
+def seed_orders(count, lines_per_order=2, start=0):
+    """Create ``count`` orders, each by its own user, with ``lines_per_order`` item lines."""
+    items = Item.objects.bulk_create([
+        Item(name=f"item-{start}-{i}", price=Decimal('2.50'), description='', stock=100)
+        for i in range(lines_per_order)
+    ])
+    users = UserProfile.objects.bulk_create([
+        UserProfile(username=f"user-{start + i}", email=f"user-{start + i}@example.com")
+        for i in range(count)
+    ])
+    orders = Order.objects.bulk_create([Order(user=user, status='pending') for user in users])
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, item=item, quantity=2) for order in orders for item in items
+    ])
+    return orders
+
+
+def stream_lines(response):
+    body = b''.join(response.streaming_content).decode('utf-8')
+    return [json.loads(line) for line in body.splitlines()]
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0)
+class OrderStreamExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(30)
+
+    def test_empty_fields_export_every_field(self):
+        response = self.client.get('/api/orders/?stream=ndjson&fields=')
+        self.assertEqual(response.status_code, 200)
+
+        rows = stream_lines(response)
+        self.assertEqual(len(rows), 30)
+        self.assertEqual(rows[0]['total_value'], 10.0)
+        self.assertEqual(len(rows[0]['items']), 2)
+
+    def test_padded_field_names_are_joined_not_fetched_per_row(self):
+        response = self.client.get('/api/orders/?stream=ndjson&fields=id,%20user')
+        # The export runs as the response is consumed: one joined query for every row
+        with self.assertNumQueries(1):
+            rows = stream_lines(response)
+
+        self.assertEqual(len(rows), 30)
+        self.assertEqual(rows[0], {"id": rows[0]["id"], "user": "user-0"})
+
+    def test_unknown_field_is_rejected_before_streaming(self):
+        response = self.client.get('/api/orders/?stream=ndjson&fields=id,bogus')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0, API_EXPORT_CHUNK_SIZE=500)
+class StreamExportMemoryTests(TestCase):
+    def _seed_items(self, total):
+        existing = Item.objects.count()
+        Item.objects.bulk_create(
+            [Item(name=f"item-{i}", price=Decimal('9.99'), description='x' * 100, stock=i % 100)
+             for i in range(existing, total)],
+            batch_size=5000
+        )
+
+    # Only allocations made on the export's own code path count; background
+    # threads (metrics flusher, Loki shipper, health refresher) allocate too
+    EXPORT_FRAMES = [
+        tracemalloc.Filter(True, pattern, all_frames=True)
+        for pattern in ('*/api/streaming.py', '*/api/views.py', '*/django/db/*')
+    ]
+    BACKGROUND_FRAMES = [
+        tracemalloc.Filter(False, pattern, all_frames=True)
+        for pattern in ('*/api/health.py', '*/api/handlers.py', '*/api/metrics.py')
+    ]
+
+    def _export_held(self, total):
+        """
+        Export memory still held halfway through and at the last chunk of an
+        export of ``total`` items (the larger of the two), and the rows exported.
+        """
+        checkpoints = {total // 2, total}
+        tracemalloc.start(5)
+        try:
+            response = self.client.get('/api/items/?stream=ndjson')
+            rows = 0
+            held = 0
+            # Discard chunks as they arrive, like a client writing to disk
+            for chunk in response.streaming_content:
+                rows += chunk.count(b'\n')
+                if rows in checkpoints:
+                    snapshot = tracemalloc.take_snapshot().filter_traces(self.EXPORT_FRAMES)
+                    snapshot = snapshot.filter_traces(self.BACKGROUND_FRAMES)
+                    held = max(held, sum(stat.size for stat in snapshot.statistics('filename')))
+        finally:
+            tracemalloc.stop()
+        return held, rows
+
+    def test_memory_held_does_not_grow_with_export_size(self):
+        held = {}
+        for total in (1_000, 4_000, 16_000):
+            self._seed_items(total)
+            held[total], rows = self._export_held(total)
+            self.assertEqual(rows, total)
+
+        # Sixteen times the rows must not mean (anywhere near) sixteen times the memory
+        self.assertLess(held[16_000], held[1_000] * 1.5, held)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0)
+class OrderListQueryCountTests(TestCase):
+    # One query for the orders (users joined in, totals summed) and one prefetch of their lines
+    QUERIES_PER_PAGE = 2
+
+    def _list_orders(self):
+        with self.assertNumQueries(self.QUERIES_PER_PAGE):
+            response = self.client.get('/api/orders/?limit=100')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['orders']
+
+    def test_query_count_does_not_grow_with_orders(self):
+        seed_orders(1)
+        self.assertEqual(len(self._list_orders()), 1)
+
+        seed_orders(40, lines_per_order=3, start=1)
+        orders = self._list_orders()
+        self.assertEqual(len(orders), 41)
+        self.assertEqual({len(order['items']) for order in orders}, {2, 3})
+        self.assertEqual(orders[-1]['user'], 'user-40')
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0, API_MAX_PAGE_SIZE=5)
+class ListPaginationTests(TestCase):
+    ENDPOINTS = {'users': UserProfile, 'items': Item, 'orders': Order}
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(12, lines_per_order=1)
+        Item.objects.bulk_create([
+            Item(name=f"listed-{i}", price=Decimal('1.25'), description='', stock=i) for i in range(7)
+        ])
+
+    def setUp(self):
+        # Item pages are cached, and 1 in 10 item page loads sleeps to simulate a slow query
+        caching._cache().clear()
+        self.addCleanup(caching._cache().clear)
+        patcher = mock.patch('api.views.random.random', return_value=1.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get(self, key, query):
+        response = self.client.get(f'/api/{key}/?{query}')
+        self.assertEqual(response.status_code, 200, response.content)
+        body = response.json()
+        return body[key], body['next_cursor']
+
+    def _error(self, key, query):
+        with self.assertLogs('django.request', level='WARNING'):
+            response = self.client.get(f'/api/{key}/?{query}')
+        self.assertEqual(response.status_code, 400)
+        return response.json()['error']
+
+    def test_cursor_round_trip_visits_every_row_once(self):
+        for key, model in self.ENDPOINTS.items():
+            with self.subTest(key):
+                ids, pages, cursor = [], 0, ''
+                while True:
+                    rows, cursor = self._get(key, f'limit=4&cursor={cursor}')
+                    ids.extend(row['id'] for row in rows)
+                    pages += 1
+                    if cursor is None:
+                        break
+                    self.assertEqual(cursor, str(ids[-1]))
+
+                expected = list(model.objects.order_by('pk').values_list('pk', flat=True))
+                self.assertEqual(ids, expected)
+                self.assertEqual(pages, -(-len(expected) // 4))
+
+    def test_cursor_past_the_last_row_is_an_empty_last_page(self):
+        last = UserProfile.objects.order_by('-pk').values_list('pk', flat=True)[0]
+        self.assertEqual(self._get('users', f'cursor={last}'), ([], None))
+
+    def test_invalid_or_tampered_cursors_are_rejected(self):
+        for cursor in ('abc', '1.5', '0x10', "5' OR '1'='1", '9' * 30 + 'z'):
+            for key in self.ENDPOINTS:
+                with self.subTest(key=key, cursor=cursor):
+                    self.assertIn("Invalid cursor", self._error(key, f'cursor={cursor}'))
+
+    def test_limit_is_clamped_to_the_maximum_page_size(self):
+        for key in self.ENDPOINTS:
+            with self.subTest(key):
+                rows, cursor = self._get(key, 'limit=500')
+                self.assertEqual(len(rows), 5)
+                self.assertEqual(cursor, str(rows[-1]['id']))
+                self.assertEqual(len(self._get(key, 'limit=2')[0]), 2)
+
+    def test_invalid_limits_are_rejected(self):
+        self.assertIn("positive", self._error('users', 'limit=0'))
+        self.assertIn("positive", self._error('items', 'limit=-3'))
+        self.assertIn("Invalid limit", self._error('orders', 'limit=ten'))
+
+    def test_fields_selects_only_the_requested_fields(self):
+        users, cursor = self._get('users', 'fields=email&limit=2')
+        self.assertEqual([set(user) for user in users], [{'email'}, {'email'}])
+        # The cursor is built from the primary key even when it isn't requested
+        self.assertEqual(cursor, str(UserProfile.objects.order_by('pk').values_list('pk', flat=True)[1]))
+
+        listed = Item.objects.get(name='listed-3')
+        items, _ = self._get('items', f'fields=price,name&cursor={listed.pk - 1}&limit=1')
+        self.assertEqual(items, [{'name': 'listed-3', 'price': 1.25}])
+
+        orders, _ = self._get('orders', 'fields=status, user&limit=1')
+        self.assertEqual(orders, [{'status': 'pending', 'user': 'user-0'}])
+
+    def test_unknown_fields_are_rejected(self):
+        error = self._error('users', 'fields=id,password')
+        self.assertIn("Unknown fields: password", error)
+        self.assertIn("Allowed: id, username, email", error)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0)
+class OrderLineValidationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='buyer', email='buyer@example.com')
+
+    def _order(self, items):
+        return self.client.post('/api/orders/', {'user_id': self.user.id, 'items': items},
+                                content_type='application/json')
+
+    def test_items_must_be_a_list(self):
+        response = self._order('abc')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], "items must be a list of {item_id, quantity} objects")
+
+    def test_lines_must_be_objects(self):
+        response = self._order([1, 2])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], "Invalid order line: 1")
+        self.assertFalse(Order.objects.exists())
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0)
+class ScarceStockRaceTests(TransactionTestCase):
+    STOCK = 5
+    BUYERS = 12
+
+    def setUp(self):
+        self.scarce = Item.objects.create(name='scarce', price=Decimal('10.00'), description='', stock=self.STOCK)
+        self.plentiful = Item.objects.create(name='plentiful', price=Decimal('1.00'), description='', stock=1000)
+        self.users = UserProfile.objects.bulk_create([
+            UserProfile(username=f"buyer-{i}", email=f"buyer-{i}@example.com") for i in range(self.BUYERS)
+        ])
+
+    def _race(self):
+        """Every buyer orders one scarce and one plentiful unit at once; returns the response statuses."""
+        barrier = threading.Barrier(self.BUYERS)
+        statuses = []
+        lock = threading.Lock()
+
+        def buy(user):
+            try:
+                client = Client()
+                barrier.wait()
+                response = client.post('/api/orders/', {
+                    'user_id': user.id,
+                    'items': [{'item_id': self.scarce.id, 'quantity': 1},
+                              {'item_id': self.plentiful.id, 'quantity': 1}],
+                }, content_type='application/json')
+                with lock:
+                    statuses.append(response.status_code)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=buy, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return statuses
+
+    def test_competing_orders_never_oversell(self):
+        statuses = self._race()
+        placed = statuses.count(201)
+
+        self.assertEqual(len(statuses), self.BUYERS)
+        self.assertLessEqual(placed, self.STOCK)
+        if connection.features.has_select_for_update:
+            # Buyers queue on the row lock instead of failing: all stock sells, the rest get 409
+            self.assertEqual(placed, self.STOCK)
+            self.assertEqual(statuses.count(409), self.BUYERS - self.STOCK)
+
+        # Rejected orders wrote nothing: no orders, no lines, no stock taken from either item
+        self.scarce.refresh_from_db()
+        self.plentiful.refresh_from_db()
+        self.assertEqual(self.scarce.stock, self.STOCK - placed)
+        self.assertEqual(self.plentiful.stock, 1000 - placed)
+        self.assertEqual(Order.objects.count(), placed)
+        self.assertEqual(OrderItem.objects.count(), placed * 2)
+
+
+class _CapturingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.addFilter(RequestIdFilter())
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@override_settings(ROOT_URLCONF='api.tests', ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0)
+class RequestIdIsolationTests(SimpleTestCase):
+    """Every log line must carry the ID of the request that logged it, however requests overlap."""
+    THREADS = 16
+    REQUESTS_PER_THREAD = 200
+    ASYNC_REQUESTS = 1000
+
+    def setUp(self):
+        self.handler = _CapturingHandler()
+        logger.addHandler(self.handler)
+        self.addCleanup(logger.removeHandler, self.handler)
+
+    def _assert_isolated(self, response_ids):
+        """``response_ids`` maps each request's marker to the X-Request-ID it was answered with."""
+        logged_ids = {record.marker: record.request_id for record in self.handler.records}
+        self.assertEqual(len(logged_ids), len(response_ids))
+        self.assertEqual(len(set(response_ids.values())), len(response_ids))
+        mismatched = [marker for marker, request_id in response_ids.items() if logged_ids.get(marker) != request_id]
+        self.assertFalse(mismatched, f"{len(mismatched)} of {len(response_ids)} log lines carried another request's ID")
+        # Nothing leaks back into the context that issued the requests
+        self.assertEqual(RequestContext.get_request_id(), 'no-request-id')
+
+    def test_threaded_requests(self):
+        response_ids = {}
+        lock = threading.Lock()
+        barrier = threading.Barrier(self.THREADS)
+
+        def worker(thread):
+            client = Client()
+            barrier.wait()
+            for i in range(self.REQUESTS_PER_THREAD):
+                marker = f"{thread}-{i}"
+                response = client.get('/log-marker/', {'n': marker})
+                with lock:
+                    response_ids[marker] = response['X-Request-ID']
+
+        threads = [threading.Thread(target=worker, args=(thread,)) for thread in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(response_ids), self.THREADS * self.REQUESTS_PER_THREAD)
+        self._assert_isolated(response_ids)
+
+    def _run_async_requests(self):
+        client = AsyncClient()
+
+        async def request(marker):
+            response = await client.get('/async-log-marker/', {'n': marker})
+            return marker, response['X-Request-ID']
+
+        async def run_all():
+            return await asyncio.gather(*(request(str(i)) for i in range(self.ASYNC_REQUESTS)))
+
+        response_ids = dict(asyncio.run(run_all()))
+        self.assertEqual(len(response_ids), self.ASYNC_REQUESTS)
+        self._assert_isolated(response_ids)
+
+    def test_concurrent_async_requests(self):
+        self._run_async_requests()
+
+    def test_concurrent_requests_through_async_api_middlewares(self):
+        # As with API_MIDDLEWARE_ASYNC, which is read when the module is imported
+        for func in (api_middleware.request_tracking_middleware, api_middleware.query_budget_middleware,
+                     api_middleware.memory_leak_middleware):
+            patcher = mock.patch.object(func, 'async_capable', True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        tracking_threads = set()
+        start_tracking = api_middleware._start_request_tracking
+
+        def spy(request, user):
+            tracking_threads.add(threading.current_thread())
+            return start_tracking(request, user)
+
+        with mock.patch.object(api_middleware, '_start_request_tracking', spy):
+            self._run_async_requests()
+
+        # The async path runs on the event loop, not in a sync_to_async worker thread
+        self.assertEqual(tracking_threads, {threading.main_thread()})
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0)
+class EndpointLabelCardinalityTests(TestCase):
+    def setUp(self):
+        # The label cap is process-wide; give each test a fresh one
+        saved = set(metrics._endpoint_labels)
+        metrics._endpoint_labels.clear()
+        self.addCleanup(metrics._endpoint_labels.update, saved)
+        self.addCleanup(metrics._endpoint_labels.clear)
+
+    def _endpoints(self):
+        metrics.recorder.flush()
+        return {sample.labels['endpoint'] for sample in metrics.http_requests_total.collect()[0].samples}
+
+    def _requests(self, endpoint, status_code):
+        metrics.recorder.flush()
+        return metrics.REGISTRY.get_sample_value(
+            'http_requests_total', {'method': 'GET', 'endpoint': endpoint, 'status_code': str(status_code)}
+        ) or 0
+
+    def test_random_paths_keep_series_bounded(self):
+        before = self._endpoints()
+        rng = random.Random(1234)
+        for i in range(10_000):
+            if i % 2:
+                self.client.get(f"/api/items/{rng.randrange(10 ** 9)}/")
+            else:
+                self.client.get(f"/{rng.getrandbits(64):x}/{rng.getrandbits(32):x}")
+
+        # 10k distinct paths, two new series: the item route template and unmatched paths
+        self.assertEqual(self._endpoints() - before, {'/api/items/<int:pk>/', metrics.UNMATCHED_ENDPOINT} - before)
+        self.assertLessEqual(len(metrics._endpoint_labels), 2)
+
+    @override_settings(METRICS_MAX_ENDPOINT_LABELS=2)
+    def test_routes_past_the_cap_fold_into_other(self):
+        other_before = self._requests(metrics.OVERFLOW_ENDPOINT, 200)
+        for route in ('/api/', '/api/health/live/', '/api/status/', '/api/health/ready/'):
+            self.assertEqual(self.client.get(route).status_code, 200)
+
+        self.assertEqual(metrics._endpoint_labels, {'/api/', '/api/health/live/'})
+        self.assertEqual(self._requests(metrics.OVERFLOW_ENDPOINT, 200) - other_before, 2)
+
+    def test_route_cache_follows_root_urlconf_changes(self):
+        self.assertEqual(api_middleware._route_for_path('/log-marker/', None), metrics.UNMATCHED_ENDPOINT)
+        with override_settings(ROOT_URLCONF='api.tests'):
+            self.assertEqual(api_middleware._route_for_path('/log-marker/', None), '/log-marker/')
+            self.assertEqual(api_middleware._route_for_path('/api/', None), metrics.UNMATCHED_ENDPOINT)
+        self.assertEqual(api_middleware._route_for_path('/log-marker/', None), metrics.UNMATCHED_ENDPOINT)
+        self.assertEqual(api_middleware._route_for_path('/api/', None), '/api/')
+
+
+class StubLoki:
+    """
+    Local stand-in for Loki's push endpoint.
+
+    Records every request with the client's address, so tests can tell which
+    connection it arrived on, and answers with the queued ``statuses`` (204
+    once they run out). Speaks HTTP/1.1, so clients can keep connections open.
+    """
+    def __init__(self, statuses=()):
+        self.requests = []
+        self.statuses = collections.deque(statuses)
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                stub.requests.append((self.client_address, dict(self.headers), body))
+                self.send_response(stub.statuses.popleft() if stub.statuses else 204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/loki/api/v1/push"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def payload(self, index):
+        """The decoded JSON push payload of request ``index``."""
+        _, headers, body = self.requests[index]
+        if headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return json.loads(body)
+
+    def pushed_lines(self):
+        """Every log line received so far, in push order."""
+        return [
+            value[1]
+            for index in range(len(self.requests))
+            for stream in self.payload(index)['streams']
+            for value in stream['values']
+        ]
+
+
+def make_record(message, level=logging.INFO, module='views', **extra):
+    record = logging.LogRecord('api', level, f"/app/api/{module}.py", 1, message, (), None)
+    record.__dict__.update(extra)
+    return record
+
+
+class LokiWireFormatTests(SimpleTestCase):
+    def setUp(self):
+        self.loki = StubLoki()
+        self.addCleanup(self.loki.close)
+
+    def _handler(self, **kwargs):
+        handler = LokiHandler(url=self.loki.url, mode='sync', batch_size=6, max_retries=0,
+                              record_format='structured', **kwargs)
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_batch_is_gzipped_with_one_stream_per_label_set(self):
+        handler = self._handler()
+        records = [make_record(f"info {i}", request_id=f"req-{i}") for i in range(4)]
+        records.insert(2, make_record("error 0", level=logging.ERROR, module='orders'))
+        records.append(make_record("error 1", level=logging.ERROR, module='orders'))
+        for record in records:
+            handler.emit(record)
+
+        self.assertEqual(len(self.loki.requests), 1)
+        _, headers, _ = self.loki.requests[0]
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Content-Type'], 'application/json')
+
+        streams = {
+            (stream['stream']['level'], stream['stream']['module']): stream['values']
+            for stream in self.loki.payload(0)['streams']
+        }
+        self.assertEqual(set(streams), {('info', 'views'), ('error', 'orders')})
+        # Values keep their logging order within a stream
+        self.assertEqual([json.loads(value[1])['message'] for value in streams[('info', 'views')]],
+                         ["info 0", "info 1", "info 2", "info 3"])
+        self.assertEqual(len(streams[('error', 'orders')]), 2)
+        # Request IDs travel as structured metadata, not stream labels
+        self.assertEqual(streams[('info', 'views')][1][2], {'request_id': 'req-1', 'user_id': 'anonymous'})
+
+    def test_uncompressed_pushes_are_plain_json(self):
+        handler = self._handler(compression=None)
+        for i in range(6):
+            handler.emit(make_record(f"line {i}"))
+
+        _, headers, _ = self.loki.requests[0]
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(len(self.loki.payload(0)['streams']), 1)
+
+    def test_pushes_reuse_one_connection(self):
+        handler = self._handler()
+        for i in range(18):
+            handler.emit(make_record(f"line {i}"))
+
+        self.assertEqual(len(self.loki.requests), 3)
+        self.assertEqual(len({client_address for client_address, _, _ in self.loki.requests}), 1)
+
+
+class LokiDeliveryFailureTests(SimpleTestCase):
+    def setUp(self):
+        spill_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spill_dir.cleanup)
+        self.spill_path = os.path.join(spill_dir.name, 'loki-spill.ndjson')
+        # The handler reports delivery problems with print()
+        stdout = contextlib.redirect_stdout(io.StringIO())
+        stdout.__enter__()
+        self.addCleanup(stdout.__exit__, None, None, None)
+
+    def _loki(self, statuses=()):
+        loki = StubLoki(statuses)
+        self.addCleanup(loki.close)
+        return loki
+
+    def _handler(self, loki, **kwargs):
+        options = dict(mode='sync', max_retries=1, backoff_base=0, breaker_threshold=2,
+                       breaker_reset_timeout=0.2, spill_path=self.spill_path, record_format='structured')
+        options.update(kwargs)
+        handler = LokiHandler(url=loki.url, **options)
+        self.addCleanup(handler.close)
+        return handler
+
+    def _batch(self, handler, *messages):
+        return [handler.build_entry(make_record(message)) for message in messages]
+
+    def _dropped(self, reason):
+        return metrics.REGISTRY.get_sample_value('loki_log_lines_dropped_total', {'reason': reason}) or 0
+
+    def _pushed_messages(self, loki):
+        return [json.loads(line)['message'] for line in loki.pushed_lines()]
+
+    def test_flapping_endpoint_trips_breaker_spills_and_replays(self):
+        loki = self._loki([503, 503])
+        handler = self._handler(loki)
+
+        # Both attempts fail: the breaker opens and the batch is parked on disk
+        handler._send_logs(self._batch(handler, "a", "b"))
+        self.assertEqual(handler.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(len(loki.requests), 2)
+        self.assertGreater(os.path.getsize(self.spill_path), 0)
+
+        # While open, pushes are short-circuited without touching the endpoint
+        handler._send_logs(self._batch(handler, "c"))
+        self.assertEqual(len(loki.requests), 2)
+
+        # After the reset timeout a half-open trial succeeds, closing the breaker,
+        # and the spilled batches are replayed behind it
+        time.sleep(0.25)
+        self.assertTrue(handler.breaker.allow_request())
+        self.assertEqual(handler.breaker.state, CircuitBreaker.HALF_OPEN)
+        handler._send_logs(self._batch(handler, "d"))
+
+        self.assertEqual(handler.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self._pushed_messages(loki), ["a", "b", "a", "b", "d", "a", "b", "c"])
+        self.assertFalse(os.path.exists(self.spill_path))
+
+    def test_failed_half_open_trial_reopens_breaker(self):
+        loki = self._loki([503, 503, 503])
+        handler = self._handler(loki)
+        handler._send_logs(self._batch(handler, "a"))
+        self.assertEqual(handler.breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.25)
+        handler._send_logs(self._batch(handler, "b"))
+
+        # One trial request, then straight back to open without a retry
+        self.assertEqual(len(loki.requests), 3)
+        self.assertEqual(handler.breaker.state, CircuitBreaker.OPEN)
+
+    def test_batches_past_the_spill_cap_are_dropped(self):
+        loki = self._loki([503] * 4)
+        handler = self._handler(loki, spill_max_bytes=1024, breaker_threshold=100)
+        dropped_before = self._dropped('spill_full')
+
+        handler._send_logs(self._batch(handler, "fits"))
+        spilled_size = os.path.getsize(self.spill_path)
+        handler._send_logs(self._batch(handler, *[f"overflow {i}" for i in range(10)]))
+
+        self.assertEqual(self._dropped('spill_full') - dropped_before, 10)
+        self.assertEqual(os.path.getsize(self.spill_path), spilled_size)
+        self.assertLessEqual(spilled_size, 1024)
+
+    def test_client_errors_are_dropped_without_retrying(self):
+        loki = self._loki([400])
+        handler = self._handler(loki)
+        dropped_before = self._dropped('rejected')
+
+        handler._send_logs(self._batch(handler, "a", "b", "c"))
+
+        self.assertEqual(len(loki.requests), 1)
+        self.assertEqual(self._dropped('rejected') - dropped_before, 3)
+        self.assertEqual(handler.breaker.state, CircuitBreaker.CLOSED)
+        self.assertFalse(os.path.exists(self.spill_path))
+
+
+class LokiAsyncShippingTests(SimpleTestCase):
+    def setUp(self):
+        spill_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spill_dir.cleanup)
+        self.spill_path = os.path.join(spill_dir.name, 'loki-spill.ndjson')
+        # The handler reports delivery problems with print()
+        stdout = contextlib.redirect_stdout(io.StringIO())
+        stdout.__enter__()
+        self.addCleanup(stdout.__exit__, None, None, None)
+        self.loki = StubLoki()
+        self.addCleanup(self.loki.close)
+
+    def _handler(self, **kwargs):
+        options = dict(url=self.loki.url, mode='async', batch_size=5, flush_interval=60, max_retries=0)
+        options.update(kwargs)
+        handler = LokiHandler(**options)
+        self.addCleanup(handler.close)
+        return handler
+
+    def _emit(self, handler, *messages):
+        for message in messages:
+            handler.emit(make_record(message))
+
+    def _queued(self, handler):
+        return [value[1] for _, value in handler._queue]
+
+    def _dropped(self, reason):
+        return metrics.REGISTRY.get_sample_value('loki_log_lines_dropped_total', {'reason': reason}) or 0
+
+    def _wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_close_ships_everything_queued(self):
+        handler = self._handler()
+        messages = [f"line {i}" for i in range(12)]
+        self._emit(handler, *messages)
+
+        handler.close()
+
+        self.assertEqual(self.loki.pushed_lines(), messages)
+        self.assertFalse(handler._worker.started())
+
+    def test_records_logged_after_close_are_shipped(self):
+        handler = self._handler()
+        self._emit(handler, "before close")
+        handler.close()
+
+        # Logging during shutdown (or a handler reused after close) restarts the shipper
+        self._emit(handler, "after close 1", "after close 2")
+        self.assertTrue(handler._worker.started())
+        handler.close()
+
+        self.assertEqual(self.loki.pushed_lines(), ["before close", "after close 1", "after close 2"])
+
+    def test_overflow_drops_oldest_or_newest(self):
+        for policy, kept in (('drop_oldest', ["2", "3", "4"]), ('drop_newest', ["0", "1", "2"])):
+            with self.subTest(policy=policy):
+                handler = self._handler(queue_size=3, overflow_policy=policy)
+                dropped_before = self._dropped('overflow')
+
+                # Keep the shipper stopped so the queue stays full
+                with mock.patch.object(handler._worker, 'ensure_started'):
+                    self._emit(handler, "0", "1", "2", "3", "4")
+
+                self.assertEqual(self._queued(handler), kept)
+                self.assertEqual(self._dropped('overflow') - dropped_before, 2)
+
+    def test_block_waits_for_room_then_drops(self):
+        handler = self._handler(queue_size=2, overflow_policy='block', block_timeout=0.05)
+        dropped_before = self._dropped('overflow')
+
+        with mock.patch.object(handler._worker, 'ensure_started'):
+            self._emit(handler, "0", "1")
+            start = time.monotonic()
+            self._emit(handler, "2")
+            self.assertGreaterEqual(time.monotonic() - start, 0.05)
+            self.assertEqual(self._queued(handler), ["0", "1"])
+            self.assertEqual(self._dropped('overflow') - dropped_before, 1)
+
+            # Room freed while the emitter waits lets the record in
+            handler.block_timeout = 5
+
+            def ship_one():
+                with handler._queue_lock:
+                    handler._queue.popleft()
+                    handler._not_full.notify_all()
+
+            timer = threading.Timer(0.05, ship_one)
+            timer.start()
+            self.addCleanup(timer.cancel)
+            start = time.monotonic()
+            self._emit(handler, "3")
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self._queued(handler), ["1", "3"])
+        self.assertEqual(self._dropped('overflow') - dropped_before, 1)
+
+    def test_shipper_spills_while_breaker_is_open_and_replays(self):
+        self.loki.statuses.extend([503, 503])
+        handler = self._handler(batch_size=2, max_retries=1, backoff_base=0, breaker_threshold=2,
+                                breaker_reset_timeout=0.2, spill_path=self.spill_path)
+
+        self._emit(handler, "a", "b")
+        self._wait_for(lambda: os.path.exists(self.spill_path))
+        self.assertEqual(handler.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(len(self.loki.requests), 2)
+
+        # Past the reset timeout the shipper's next push is the half-open trial
+        time.sleep(0.25)
+        self._emit(handler, "c")
+        handler.close()
+
+        self.assertEqual(handler.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.loki.pushed_lines(), ["a", "b", "a", "b", "c", "a", "b"])
+        self.assertFalse(os.path.exists(self.spill_path))
+
+    def test_forked_child_starts_with_an_empty_queue(self):
+        handler = self._handler()
+        with mock.patch.object(handler._worker, 'ensure_started'):
+            self._emit(handler, "queued by parent")
+        parent_lock = handler._queue_lock
+
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self._emit(handler, "logged by child")
+            self.assertIsNot(handler._queue_lock, parent_lock)
+            handler.close()
+
+        self.assertEqual(self.loki.pushed_lines(), ["logged by child"])
+
+
+class BackgroundThreadTests(SimpleTestCase):
+    def test_starts_once_per_process(self):
+        started = []
+        release = threading.Event()
+        thread = BackgroundThread(lambda: (started.append(os.getpid()), release.wait()), 'test-background',
+                                  before_start=lambda: started.append('before'))
+        self.addCleanup(release.set)
+
+        for _ in range(3):
+            thread.ensure_started()
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            # A forked child inherits the object but not the thread
+            self.assertFalse(thread.started())
+            thread.ensure_started()
+            thread.ensure_started()
+
+        release.set()
+        deadline = time.monotonic() + 5
+        while len(started) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(started.count('before'), 2)
+        self.assertEqual(len(started), 4)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0)
+class UserBatchConflictTests(TestCase):
+    def setUp(self):
+        self.existing = UserProfile.objects.create(username='old-name', email='taken@example.com')
+
+    def _ingest(self, on_conflict):
+        response = self.client.post(f'/api/users/batch/?on_conflict={on_conflict}', [
+            {"username": "new-a", "email": "a@example.com"},
+            {"username": "new-name", "email": "taken@example.com"},
+            {"username": "new-b", "email": "b@example.com"},
+        ], content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def _ids_by_email(self):
+        return dict(UserProfile.objects.values_list('email', 'id'))
+
+    def test_ignore_reports_ids_of_created_and_existing_rows(self):
+        results = self._ingest('ignore')
+        ids = self._ids_by_email()
+
+        self.assertEqual([(result['status'], result['id']) for result in results], [
+            ("created", ids['a@example.com']),
+            ("ignored", self.existing.id),
+            ("created", ids['b@example.com']),
+        ])
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.username, 'old-name')
+
+    def test_update_reports_updated_rows(self):
+        results = self._ingest('update')
+        ids = self._ids_by_email()
+
+        self.assertEqual([(result['status'], result['id']) for result in results], [
+            ("created", ids['a@example.com']),
+            ("updated", self.existing.id),
+            ("created", ids['b@example.com']),
+        ])
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.username, 'new-name')
+
+    def test_row_inserted_by_another_writer_is_not_reported_as_created(self):
+        # Another writer commits the same email between our chunk's INSERT and read-back
+        original_bulk_create = UserProfile.objects.bulk_create
+
+        def racing_bulk_create(objects, **kwargs):
+            UserProfile.objects.create(username='racer', email='a@example.com')
+            return original_bulk_create(objects, **kwargs)
+
+        with mock.patch.object(UserProfile.objects, 'bulk_create', side_effect=racing_bulk_create):
+            results = self._ingest('ignore')
+
+        self.assertEqual(results[0], {"index": 0, "status": "ignored", "id": self._ids_by_email()['a@example.com']})
+        self.assertEqual(results[2]['status'], "created")
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0)
+class QueryBudgetTests(TestCase):
+    @override_settings(QUERY_BUDGET={'queries': 50, 'db_time': 0.5},
+                       QUERY_BUDGET_ROUTES={'/r/': {'queries': 3}, 'POST /r/': {'queries': 7}})
+    def test_method_budget_overrides_route_budget(self):
+        self.assertEqual(query_budget.budget_for('/r/', 'GET'), {'queries': 3, 'db_time': 0.5})
+        self.assertEqual(query_budget.budget_for('/r/', 'POST'), {'queries': 7, 'db_time': 0.5})
+        self.assertEqual(query_budget.budget_for('/r/'), {'queries': 3, 'db_time': 0.5})
+
+    def test_first_order_and_order_page_stay_within_budget(self):
+        seed_orders(3)
+        user = UserProfile.objects.create(username='first-timer', email='first-timer@example.com')
+        item = Item.objects.first()
+
+        with self.assertNoLogs('api.middleware', level='WARNING'):
+            response = self.client.post('/api/orders/', {
+                'user_id': user.id, 'items': [{'item_id': item.id, 'quantity': 1}],
+            }, content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(self.client.get('/api/orders/').status_code, 200)
+
+
+class RecorderExitFlushTests(SimpleTestCase):
+    def test_buffered_updates_are_written_at_exit(self):
+        # A worker that exits right after recording, well within the flush
+        # interval, must still leave its updates in the multiprocess files
+        script = (
+            "import django; django.setup()\n"
+            "from api import metrics\n"
+            "metrics.recorder.inc(metrics.loki_log_lines_queued_total, (), 7)\n"
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR,
+                           env=dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory),
+                           check=True, timeout=60, capture_output=True)
+
+            registry = CollectorRegistry()
+            MultiProcessCollector(registry, path=directory)
+            self.assertEqual(registry.get_sample_value('loki_log_lines_queued_total'), 7)
+
+
+@override_settings(CATALOG_CACHE_LOCK_TIMEOUT=1)
+class CacheRecomputeLockTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = caching._cache()
+        self.cache.clear()
+        self.addCleanup(self.cache.clear)
+
+    def test_waiter_that_gives_up_leaves_the_other_process_lock(self):
+        # Another process holds the recompute lock and never delivers
+        self.cache.add('slow-key:lock', 'other-process', timeout=60)
+
+        value = caching.get_or_compute('test', 'slow-key', lambda: 'computed', ttl=60)
+
+        self.assertEqual(value, 'computed')
+        self.assertEqual(self.cache.get('slow-key:lock'), 'other-process')
+
+    def test_waiting_on_one_key_does_not_block_its_stripe(self):
+        # A different key guarded by the same in-process lock
+        stripe = caching._local_lock('slow-key')
+        neighbour = next(f"key-{n}" for n in itertools.count() if caching._local_lock(f"key-{n}") is stripe)
+        self.cache.add('slow-key:lock', 'other-process', timeout=60)
+
+        waiter = threading.Thread(target=caching.get_or_compute, args=('test', 'slow-key', lambda: 'slow', 60))
+        waiter.start()
+        self.addCleanup(waiter.join)
+        time.sleep(0.05)
+
+        start = time.monotonic()
+        self.assertEqual(caching.get_or_compute('test', neighbour, lambda: 'fast', ttl=60), 'fast')
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertTrue(waiter.is_alive())
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0)
+class HealthEndpointTests(TestCase):
+    def use_monitor(self, **kwargs):
+        monitor = health.HealthMonitor(ttl=60, **kwargs)
+        patcher = mock.patch.object(health, 'monitor', monitor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return monitor
+
+    def test_status_leaves_the_request_connection_alone(self):
+        self.use_monitor()
+        Item.objects.create(name="widget", description="", price=Decimal('1.00'), stock=1)
+
+        response = self.client.get('/api/status/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'operational')
+        self.assertIs(response.json()['active_connections'], True)
+        # The sample ran on the refresher's connection, not the test transaction's
+        self.assertTrue(connection.in_atomic_block)
+        self.assertEqual(Item.objects.count(), 1)
+
+    def test_live_and_ready(self):
+        self.use_monitor()
+
+        self.assertEqual(self.client.get('/api/health/live/').json(), {"status": "alive"})
+        response = self.client.get('/api/health/ready/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            "status": "ready", "database_ok": True, "stale": False, "warming_up": False,
+        })
+        self.assertEqual(Item.objects.count(), 0)
+
+    def test_not_ready_while_warming_up(self):
+        monitor = self.use_monitor(warmup_timeout=0.01)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        original_sample = monitor._sample
+
+        def slow_sample():
+            release.wait()
+            return original_sample()
+
+        with mock.patch.object(monitor, '_sample', slow_sample):
+            ready = self.client.get('/api/health/ready/')
+            status = self.client.get('/api/status/')
+
+        self.assertEqual(ready.status_code, 503)
+        self.assertTrue(ready.json()['warming_up'])
+        self.assertEqual(status.json()['status'], 'warming_up')
+
+    def test_not_ready_when_stale(self):
+        monitor = self.use_monitor()
+        self.client.get('/api/health/ready/')
+        monitor._snapshot = dict(monitor._snapshot, sampled_at=time.monotonic() - 3600)
+
+        response = self.client.get('/api/health/ready/')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(response.json()['stale'])
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], MEMORY_LEAK_PROBABILITY=0)
+class CatalogInvalidationTests(TestCase):
+    def setUp(self):
+        self.cache = caching._cache()
+        self.cache.clear()
+        self.addCleanup(self.cache.clear)
+        self.item = Item.objects.create(name="widget", description="", price=Decimal('2.50'), stock=10)
+
+    def listed(self):
+        return {row['id']: row for row in self.client.get('/api/items/').json()['items']}
+
+    def detail(self, pk):
+        return self.client.get(f'/api/items/{pk}/')
+
+    def warm(self):
+        self.assertIn(self.item.pk, self.listed())
+        self.assertEqual(self.detail(self.item.pk).status_code, 200)
+
+    def test_item_save_invalidates_list_and_item(self):
+        self.warm()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.stock = 3
+            self.item.save()
+
+        self.assertEqual(self.listed()[self.item.pk]['stock'], 3)
+        self.assertEqual(self.detail(self.item.pk).json()['stock'], 3)
+
+    def test_item_delete_invalidates_list_and_item(self):
+        self.warm()
+        pk = self.item.pk
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.delete()
+
+        self.assertNotIn(pk, self.listed())
+        self.assertEqual(self.detail(pk).status_code, 404)
+
+    def test_new_item_is_visible_after_a_miss_for_its_pk(self):
+        self.warm()
+        self.assertEqual(self.detail(self.item.pk + 1).status_code, 404)
+        with self.captureOnCommitCallbacks(execute=True):
+            created = Item.objects.create(name="gadget", description="", price=Decimal('1.00'), stock=1)
+
+        self.assertEqual(created.pk, self.item.pk + 1)
+        self.assertIn(created.pk, self.listed())
+        self.assertEqual(self.detail(created.pk).json()['name'], "gadget")
+
+    def test_batch_ingest_invalidates_the_list_only(self):
+        self.warm()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/items/batch/', [
+                {"name": "bolt", "price": "0.10"}, {"name": "nut", "price": "0.05"},
+            ], content_type='application/json')
+        new_pks = [result['id'] for result in response.json()['results']]
+
+        self.assertTrue(set(new_pks) <= set(self.listed()))
+        for pk in new_pks:
+            self.assertIsNone(self.cache.get(caching._item_version_key(pk)))
+
+    def test_order_stock_decrement_invalidates_list_and_item(self):
+        user = UserProfile.objects.create(username='buyer', email='buyer@example.com')
+        self.warm()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/orders/', {
+                'user_id': user.id, 'items': [{'item_id': self.item.pk, 'quantity': 4}],
+            }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(self.listed()[self.item.pk]['stock'], 6)
+        self.assertEqual(self.detail(self.item.pk).json()['stock'], 6)
+
+    def test_version_keys_expire(self):
+        with mock.patch.object(self.cache, 'add', wraps=self.cache.add) as add:
+            self.detail(10_000)
+
+        version_key = caching._item_version_key(10_000)
+        timeouts = [call.kwargs['timeout'] for call in add.call_args_list if call.args[0] == version_key]
+        self.assertEqual(timeouts, [300])
+
+
+class StatementFingerprintTests(SimpleTestCase):
+    def test_literals_and_list_lengths_share_a_fingerprint(self):
+        fingerprints = {
+            db_instrumentation.normalize(sql) for sql in (
+                'SELECT "id" FROM "api_item" WHERE "id" IN (%s, %s) AND "name" = \'bolt\' LIMIT 21',
+                'SELECT "id" FROM "api_item" WHERE "id" IN (%s, %s, %s, %s) AND "name" = \'it\'\'s\' LIMIT 5',
+                'SELECT  "id" FROM "api_item"\n WHERE "id" IN (7, 8) AND "name" = %s LIMIT 1',
+            )
+        }
+        self.assertEqual(fingerprints, {'SELECT "id" FROM "api_item" WHERE "id" IN (?, ...) AND "name" = ? LIMIT ?'})
+
+    def test_multi_row_values_collapse(self):
+        self.assertEqual(
+            db_instrumentation.normalize('INSERT INTO "api_order" ("user_id", "status") VALUES (%s, %s), (%s, %s)'),
+            'INSERT INTO "api_order" ("user_id", "status") VALUES (?, ...), ...',
+        )
+
+    def test_classify(self):
+        cases = {
+            'SELECT "api_item"."id" FROM "api_item" WHERE "id" = ?': ('SELECT', 'api_item'),
+            'SELECT COUNT(*) FROM "api_order"': ('SELECT', 'api_order'),
+            'INSERT INTO "api_order" ("user_id") VALUES (?)': ('INSERT', 'api_order'),
+            'UPDATE "api_item" SET "stock" = "stock" - ? WHERE "id" = ?': ('UPDATE', 'api_item'),
+            'DELETE FROM "api_order" WHERE "id" = ?': ('DELETE', 'api_order'),
+            'SAVEPOINT "s1_x2"': ('SAVEPOINT', 'none'),
+            'SELECT ?': ('SELECT', 'none'),
+        }
+        for fingerprint, labels in cases.items():
+            with self.subTest(fingerprint):
+                self.assertEqual(db_instrumentation.classify(fingerprint), labels)
+
+
+class RepeatedSelectTests(TestCase):
+    def test_repeated_selects_are_flagged_most_frequent_first(self):
+        stats = db_instrumentation.QueryStats()
+        for _ in range(12):
+            stats.record('SELECT * FROM "a" WHERE "id" = ?', 'SELECT', 'a', 0.001)
+        for _ in range(10):
+            stats.record('SELECT * FROM "b" WHERE "id" = ?', 'SELECT', 'b', 0.002)
+        for _ in range(9):
+            stats.record('SELECT * FROM "c" WHERE "id" = ?', 'SELECT', 'c', 0.001)
+        for _ in range(20):
+            stats.record('UPDATE "a" SET "x" = ? WHERE "id" = ?', 'UPDATE', 'a', 0.001)
+
+        self.assertEqual([fingerprint for fingerprint, _, _ in stats.repeated_selects(10)], [
+            'SELECT * FROM "a" WHERE "id" = ?', 'SELECT * FROM "b" WHERE "id" = ?',
+        ])
+        self.assertEqual(stats.count, 51)
+
+    def test_n_plus_one_through_the_orm_is_detected_without_logging_each_statement(self):
+        seed_orders(12)
+        stats, token = db_instrumentation.start_request('test-request')
+        try:
+            with self.assertNoLogs('api.metrics', level='DEBUG'):
+                # One query for the orders, then one per order for its user
+                usernames = [order.user.username for order in Order.objects.all()]
+        finally:
+            db_instrumentation.finish_request(token)
+
+        self.assertEqual(len(usernames), 12)
+        self.assertEqual(stats.count, 13)
+        [(fingerprint, executions, _)] = stats.repeated_selects(10)
+        self.assertEqual(executions, 12)
+        self.assertIn('FROM "api_userprofile"', fingerprint)
+
+
+class OrderStatusCountTests(TestCase):
+    def setUp(self):
+        self.counts = order_stats.order_status_counts
+        # The reconciler thread's connection can't see this test's transaction
+        patcher = mock.patch.object(self.counts._reconciler, 'ensure_started')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.keys = [self.counts._key(bucket) for bucket in self.counts._buckets()]
+        self.counts.cache.delete_many(self.keys)
+        self.addCleanup(self.counts.cache.delete_many, self.keys)
+        self.user = UserProfile.objects.create(username='counted', email='counted@example.com')
+
+    def _expected(self, **counts):
+        return dict(dict.fromkeys(self.counts._buckets(), 0), **counts)
+
+    def _drift(self):
+        return metrics.REGISTRY.get_sample_value('order_status_drift_total') or 0
+
+    def test_unseeded_counts_are_seeded_by_the_first_read_not_by_commits(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(user=self.user, status='pending')
+            Order.objects.create(user=self.user, status='shipped')
+        self.assertEqual(self.counts.cache.get_many(self.keys), {})
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.counts.counts(), self._expected(pending=1, other=1))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.counts.counts(), self._expected(pending=1, other=1))
+
+    def test_signals_move_orders_between_seeded_counts(self):
+        Order.objects.create(user=self.user, status='pending')
+        self.counts.counts()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.create(user=self.user, status='pending')
+        self.assertEqual(self.counts.counts(), self._expected(pending=2))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order.status = 'completed'
+            order.save()
+        self.assertEqual(self.counts.counts(), self._expected(pending=1, completed=1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order.delete()
+        self.assertEqual(self.counts.counts(), self._expected(pending=1))
+
+        # Changes roll back with their transaction
+        with self.captureOnCommitCallbacks(execute=False):
+            Order.objects.create(user=self.user, status='cancelled')
+        self.assertEqual(self.counts.counts(), self._expected(pending=1))
+
+    def test_reconcile_corrects_writes_that_bypass_signals(self):
+        Order.objects.create(user=self.user, status='pending')
+        Order.objects.create(user=self.user, status='pending')
+        self.counts.counts()
+        drift_before = self._drift()
+
+        Order.objects.update(status='abandoned')
+        self.assertEqual(self.counts.counts(), self._expected(pending=2))
+
+        with self.assertLogs('api.order_stats', level='WARNING'):
+            self.assertEqual(self.counts.reconcile(), self._expected(abandoned=2))
+        self.assertEqual(self.counts.counts(), self._expected(abandoned=2))
+        self.assertEqual(self._drift() - drift_before, 4)
+
+    def test_collector_is_shared_only_with_a_cache_all_workers_see(self):
+        self.assertFalse(order_stats._cache_is_shared('default'))
+        with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': 'redis://127.0.0.1:6379/0',
+        }}):
+            self.assertTrue(order_stats._cache_is_shared('default'))
+
+
+class OrderLeaderboardTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = UserProfile.objects.create(username='alice', email='alice@example.com')
+        cls.bob = UserProfile.objects.create(username='bob', email='bob@example.com')
+
+    def test_counts_follow_order_create_cancel_and_delete(self):
+        alice_orders = [Order.objects.create(user=self.alice) for _ in range(3)]
+        bob_order = Order.objects.create(user=self.bob)
+        self.assertEqual(leaderboard.top_users(), [('alice', 3), ('bob', 1)])
+
+        # Cancelled orders still count, as they did when the leaderboard aggregated the order table
+        alice_orders[0].status = 'cancelled'
+        alice_orders[0].save()
+        self.assertEqual(leaderboard.top_users(), [('alice', 3), ('bob', 1)])
+
+        alice_orders[1].delete()
+        bob_order.delete()
+        self.assertEqual(leaderboard.top_users(), [('alice', 2)])
+        self.assertEqual(UserOrderCount.objects.get(user=self.bob).order_count, 0)
+
+    def test_ties_are_ordered_by_user_and_limited(self):
+        Order.objects.create(user=self.bob)
+        Order.objects.create(user=self.alice)
+        self.assertEqual(leaderboard.top_users(), [('alice', 1), ('bob', 1)])
+        self.assertEqual(leaderboard.top_users(limit=1), [('alice', 1)])
+
+    def test_rebuild_command_recounts_from_the_order_table(self):
+        for _ in range(3):
+            Order.objects.create(user=self.alice)
+        # Drift: a stale count, and orders inserted without signals
+        UserOrderCount.objects.filter(user=self.alice).update(order_count=99)
+        Order.objects.bulk_create([Order(user=self.bob, status='pending') for _ in range(2)])
+        carol = UserProfile.objects.create(username='carol', email='carol@example.com')
+        UserOrderCount.objects.create(user=carol, order_count=5)
+
+        out = io.StringIO()
+        call_command('rebuild_order_leaderboard', chunk_size=1, stdout=out)
+
+        self.assertIn("Rebuilt order counts for 2 users", out.getvalue())
+        self.assertEqual(leaderboard.top_users(), [('alice', 3), ('bob', 2)])
+        self.assertFalse(UserOrderCount.objects.filter(user=carol).exists())
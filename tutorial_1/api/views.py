@@ -2,17 +2,13 @@ import time
 import random
 import logging
 import json
-import psutil
-import os
 from django.http import JsonResponse, HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from django.views.decorators.csrf import csrf_exempt
 from django.db import connection
-from django.db.backends.signals import connection_created
-from django.dispatch import receiver
-from django.core.cache import cache
-from django.contrib.auth.models import User
+from django.db.models import DecimalField, F, Prefetch, Sum
 from .models import UserProfile, Item, Order, OrderItem
-from . import metrics
+from . import batch, caching, health, leaderboard, metrics, orders, pagination, streaming
 
 logger = logging.getLogger(__name__)
 
@@ -21,8 +17,13 @@ def api_root(request):
     """Root API endpoint that lists available endpoints."""
     endpoints = {
         "status": "/api/status/",
+        "liveness": "/api/health/live/",
+        "readiness": "/api/health/ready/",
         "users": "/api/users/",
+        "users_batch": "/api/users/batch/",
         "items": "/api/items/",
+        "items_batch": "/api/items/batch/",
+        "item_detail": "/api/items/<id>/",
         "orders": "/api/orders/",
         "slow_endpoint": "/api/slow-query/",
         "memory_leak": "/api/leak-simulation/",
@@ -31,56 +32,141 @@ def api_root(request):
     return JsonResponse({"available_endpoints": endpoints})
 
 def status(request):
-    """Simple status endpoint that returns system metrics."""
-    process = psutil.Process(os.getpid())
-    memory_info = process.memory_info()
-    
-    metrics.update_memory_usage(memory_info.rss)
+    """
+    Simple status endpoint that returns system metrics.
+
+    Served from the health monitor's cached snapshot, so it never samples the
+    process or touches the database itself.
+    """
+    snapshot = health.get_health_snapshot()
     
     status_data = {
-        "status": "operational",
-        "memory_usage_mb": memory_info.rss / (1024 * 1024),
-        "cpu_percent": process.cpu_percent(interval=0.1),
-        "thread_count": process.num_threads(),
-        "active_connections": is_connection_active(),
+        "status": "warming_up" if snapshot["warming_up"] else "operational",
+        "memory_usage_mb": snapshot["memory_usage_mb"],
+        "cpu_percent": snapshot["cpu_percent"],
+        "thread_count": snapshot["thread_count"],
+        "active_connections": snapshot["database_ok"],
     }
     
     logger.info("Status check performed", extra=status_data)
     return JsonResponse(status_data)
 
+def liveness(request):
+    """Cheap liveness probe: answers as long as the worker can serve requests."""
+    return JsonResponse({"status": "alive"})
+
+def readiness(request):
+    """
+    Readiness probe backed by the cached health snapshot.
+
+    Reports 503 when the database check failed, the snapshot has gone stale or
+    the worker hasn't taken its first sample yet.
+    """
+    snapshot = health.get_health_snapshot()
+    ready = snapshot["database_ok"] and not snapshot["stale"]
+    
+    return JsonResponse({
+        "status": "ready" if ready else "unavailable",
+        "database_ok": snapshot["database_ok"],
+        "stale": snapshot["stale"],
+        "warming_up": snapshot["warming_up"],
+    }, status=200 if ready else 503)
+
+USER_FIELDS = ("id", "username", "email", "created_at", "last_login")
+ITEM_FIELDS = ("id", "name", "price", "description", "stock")
+ORDER_FIELDS = ("id", "user", "status", "created_at", "items", "total_value")
+
+# Per-field conversions for values() rows that JsonResponse would render differently
+FIELD_CONVERTERS = {
+    "price": float,
+}
+
+def _project_row(row, fields):
+    """Keep only the requested fields of a values() row, converting where needed."""
+    return {field: FIELD_CONVERTERS.get(field, _identity)(row[field]) for field in fields}
+
+def _project_rows(rows, fields):
+    return [_project_row(row, fields) for row in rows]
+
+def _identity(value):
+    return value
+
+def _list_page(request, queryset, allowed_fields, default_fields):
+    """Fetch one keyset page of a values() projection for a list endpoint."""
+    cursor, limit, fields = pagination.parse_list_params(request, allowed_fields, default_fields)
+    return _fetch_page(queryset, cursor, limit, fields)
+
+def _fetch_page(queryset, cursor, limit, fields):
+    # The primary key is always fetched because the cursor is built from it
+    rows, next_cursor = pagination.paginate(
+        queryset.values(*dict.fromkeys(("id", *fields))), cursor, limit
+    )
+    return _project_rows(rows, fields), next_cursor
+
+def _stream_export(request, queryset_for, allowed_fields, default_fields, key, to_dict=None):
+    """
+    Stream every row of ``queryset_for(fields)`` (from ``cursor`` on) as NDJSON or JSON.
+
+    The queryset is built from the validated ``fields``, so it loads exactly
+    what serialization needs. Rows are read with ``iterator()``, which uses a
+    server-side cursor on PostgreSQL, so neither the queryset cache nor the
+    response holds the whole result. Without ``to_dict`` the queryset is
+    exported as a values() projection; otherwise ``to_dict(obj, fields)``
+    serializes each object.
+    """
+    stream_format = request.GET['stream']
+    if stream_format not in streaming.STREAM_FORMATS:
+        return JsonResponse({"error": f"Unknown stream format: {stream_format}. "
+                                      f"Allowed: {', '.join(streaming.STREAM_FORMATS)}"}, status=400)
+    try:
+        cursor, _, fields = pagination.parse_list_params(request, allowed_fields, default_fields)
+    except pagination.PaginationError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    queryset = queryset_for(fields).order_by('pk')
+    if cursor is not None:
+        queryset = queryset.filter(pk__gt=cursor)
+
+    if to_dict is None:
+        objects = queryset.values(*fields).iterator(chunk_size=streaming.export_chunk_size())
+        rows = (_project_row(row, fields) for row in objects)
+    else:
+        objects = queryset.iterator(chunk_size=streaming.export_chunk_size())
+        rows = (to_dict(obj, fields) for obj in objects)
+
+    logger.info(f"Streaming {key} export started", extra={"stream_format": stream_format, "fields": fields})
+    return streaming.streaming_export(rows, stream_format, key)
+
 @csrf_exempt
 def user_list(request):
-    """API endpoint for user management."""
+    """
+    API endpoint for user management.
+
+    GET is paginated by keyset (``cursor``/``limit``) and supports ``fields``
+    projection, e.g. ``/api/users/?fields=id,email&limit=500``.
+    """
     if request.method == 'GET':
-        # Time this database query
-        start_time = time.time()
-        users = UserProfile.objects.all()
-        user_list = [{"id": user.id, "username": user.username, "email": user.email} for user in users]
-        duration = time.time() - start_time
-        
-        # Track the query in our metrics
-        metrics.track_db_query('SELECT', 'user_profile', duration)
+        try:
+            user_list, next_cursor = _list_page(
+                request, UserProfile.objects.all(), USER_FIELDS, ("id", "username", "email")
+            )
+        except pagination.PaginationError as e:
+            return JsonResponse({"error": str(e)}, status=400)
         
-        metrics.active_users_total.set(len(user_list))
+        metrics.update_active_users(UserProfile.objects.count)
         
-        return JsonResponse({"users": user_list})
+        return JsonResponse({"users": user_list, "next_cursor": next_cursor})
     
     elif request.method == 'POST':
         try:
             data = json.loads(request.body)
             
-            # Start timing
-            start_time = time.time()
-            
             # Create user
             user = UserProfile.objects.create(
                 username=data.get('username'),
                 email=data.get('email')
             )
             
-            duration = time.time() - start_time
-            metrics.track_db_query('INSERT', 'user_profile', duration)
-            
             logger.info(f"User created: {user.username}", 
                         extra={"user_id": user.id, "email": user.email})
             
@@ -92,36 +178,47 @@ def user_list(request):
 
 @csrf_exempt
 def item_list(request):
-    """API endpoint for item management."""
+    """
+    API endpoint for item management.
+
+    GET is paginated by keyset (``cursor``/``limit``) and supports ``fields``
+    projection, e.g. ``/api/items/?fields=id,price``. Pages are served through
+    the read-through catalog cache, which item writes invalidate.
+    ``?stream=ndjson`` or ``?stream=json`` exports every item as a streamed
+    response instead, straight from the database.
+    """
+    if request.method == 'GET' and 'stream' in request.GET:
+        return _stream_export(request, lambda fields: Item.objects.all(), ITEM_FIELDS,
+                              ("id", "name", "price", "stock"), "items")
+    
     if request.method == 'GET':
-        # Simulate occasional slow queries
-        if random.random() < 0.1:
-            time.sleep(0.5)
-        
-        start_time = time.time()
-        items = Item.objects.all()
-        item_list = [{"id": item.id, "name": item.name, "price": float(item.price), "stock": item.stock} 
-                     for item in items]
-        duration = time.time() - start_time
+        try:
+            cursor, limit, fields = pagination.parse_list_params(
+                request, ITEM_FIELDS, ("id", "name", "price", "stock")
+            )
+        except pagination.PaginationError as e:
+            return JsonResponse({"error": str(e)}, status=400)
         
-        metrics.track_db_query('SELECT', 'item', duration)
+        def load_page():
+            # Simulate occasional slow queries
+            if random.random() < 0.1:
+                time.sleep(0.5)
+            
+            item_list, next_cursor = _fetch_page(Item.objects.all(), cursor, limit, fields)
+            return {"items": item_list, "next_cursor": next_cursor}
         
-        return JsonResponse({"items": item_list})
+        return JsonResponse(caching.get_item_page((cursor, limit, ",".join(fields)), load_page))
     
     elif request.method == 'POST':
         try:
             data = json.loads(request.body)
             
-            start_time = time.time()
             item = Item.objects.create(
                 name=data.get('name'),
                 price=data.get('price'),
                 description=data.get('description', ''),
                 stock=data.get('stock', 0)
             )
-            duration = time.time() - start_time
-            
-            metrics.track_db_query('INSERT', 'item', duration)
             
             return JsonResponse({
                 "id": item.id, 
@@ -133,102 +230,181 @@ def item_list(request):
             logger.error(f"Error creating item: {str(e)}")
             return JsonResponse({"error": str(e)}, status=400)
 
+def item_detail(request, pk):
+    """Single item lookup, served through the read-through catalog cache."""
+    if request.method != 'GET':
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    
+    def load_item():
+        row = Item.objects.filter(pk=pk).values(*ITEM_FIELDS).first()
+        return None if row is None else _project_row(row, ITEM_FIELDS)
+    
+    item = caching.get_item(pk, load_item)
+    if item is None:
+        return JsonResponse({"error": "Item not found"}, status=404)
+    return JsonResponse(item)
+
+def _batch_response(results, parse_errors):
+    """Merge body-level parse errors into the per-row results and summarize them."""
+    results = results + [
+        {"index": index, "status": "invalid", "errors": {"row": [message]}}
+        for index, message in parse_errors.items()
+    ]
+    results.sort(key=lambda result: result["index"])
+    return JsonResponse({"summary": batch.summarize(results), "results": results})
+
+@csrf_exempt
+def user_batch(request):
+    """
+    Bulk user ingestion.
+
+    POST a JSON array of ``{"username", "email"}`` objects, or the same objects
+    as NDJSON (``Content-Type: application/x-ndjson``). Rows are validated up
+    front and written in chunked bulk INSERTs that upsert on ``email``;
+    ``?on_conflict=ignore`` keeps existing users unchanged instead. Every input
+    row gets a result with its index and status.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    
+    on_conflict = request.GET.get('on_conflict', 'update')
+    if on_conflict not in batch.CONFLICT_MODES:
+        return JsonResponse({"error": f"on_conflict must be one of {', '.join(batch.CONFLICT_MODES)}"}, status=400)
+    
+    try:
+        rows, parse_errors = batch.parse_batch_body(request)
+    except batch.BatchError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+    
+    start_time = time.time()
+    results = batch.ingest_users(rows, on_conflict=on_conflict)
+    duration = time.time() - start_time
+    
+    logger.info(f"Ingested {len(rows)} user rows in {duration:.3f}s",
+                extra={"rows": len(rows), "invalid": len(parse_errors)})
+    
+    return _batch_response(results, parse_errors)
+
+@csrf_exempt
+def item_batch(request):
+    """
+    Bulk item ingestion.
+
+    POST a JSON array or NDJSON of ``{"name", "price", "description", "stock"}``
+    objects. Valid rows are written in chunked bulk INSERTs; invalid rows are
+    reported per index without failing the rest of the batch.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    
+    try:
+        rows, parse_errors = batch.parse_batch_body(request)
+    except batch.BatchError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+    
+    start_time = time.time()
+    results = batch.ingest_items(rows)
+    duration = time.time() - start_time
+    
+    logger.info(f"Ingested {len(rows)} item rows in {duration:.3f}s",
+                extra={"rows": len(rows), "invalid": len(parse_errors)})
+    
+    return _batch_response(results, parse_errors)
+
+def _order_queryset(fields):
+    """
+    Orders with only the related data the requested ``fields`` need.
+
+    Users are joined in, order lines and their items come from a single
+    prefetch query, and order totals are summed by the database.
+    """
+    # The order's own columns are narrow; projection decides which joins run
+    queryset = Order.objects.all()
+    only_fields = ["id", "status", "created_at"]
+    if "user" in fields:
+        queryset = queryset.select_related('user')
+        only_fields.append('user__username')
+    queryset = queryset.only(*only_fields)
+    if "items" in fields:
+        queryset = queryset.prefetch_related(
+            Prefetch('orderitem_set', queryset=OrderItem.objects.select_related('item'))
+        )
+    if "total_value" in fields:
+        queryset = queryset.annotate(total_value=Sum(
+            F('orderitem__item__price') * F('orderitem__quantity'),
+            output_field=DecimalField(max_digits=20, decimal_places=2)
+        ))
+    return queryset
+
+def _order_to_dict(order, fields):
+    """Serialize an order from ``_order_queryset`` with the requested fields."""
+    row = {}
+    for field in fields:
+        if field == "id":
+            row["id"] = order.id
+        elif field == "user":
+            row["user"] = order.user.username
+        elif field == "status":
+            row["status"] = order.status
+        elif field == "created_at":
+            row["created_at"] = order.created_at.isoformat()
+        elif field == "items":
+            row["items"] = [
+                {
+                    "item_name": order_item.item.name,
+                    "quantity": order_item.quantity,
+                    "unit_price": float(order_item.item.price),
+                    "total": float(order_item.item.price) * order_item.quantity
+                }
+                for order_item in order.orderitem_set.all()
+            ]
+        elif field == "total_value":
+            row["total_value"] = float(order.total_value or 0)
+    return row
+
 @csrf_exempt
 def order_list(request):
-    """API endpoint for order management."""
+    """
+    API endpoint for order management.
+
+    GET is paginated by keyset (``cursor``/``limit``) and supports ``fields``
+    projection; related rows are only loaded for the fields that need them.
+    ``?stream=ndjson`` or ``?stream=json`` exports every order as a streamed
+    response instead. Reads have no metric side effects: order status counts
+    and the abandonment rate are maintained by ``api.order_stats``.
+    """
+    if request.method == 'GET' and 'stream' in request.GET:
+        return _stream_export(request, _order_queryset, ORDER_FIELDS,
+                              ORDER_FIELDS, "orders", to_dict=_order_to_dict)
+    
     if request.method == 'GET':
-        # This query is intentionally inefficient to show N+1 query problems
-        start_time = time.time()
-        orders = Order.objects.all()
-        
-        # Detailed information requires fetching related models
-        order_list = []
-        for order in orders:
-            order_items = []
-            total_value = 0
-            
-            # N+1 query problem here (not using select_related/prefetch_related)
-            for order_item in OrderItem.objects.filter(order=order):
-                item = order_item.item
-                item_total = float(item.price) * order_item.quantity
-                total_value += item_total
-                
-                order_items.append({
-                    "item_name": item.name,
-                    "quantity": order_item.quantity,
-                    "unit_price": float(item.price),
-                    "total": item_total
-                })
-            
-            order_list.append({
-                "id": order.id,
-                "user": order.user.username,
-                "status": order.status,
-                "created_at": order.created_at.isoformat(),
-                "items": order_items,
-                "total_value": total_value
-            })
-            
-            # Track order value in metrics
-            metrics.order_value_total.labels(status=order.status).observe(total_value)
-            
-        duration = time.time() - start_time
-        
-        # This query was slow, let's track it
-        if duration > 0.1:  # 100ms threshold
-            logger.warning(f"Slow order query detected: {duration:.4f}s",
-                          extra={"query_time": duration, "order_count": len(orders)})
-        
-        metrics.track_db_query('SELECT', 'order', duration)
+        try:
+            cursor, limit, fields = pagination.parse_list_params(request, ORDER_FIELDS)
+        except pagination.PaginationError as e:
+            return JsonResponse({"error": str(e)}, status=400)
         
-        # Calculate cart abandonment rate (simplified example)
-        abandoned = Order.objects.filter(status='abandoned').count()
-        total = Order.objects.count()
-        if total > 0:
-            abandonment_rate = abandoned / total
-            metrics.cart_abandonment_rate.set(abandonment_rate)
+        order_page, next_cursor = pagination.paginate(_order_queryset(fields), cursor, limit)
+        order_list = [_order_to_dict(order, fields) for order in order_page]
         
-        return JsonResponse({"orders": order_list})
+        return JsonResponse({"orders": order_list, "next_cursor": next_cursor})
     
     elif request.method == 'POST':
         try:
             data = json.loads(request.body)
             
-            # Creating an order involves multiple DB operations
-            start_time = time.time()
-            
             # Get the user
             try:
                 user = UserProfile.objects.get(id=data.get('user_id'))
             except UserProfile.DoesNotExist:
                 return JsonResponse({"error": "User not found"}, status=404)
             
-            # Create the order
-            order = Order.objects.create(
-                user=user,
-                status=data.get('status', 'pending')
-            )
-            
-            # Add items to the order
-            total_value = 0
-            for item_data in data.get('items', []):
-                try:
-                    item = Item.objects.get(id=item_data.get('item_id'))
-                    quantity = item_data.get('quantity', 1)
-                    
-                    OrderItem.objects.create(
-                        order=order,
-                        item=item,
-                        quantity=quantity
-                    )
-                    
-                    total_value += float(item.price) * quantity
-                    
-                except Item.DoesNotExist:
-                    logger.warning(f"Item {item_data.get('item_id')} not found for order {order.id}")
-            
-            duration = time.time() - start_time
-            metrics.track_db_query('INSERT', 'order', duration)
+            # Create the order, its lines and the stock reservation in one transaction
+            try:
+                quantities = orders.parse_order_lines(data.get('items', []))
+                order, total_value = orders.create_order(user, data.get('status', 'pending'), quantities)
+            except orders.OrderRejected as e:
+                logger.warning(f"Order rejected for user {user.id}: {str(e)}", extra=e.details)
+                return JsonResponse({"error": str(e), **e.details}, status=e.status)
             
             # Track order value
             metrics.order_value_total.labels(status=order.status).observe(total_value)
@@ -244,40 +420,52 @@ def order_list(request):
 
 def slow_query(request):
     """
-    Endpoint that intentionally performs a slow database query.
-    This demonstrates how to identify problematic queries with monitoring.
+    Endpoint that used to aggregate every order per user on each call.
+
+    The per-user order counts are now maintained incrementally in
+    ``UserOrderCount`` (see ``api.leaderboard``), so the top ``?limit=``
+    users (default 10) come from an index scan instead of a full GROUP BY.
+    The simulated processing delay is kept for the monitoring demo.
     """
     logger.info("Starting slow query execution")
     
-    # Simulate a complex, inefficient query
-    start_time = time.time()
+    try:
+        limit = int(request.GET.get('limit', 10))
+    except ValueError:
+        return JsonResponse({"error": f"Invalid limit: {request.GET.get('limit')}"}, status=400)
+    if limit < 1:
+        return JsonResponse({"error": "limit must be a positive integer"}, status=400)
     
-    # Execute a deliberately inefficient query
-    with connection.cursor() as cursor:
-        # Using raw SQL to demonstrate a poorly optimized query
-        cursor.execute("""
-            SELECT u.username, COUNT(o.id) as order_count
-            FROM api_userprofile u
-            LEFT JOIN api_order o ON u.id = o.user_id
-            GROUP BY u.username
-            ORDER BY order_count DESC
-        """)
-        results = cursor.fetchall()
+    start_time = time.time()
+    top_users = leaderboard.top_users(limit)
     
     # Simulate additional processing time
     time.sleep(random.uniform(0.5, 2.0))
     
     duration = time.time() - start_time
-    metrics.track_db_query('COMPLEX_JOIN', 'multiple_tables', duration)
     
     logger.warning(f"Slow query executed in {duration:.4f}s",
-                  extra={"query_duration": duration, "query_type": "COMPLEX_JOIN"})
+                  extra={"query_duration": duration, "query_type": "LEADERBOARD"})
     
     return JsonResponse({
         "message": f"Slow query completed in {duration:.4f} seconds",
-        "results_count": len(results)
+        "results_count": len(top_users),
+        "top_users": [
+            {"username": username, "order_count": order_count}
+            for username, order_count in top_users
+        ]
     })
 
+def prometheus_metrics(request):
+    """
+    Prometheus scrape endpoint.
+
+    Under a multi-worker server (``PROMETHEUS_MULTIPROC_DIR`` set) the response
+    aggregates every worker's metric files, so a scrape reflects the whole
+    deployment rather than whichever worker answered it.
+    """
+    return HttpResponse(generate_latest(metrics.scrape_registry()), content_type=CONTENT_TYPE_LATEST)
+
 def leak_simulation(request):
     """
     Endpoint that intentionally creates a memory leak.
@@ -290,9 +478,8 @@ def leak_simulation(request):
     """
     logger.info("Memory leak simulation endpoint accessed")
     
-    # Get current memory stats before leak
-    process = psutil.Process(os.getpid())
-    before_mem = process.memory_info().rss / (1024 * 1024)  # MB
+    # Get current memory stats before leak (fresh samples, so the difference is visible)
+    before_mem = metrics.get_process_snapshot(max_age=0)['rss_bytes'] / (1024 * 1024)  # MB
     
     # Simulate memory leak
     leak_size = int(request.GET.get('size', '1000'))
@@ -300,7 +487,7 @@ def leak_simulation(request):
         metrics.simulate_memory_leak(request.path, size=leak_size)
     
     # Get memory after leak
-    after_mem = process.memory_info().rss / (1024 * 1024)  # MB
+    after_mem = metrics.get_process_snapshot(max_age=0)['rss_bytes'] / (1024 * 1024)  # MB
     
     logger.warning(f"Memory usage increased from {before_mem:.2f}MB to {after_mem:.2f}MB",
                   extra={
@@ -310,8 +497,6 @@ def leak_simulation(request):
                       "leak_objects": len(metrics.MEMORY_LEAK_CACHE)
                   })
     
-    metrics.update_memory_usage(process.memory_info().rss)
-    
     return JsonResponse({
         "message": "Memory leak simulated",
         "memory_before_mb": before_mem,
@@ -353,13 +538,3 @@ def generate_error(request):
     
     # This code will never be reached due to the errors above
     return JsonResponse({"message": "No error generated"})
-
-def is_connection_active():
-    try:
-        # Execute a simple test query
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT 1")
-            return True
-    except Exception as e:
-        print(f"Connection error: {e}")
-        return False
\ No newline at end of file
@@ -0,0 +1,36 @@
+# gunicorn.conf.py
+# Run with: gunicorn -c gunicorn.conf.py tutorial_1.wsgi:application
+# (or, for ASGI: gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker tutorial_1.asgi:application;
+# plain `uvicorn --workers` has no hook to clean up after dead workers)
+import os
+import shutil
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+
+# Prometheus multiprocess mode: every worker writes its metrics to mmap-backed
+# files here and /metrics aggregates them. Set before any worker imports
+# prometheus_client.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/tutorial_1-prometheus')
+
+def on_starting(server):
+    # Files left by a previous run would be aggregated into this one's counters
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+def post_worker_init(worker):
+    from api import metrics
+    metrics.worker_publisher.ensure_started()
+
+def worker_exit(server, worker):
+    # Write this worker's buffered metric updates before it goes; the atexit flush
+    # in api.metrics covers other exits
+    from api import metrics
+    metrics.recorder.flush()
+
+def child_exit(server, worker):
+    # Drop the dead worker's live gauges (in-progress requests, process stats, pool state);
+    # its counters and histograms stay so totals never go backwards
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -51,9 +52,14 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "api.middleware.request_tracking_middleware",  
+    "api.middleware.query_budget_middleware",
     "api.middleware.memory_leak_middleware",  
     "django_prometheus.middleware.PrometheusAfterMiddleware"
 ]
+# Let the api middlewares run natively async under ASGI. Off while the views are
+# sync: the async chain makes the MiddlewareMixin middlewares above hop per hook
+# (see `manage.py bench_asgi`)
+API_MIDDLEWARE_ASYNC = False
 
 ROOT_URLCONF = "tutorial_1.urls"
 
@@ -87,9 +93,47 @@ DATABASES = {
         'PASSWORD': 'appy',
         'HOST': 'localhost',  # or '127.0.0.1'
         'PORT': '5432',
+        # Validate reused connections before handing them to a request
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Connection reuse. With DB_POOL enabled (the default), each process keeps a
+# psycopg connection pool and requests borrow from it; otherwise connections
+# persist per thread for DB_CONN_MAX_AGE seconds. Django doesn't allow both.
+if os.environ.get('DB_POOL', 'true').lower() in ('1', 'true', 'yes'):
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+            'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),  # Max wait for a free connection
+            'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', 300)),  # Close idle extras after this
+            'max_lifetime': float(os.environ.get('DB_POOL_MAX_LIFETIME', 3600)),  # Recycle connections
+        },
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('DB_CONN_MAX_AGE', 60))
+
+
+# Cache
+# Local memory by default (per process, fine for development and tests); set
+# CACHE_REDIS_URL to share the cache between workers in production.
+
+if os.environ.get('CACHE_REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['CACHE_REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -141,6 +185,26 @@ LOGGING = {
             'formatter': 'json',
             'filters': ['request_id'],
             'url': 'http://localhost:3100/loki/api/v1/push',
+            # Ship from a background thread so logging never blocks a request
+            'mode': 'async',
+            'batch_size': 100,
+            'flush_interval': 2,
+            'queue_size': 10000,
+            'overflow_policy': 'drop_oldest',
+            # Only low-cardinality fields become stream labels; per-request
+            # identifiers travel as structured metadata instead
+            'labels': ['level', 'module', 'app'],
+            'metadata_fields': ['request_id', 'user_id', 'trace_id'],
+            'metadata_mode': 'structured',
+            # Retry, then park undeliverable batches on disk until Loki recovers
+            'max_retries': 3,
+            'breaker_threshold': 5,
+            'breaker_reset_timeout': 30,
+            'spill_path': BASE_DIR / 'loki-spill.ndjson',
+            'spill_max_bytes': 50 * 1024 * 1024,
+            # Build the JSON line straight from the record in a single encode
+            'record_format': 'structured',
+            'json_backend': 'auto',
         },
     },
     'loggers': {
@@ -184,3 +248,55 @@ MEMORY_LEAK_PROBABILITY = 0.05  # 5% chance of leak on requests to leak-prone en
 
 # Prometheus pushgateway settings
 PROMETHEUS_PUSHGATEWAY = 'localhost:9091'  # Pushgateway service address
+
+# Health check settings
+HEALTH_CHECK_TTL = 5  # Seconds between background health snapshot refreshes
+
+# Upper bound on distinct endpoint labels in the HTTP request metrics
+METRICS_MAX_ENDPOINT_LABELS = 200
+
+# List endpoint pagination
+API_DEFAULT_PAGE_SIZE = 100  # Rows per page when no limit is given
+API_MAX_PAGE_SIZE = 1000  # Server-side cap on the limit parameter
+API_EXPORT_CHUNK_SIZE = 2000  # Rows per database fetch in streaming exports
+
+# Batch ingestion endpoints
+BATCH_INGEST_MAX_ROWS = 10000  # Rows accepted per batch request
+BATCH_INGEST_CHUNK_SIZE = 1000  # Rows per bulk INSERT
+DATA_UPLOAD_MAX_MEMORY_SIZE = 20 * 1024 * 1024  # Room for full-size batch bodies
+
+# Item catalog read-through cache
+CATALOG_CACHE_LIST_TTL = 30  # Seconds a cached item list page lives
+CATALOG_CACHE_ITEM_TTL = 300  # Seconds a cached single item lives
+CATALOG_CACHE_LOCK_TIMEOUT = 5  # Max seconds to wait for another worker's recompute
+
+# Order status metrics
+ORDER_STATUSES = ('pending', 'processing', 'completed', 'cancelled', 'abandoned')  # Others count as "other"
+ORDER_STATS_RECONCILE_INTERVAL = 300  # Seconds between recounts from the database
+
+# Order leaderboard
+LEADERBOARD_MAX_SIZE = 100  # Cap on the number of users a leaderboard query returns
+
+# Database query instrumentation
+DB_INSTRUMENTATION_ENABLED = True  # Time every SQL statement via a connection execute wrapper
+DB_N_PLUS_ONE_THRESHOLD = 10  # Executions of one SELECT fingerprint in a request that flag an N+1
+
+# Query budgets and slow query capture
+QUERY_BUDGET = {'queries': 50, 'db_time': 0.5}  # Per request, for routes not listed below
+QUERY_BUDGET_ROUTES = {  # By route, or by "METHOD route" for a single method
+    # Measured: a page of orders is 2 queries; a user's first order is 11, plus BEGIN and
+    # the order stats reconcile outside a test transaction (repeat orders skip the
+    # leaderboard's SAVEPOINT/INSERT/RELEASE)
+    'GET /api/orders/': {'queries': 5},
+    'POST /api/orders/': {'queries': 15},
+    '/api/users/batch/': {'queries': None, 'db_time': 10},
+    '/api/items/batch/': {'queries': None, 'db_time': 10},
+}
+SLOW_QUERY_THRESHOLD = 0.1  # Seconds; slower statements are candidates for EXPLAIN sampling
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = 0.05  # Fraction of slow statements explained (PostgreSQL only)
+SLOW_QUERY_EXPLAIN_INTERVAL = 300  # Seconds before the same statement is explained again
+SLOW_QUERY_EXPLAIN_TIMEOUT = 5  # statement_timeout for the EXPLAIN ANALYZE, in seconds
+
+# Request IDs and trace context
+REQUEST_ID_TRUST_INBOUND = True  # Reuse valid X-Request-ID/traceparent headers from the edge proxy
+DB_QUERY_COMMENTS = False  # Append /*request_id='...'*/ to SQL run for a request
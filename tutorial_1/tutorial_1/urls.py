@@ -1,16 +1,21 @@
 from django.contrib import admin
-from django.urls import path, include
-from api.views import api_root, status, user_list, item_list, order_list, slow_query, leak_simulation, generate_error
+from django.urls import path
+from api.views import api_root, status, liveness, readiness, user_list, user_batch, item_list, item_detail, item_batch, order_list, slow_query, prometheus_metrics, leak_simulation, generate_error
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", api_root),
     path("api/status/", status),
+    path("api/health/live/", liveness),
+    path("api/health/ready/", readiness),
     path("api/users/", user_list),
+    path("api/users/batch/", user_batch),
     path("api/items/", item_list),
+    path("api/items/batch/", item_batch),
+    path("api/items/<int:pk>/", item_detail),
     path("api/orders/", order_list),
     path("api/slow-query/", slow_query),
     path("api/leak-simulation/", leak_simulation),
     path("api/generate-error/", generate_error),
-    path("", include('django_prometheus.urls'))
+    path("metrics", prometheus_metrics, name="prometheus-django-metrics")
 ]